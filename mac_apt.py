@@ -18,18 +18,24 @@
 '''
 
 import argparse
+import datetime
 import logging
+import multiprocessing
 import os
 import plugins.helpers.macinfo as macinfo
+import plugins.helpers.worker_processes as worker_processes
 import pyewf
 import pytsk3
 import pyvmdk
+import queue
+import shutil
 import sys
 import textwrap
 import time
 import traceback
 from plugins.helpers.aff4_helper import EvidenceImageStream
-from plugins.helpers.apfs_reader import ApfsContainer, ApfsDbInfo
+from plugins.helpers.UnifiedLog.resources import LogFilter
+from plugins.helpers.apfs_reader import ApfsContainer, ApfsDbInfo, ApfsFileSystemParser, ApfsSysDataLinkedVolume
 from plugins.helpers.apple_sparse_image import AppleSparseImage
 from plugins.helpers.writer import *
 from plugins.helpers.disk_report import *
@@ -53,6 +59,30 @@ def CheckInputType(input_type):
     input_type = input_type.upper()
     return input_type in ['AFF4','E01','DD','DMG','VMDK','MOUNTED','SPARSE','AXIOMZIP']
 
+def ReadUtcDateTime(value):
+    '''For argparse, returns datetime from 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' '''
+    for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"'{value}' is not a valid date, use YYYY-MM-DD or \"YYYY-MM-DD HH:MM:SS\"")
+
+def ReadCommaSeparatedList(value):
+    '''For argparse, returns list of the comma separated items in value'''
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def SetPluginSettings(plugins, plugin_name, settings):
+    '''Sets settings (module level variables) of a plugin from command line options.
+       'settings' is a dictionary of name:value, settings with value None are not changed.
+    '''
+    for plugin in plugins:
+        if plugin.__Plugin_Name == plugin_name:
+            for name, value in settings.items():
+                if value is not None:
+                    setattr(plugin, name, value)
+            break
+
 ######### FOR HANDLING E01 file ###############
 class ewf_Img_Info(pytsk3.Img_Info):
   def __init__(self, ewf_handle):
@@ -201,6 +231,21 @@ def GetImgInfoObjectForSparse(path):
 
 #### End special handling for .sparseimage ####
 
+def OpenImage(input_type, input_path):
+    '''Returns an Img_Info object for the image, or None if input_type is not a disk image type'''
+    input_type = input_type.upper()
+    if input_type == 'E01':
+        return GetImgInfoObjectForE01(input_path)
+    elif input_type == 'VMDK':
+        return GetImgInfoObjectForVMDK(input_path)
+    elif input_type == 'AFF4':
+        return GetImgInfoObjectForAff4(input_path)
+    elif input_type == 'SPARSE':
+        return GetImgInfoObjectForSparse(input_path)
+    elif input_type in ('DD', 'DMG'):
+        return pytsk3.Img_Info(input_path) # Works for split dd images too! Works for DMG too, if no compression/encryption is used!
+    return None
+
 def FindMacOsFiles(mac_info):
     if mac_info.IsValidFilePath('/System/Library/CoreServices/SystemVersion.plist'):
         if mac_info.IsValidFilePath("/System/Library/Kernels/kernel") or \
@@ -276,6 +321,62 @@ def GetApfsContainerUuid(img, container_start_offset):
     uuid = UUID(bytes=uuid_bytes)
     return uuid
 
+def UseExistingApfsDb(mac_info, db_path):
+    '''Opens an existing APFS db and checks if it has the correct data for the
+       loaded container. If so, volumes are set up to use it and True is returned.
+    '''
+    existing_db = SqliteWriter()
+    existing_db.OpenSqliteDb(db_path)
+    apfs_db_info = ApfsDbInfo(existing_db)
+    if apfs_db_info.CheckVerInfo() and apfs_db_info.CheckVolInfoAndGetVolEncKey(mac_info.apfs_container.volumes):
+        # all good, db is up to date, use it
+        mac_info.apfs_db = existing_db
+        if mac_info.apfs_sys_volume:
+            mac_info.apfs_data_volume.dbo = mac_info.apfs_db
+            mac_info.apfs_sys_volume.dbo = mac_info.apfs_db
+            mac_info.apfs_preboot_volume.dbo = mac_info.apfs_db
+            mac_info.apfs_update_volume.dbo = mac_info.apfs_db
+            mac_info.UseCombinedVolume()
+        return True
+    existing_db.CloseDb()
+    return False
+
+def IsApfsDbUpToDate(mac_info, db_path):
+    '''Opens an existing APFS db read-only and returns True if it has the
+       correct data for the loaded container. The db is not modified.
+    '''
+    existing_db = SqliteWriter()
+    try:
+        existing_db.OpenSqliteDb(db_path, read_only=True)
+    except (OSError, sqlite3.Error):
+        return False
+    apfs_db_info = ApfsDbInfo(existing_db)
+    is_up_to_date = apfs_db_info.CheckVerInfo() and apfs_db_info.CheckVolInfoAndGetVolEncKey(mac_info.apfs_container.volumes)
+    existing_db.CloseDb()
+    return is_up_to_date
+
+def CopyApfsDbFromCache(cached_db_path, db_path):
+    '''Copies a cached APFS db to the output folder, so the cached db is never
+       modified by this run. Returns True if successful.
+    '''
+    try:
+        shutil.copyfile(cached_db_path, db_path)
+        return True
+    except OSError:
+        log.exception('Failed to copy APFS db from cache folder')
+    return False
+
+def SaveApfsDbToCache(db_path, cached_db_path):
+    '''Copies a completed APFS db to the cache folder, for use by later runs'''
+    try:
+        os.makedirs(os.path.dirname(cached_db_path), exist_ok=True)
+        temp_path = cached_db_path + '.tmp'
+        shutil.copyfile(db_path, temp_path)
+        os.replace(temp_path, cached_db_path) # So other runs never see a partial db
+        log.info('Saved APFS db to cache folder as ' + cached_db_path)
+    except OSError:
+        log.exception('Failed to save APFS db to cache folder')
+
 def FindMacOsPartitionInApfsContainer(img, vol_info, container_size, container_start_offset, container_uuid):
     global mac_info
     mac_info = macinfo.ApfsMacInfo(mac_info.output_params, mac_info.password, mac_info.dont_decrypt)
@@ -302,33 +403,32 @@ def FindMacOsPartitionInApfsContainer(img, vol_info, container_size, container_s
         # start db
         use_existing_db = False
         apfs_sqlite_path = os.path.join(mac_info.output_params.output_path, "APFS_Volumes_" + str(container_uuid).upper() + ".db")
-        if os.path.exists(apfs_sqlite_path): # Check if db already exists
-            existing_db = SqliteWriter()     # open & check if it has the correct data
-            existing_db.OpenSqliteDb(apfs_sqlite_path)
-            apfs_db_info = ApfsDbInfo(existing_db)
-            if apfs_db_info.CheckVerInfo() and apfs_db_info.CheckVolInfoAndGetVolEncKey(mac_info.apfs_container.volumes):
-                # all good, db is up to date, use it
+        cached_db_path = None
+        if args.apfs_cache_dir: # Check if a db built by an earlier run for this container state exists
+            cached_db_path = os.path.join(args.apfs_cache_dir, ApfsDbInfo.GetCacheFileName(container_uuid, mac_info.apfs_container.volumes))
+            if os.path.exists(cached_db_path):
+                if IsApfsDbUpToDate(mac_info, cached_db_path):
+                    if CopyApfsDbFromCache(cached_db_path, apfs_sqlite_path) and UseExistingApfsDb(mac_info, apfs_sqlite_path):
+                        use_existing_db = True
+                        log.info('Found a matching APFS db in the cache folder ({}), copied it to the output folder, will not read APFS volumes again!'.format(cached_db_path))
+                else:
+                    log.info('Found a cached APFS db, but it is STALE, it will be replaced!')
+        if not use_existing_db and os.path.exists(apfs_sqlite_path): # Check if db already exists
+            if UseExistingApfsDb(mac_info, apfs_sqlite_path):
                 use_existing_db = True
-                mac_info.apfs_db = existing_db
-                if mac_info.apfs_sys_volume:
-                    mac_info.apfs_data_volume.dbo = mac_info.apfs_db
-                    mac_info.apfs_sys_volume.dbo = mac_info.apfs_db
-                    mac_info.apfs_preboot_volume.dbo = mac_info.apfs_db
-                    mac_info.apfs_update_volume.dbo = mac_info.apfs_db
-                    mac_info.UseCombinedVolume()
                 log.info('Found an existing APFS_Volumes.db in the output folder, looks good, will not create a new one!')
             else:
                 # db does not seem up to date, create a new one and read info
-                existing_db.CloseDb()
                 log.info('Found an existing APFS_Volumes.db in the output folder, but it is STALE, creating a new one!')
                 os.remove(apfs_sqlite_path)
         if not use_existing_db:
             apfs_sqlite_path = SqliteWriter.CreateSqliteDb(apfs_sqlite_path) # Will create with next avail file name
             mac_info.apfs_db = SqliteWriter()
             mac_info.apfs_db.OpenSqliteDb(apfs_sqlite_path)
+            mac_info.apfs_db.BeginBulkInsert() # Fast pragmas for the whole run, each volume commits & creates its indexes when loaded
             try:
                 log.info('Reading APFS volumes from container, this may take a few minutes ...')
-                mac_info.ReadApfsVolumes()
+                mac_info.ReadApfsVolumes(args.apfs_workers, lambda: OpenImage(args.input_type, args.input_path), args.apfs_block_workers, args.apfs_paths_method)
                 apfs_db_info = ApfsDbInfo(mac_info.apfs_db)
                 apfs_db_info.WriteVolInfo(mac_info.apfs_container.volumes)
                 if mac_info.apfs_sys_volume:
@@ -336,10 +436,16 @@ def FindMacOsPartitionInApfsContainer(img, vol_info, container_size, container_s
                     mac_info.apfs_sys_volume.dbo = mac_info.apfs_db
                     if not mac_info.CreateCombinedVolume():
                         return False
+                mac_info.apfs_db.EndBulkInsert() # Version info is written last, only after all data is committed
                 apfs_db_info.WriteVersionInfo()
+                if cached_db_path:
+                    SaveApfsDbToCache(apfs_sqlite_path, cached_db_path)
             except:
                 log.exception('Error while reading APFS volumes')
                 return False
+            finally:
+                if mac_info.apfs_db.bulk_insert_mode:
+                    mac_info.apfs_db.EndBulkInsert()
         mac_info.output_params.apfs_db_path = apfs_sqlite_path
 
         if mac_info.apfs_sys_volume: # catalina or above
@@ -427,6 +533,96 @@ def ReadPasswordFromFile(path):
     f.close()
     return data.replace('\n', '').replace('\r', '')
 
+def GetTimeString(seconds):
+    return time.strftime('%H:%M:%S', time.gmtime(seconds))
+
+def RunPlugin(plugin, mac_info):
+    '''Runs a single plugin, returns its run time in seconds'''
+    log.info("-"*50)
+    log.info("Running plugin " + plugin.__Plugin_Name)
+    time_started = time.time()
+    try:
+        plugin.Plugin_Start(mac_info)
+    except Exception as ex:
+        log.exception ("An exception occurred while running plugin - {}".format(plugin.__Plugin_Name))
+    run_time = time.time() - time_started
+    log.info("Plugin {} finished in time = {}".format(plugin.__Plugin_Name, GetTimeString(run_time)))
+    return run_time
+
+def _PluginWorker(task_queue, output_queue):
+    '''Worker process function, runs plugins (indexes into plugins list) taken 
+       from task_queue until None is received. All output is sent over output_queue.
+    '''
+    export_log = output_params.export_log_sqlite # Keep a reference, it is owned (and closed) by main process
+    try:
+        mac_info._ReopenImageHandles(mac_info.image_opener)
+        SetWriterQueue(output_queue, output_params.output_db_path)
+        output_params.export_log_sqlite = ExportLogQueueWriter(output_queue)
+        while True:
+            index = task_queue.get()
+            if index is None:
+                break
+            run_time = RunPlugin(plugins[index], mac_info)
+            output_queue.put(('plugin_finished', index, run_time))
+    except Exception:
+        log.exception('Error in plugin worker process')
+    output_queue.put(('worker_exit', ))
+
+def RunPluginsInParallel(plugins_to_process, num_jobs):
+    '''Runs plugins in forked worker processes, each with its own handles to the
+       image and APFS db. Output from all workers is written by this process.
+       Returns False if parallel processing is not possible.
+    '''
+    try:
+        # Workers inherit the loaded mac_info, so fork is needed
+        mp_context = multiprocessing.get_context('fork')
+    except ValueError:
+        log.info('Running plugins in parallel is not supported on this platform, running serially')
+        return False
+
+    num_jobs = min(num_jobs, len(plugins_to_process))
+    log.info(f'Running {len(plugins_to_process)} plugins using {num_jobs} worker processes')
+    task_queue = mp_context.Queue()
+    output_queue = mp_context.Queue(maxsize=1000) # Workers wait if writing falls behind
+    for plugin in plugins_to_process:
+        task_queue.put(plugins.index(plugin))
+    for _ in range(num_jobs):
+        task_queue.put(None)
+    # Not daemonic, plugins may start their own worker processes
+    workers = [mp_context.Process(target=_PluginWorker, args=(task_queue, output_queue)) for _ in range(num_jobs)]
+    for worker in workers:
+        worker.start()
+
+    queued_writes_handler = QueuedWritesHandler(output_params)
+    plugin_run_times = {}
+    running_workers = num_jobs
+    while running_workers:
+        try:
+            message = output_queue.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                log.error('Plugin worker processes exited unexpectedly')
+                break
+            continue
+        if message[0] == 'plugin_finished':
+            plugin_run_times[plugins[message[1]].__Plugin_Name] = message[2]
+        elif message[0] == 'worker_exit':
+            running_workers -= 1
+        elif not queued_writes_handler.HandleMessage(message):
+            log.error(f'Unknown message type {message[0]} from plugin worker')
+    for worker in workers:
+        worker.join()
+    queued_writes_handler.FinishWrites()
+
+    log.info("-"*50)
+    log.info("Plugin run times:")
+    for plugin_name, run_time in sorted(plugin_run_times.items(), key=lambda x: x[1], reverse=True):
+        log.info("  {:<20}{}".format(plugin_name, GetTimeString(run_time)))
+    not_finished = [plugin.__Plugin_Name for plugin in plugins_to_process if plugin.__Plugin_Name not in plugin_run_times]
+    if not_finished:
+        log.error('These plugins did not complete in worker processes : ' + ', '.join(not_finished))
+    return True
+
 ## Main program ##
 
 plugins = []
@@ -459,6 +655,20 @@ arg_parser.add_argument('-l', '--log_level', help='Log levels: INFO, DEBUG, WARN
 arg_parser.add_argument('-p', '--password', help='Personal Recovery Key(PRK) or Password for any user (for decrypting encrypted volume).')
 arg_parser.add_argument('-pf', '--password_file', help='Text file containing Personal Recovery Key(PRK) or Password')
 arg_parser.add_argument('-d', '--dont_decrypt', default=False, action="store_true", help='Don\'t decrypt as image is already decrypted!')
+arg_parser.add_argument('-w', '--apfs_workers', type=int, default=1, help='Number of processes for parsing APFS volumes in parallel (Default is 1, no parallel parsing)')
+arg_parser.add_argument('-b', '--apfs_block_workers', type=int, default=1, help='Number of processes for decoding APFS b-tree blocks of a volume (Default is 1).\nNot used for volumes parsed by --apfs_workers')
+arg_parser.add_argument('-pm', '--apfs_paths_method', default='memory', choices=ApfsFileSystemParser.paths_build_methods, help='How the APFS Paths table is built, memory = in python (fastest, Default), cte = recursive sql query,\ncompare = both, logs their timings and any differences')
+arg_parser.add_argument('-pw', '--parse_workers', type=int, help='Number of processes used by plugins (FSEVENTS, SPOTLIGHT, UNIFIEDLOGS) to parse files in parallel (Default is 1, no parallel parsing).\nWith --jobs, this is shared by the plugins running in parallel')
+arg_parser.add_argument('--spotlight_sqlite_only', action="store_true", help='SPOTLIGHT: Only write store items and paths to sqlite, the <prefix>_data.txt and\n<prefix>_fullpaths.tsv files are not written (faster for large stores)')
+arg_parser.add_argument('--unifiedlogs_export', action="store_true", help='UNIFIEDLOGS: Export the diagnostics & uuidtext folders and parse the exported copies\n(Default is to read the log files directly from the image)')
+arg_parser.add_argument('--unifiedlogs_start_time', metavar='DATETIME', type=ReadUtcDateTime, help='UNIFIEDLOGS: Only extract logs from this UTC time on, as YYYY-MM-DD or "YYYY-MM-DD HH:MM:SS"')
+arg_parser.add_argument('--unifiedlogs_end_time', metavar='DATETIME', type=ReadUtcDateTime, help='UNIFIEDLOGS: Only extract logs up to this UTC time, as YYYY-MM-DD or "YYYY-MM-DD HH:MM:SS"')
+arg_parser.add_argument('--unifiedlogs_subsystems', metavar='LIST', type=ReadCommaSeparatedList, help='UNIFIEDLOGS: Only extract logs of these subsystems (comma separated)\nEg: com.apple.xpc,com.apple.securityd')
+arg_parser.add_argument('--unifiedlogs_categories', metavar='LIST', type=ReadCommaSeparatedList, help='UNIFIEDLOGS: Only extract logs of these categories (comma separated)')
+arg_parser.add_argument('--unifiedlogs_processes', metavar='LIST', type=ReadCommaSeparatedList, help='UNIFIEDLOGS: Only extract logs of these process names (comma separated)\nEg: sshd,kernel')
+arg_parser.add_argument('--unifiedlogs_min_level', metavar='LEVEL', choices=list(LogFilter.log_levels), help='UNIFIEDLOGS: Only extract logs of this level or higher')
+arg_parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of plugins to run in parallel, each in its own process (Default is 1).\nNot used with XLSX output')
+arg_parser.add_argument('-ac', '--apfs_cache_dir', help='Folder to keep APFS metadata dbs in. If a db for the same container (UUID and volume state) is found,\nit is used instead of reading the APFS volumes again. New dbs are saved here.')
 #arg_parser.add_argument('-u', '--use_tsk', action="store_true", help='Use sleuthkit instead of native HFS+ parser (This is slower!)')
 arg_parser.add_argument('plugin', nargs="+", help="Plugins to run (space separated). FAST will run most plugins")
 args = arg_parser.parse_args()
@@ -498,6 +708,18 @@ LogLibraryVersions(log)
 if not CheckInputType(args.input_type): 
     Exit("Exiting -> 'input_type' " + args.input_type + " not recognized")
 
+SetPluginSettings(plugins, 'SPOTLIGHT', { 'sqlite_only_output': True if args.spotlight_sqlite_only else None })
+SetPluginSettings(plugins, 'UNIFIEDLOGS', { 'export_log_files': True if args.unifiedlogs_export else None,
+    'filter_start_time': args.unifiedlogs_start_time, 'filter_end_time': args.unifiedlogs_end_time, 
+    'filter_subsystems': args.unifiedlogs_subsystems, 'filter_categories': args.unifiedlogs_categories, 
+    'filter_process_names': args.unifiedlogs_processes, 'filter_min_log_level': args.unifiedlogs_min_level })
+
+if args.parse_workers and args.parse_workers > 1:
+    # Each plugin job gets its share, so there are about parse_workers processes in all
+    worker_processes.num_parse_workers = max(1, args.parse_workers // max(1, args.jobs))
+    if args.jobs > 1:
+        log.info(f'--parse_workers {args.parse_workers} is shared by {args.jobs} jobs, each plugin may use {worker_processes.num_parse_workers} worker processes')
+
 plugins_to_run = [x.upper() for x in args.plugin]  # convert all plugin names entered by user to uppercase
 process_all = IsItemPresentInList(plugins_to_run, 'ALL')
 if not process_all:
@@ -548,20 +770,8 @@ found_macos = False
 mac_info = None
 time_processing_started = time.time()
 try:
-    if args.input_type.upper() == 'E01':
-        img = GetImgInfoObjectForE01(args.input_path)
-        mac_info = macinfo.MacInfo(output_params)
-    elif args.input_type.upper() == 'VMDK':
-        img = GetImgInfoObjectForVMDK(args.input_path)
-        mac_info = macinfo.MacInfo(output_params)
-    elif args.input_type.upper() == 'AFF4':
-        img = GetImgInfoObjectForAff4(args.input_path)
-        mac_info = macinfo.MacInfo(output_params)
-    elif args.input_type.upper() == 'SPARSE':
-        img = GetImgInfoObjectForSparse(args.input_path)
-        mac_info = macinfo.MacInfo(output_params)
-    elif args.input_type.upper() in ('DD', 'DMG'):
-        img = pytsk3.Img_Info(args.input_path) # Works for split dd images too! Works for DMG too, if no compression/encryption is used!
+    if args.input_type.upper() in ('E01', 'VMDK', 'AFF4', 'SPARSE', 'DD', 'DMG'):
+        img = OpenImage(args.input_type, args.input_path)
         mac_info = macinfo.MacInfo(output_params)
     elif args.input_type.upper() == 'MOUNTED':
         if os.path.isdir(args.input_path):
@@ -615,20 +825,26 @@ if args.input_type.upper() not in ('MOUNTED','AXIOMZIP'):
 if found_macos:
     if not mac_info.is_apfs:
         mac_info.hfs_native.Initialize(mac_info.pytsk_image, mac_info.macos_partition_start_offset)
-    for plugin in plugins:
-        if process_all or IsItemPresentInList(plugins_to_run, plugin.__Plugin_Name):
-            log.info("-"*50)
-            log.info("Running plugin " + plugin.__Plugin_Name)
-            try:
-                plugin.Plugin_Start(mac_info)
-            except Exception as ex:
-                log.exception ("An exception occurred while running plugin - {}".format(plugin.__Plugin_Name))
+    if args.input_type.upper() not in ('MOUNTED','AXIOMZIP'):
+        mac_info.image_opener = lambda: OpenImage(args.input_type, args.input_path)
+    plugins_to_process = [plugin for plugin in plugins if process_all or IsItemPresentInList(plugins_to_run, plugin.__Plugin_Name)]
+    if args.jobs > 1 and len(plugins_to_process) > 1:
+        if args.xlsx: # Sheets are written as a whole, they cannot be interleaved
+            log.info('Plugins cannot be run in parallel when XLSX output is selected, running serially')
+        elif RunPluginsInParallel(plugins_to_process, args.jobs):
+            plugins_to_process = []
+    for plugin in plugins_to_process:
+        RunPlugin(plugin, mac_info)
 else:
     log.warning (":( Could not find a partition having a macOS installation on it")
 
 log.info("-"*50)
 
 # Final cleanup
+if mac_info.is_apfs and mac_info.apfs_container != None:
+    if isinstance(mac_info.macos_FS, ApfsSysDataLinkedVolume): # Not one of the container's volumes
+        log.debug('Combined volume file metadata cache stats: ' + mac_info.macos_FS.files_meta_cache.GetStats())
+    mac_info.apfs_container.close()
 if img != None: img.close()
 if args.xlsx:
     output_params.xlsx_writer.CommitAndCloseFile()
@@ -639,5 +855,5 @@ if output_params.export_log_sqlite:
 
 time_processing_ended = time.time()
 run_time = time_processing_ended - time_processing_started
-log.info("Finished in time = {}".format(time.strftime('%H:%M:%S', time.gmtime(run_time))))
+log.info("Finished in time = {}".format(GetTimeString(run_time)))
 log.info("Review the Log file and report any ERRORs or EXCEPTIONS to the developers")
@@ -8,8 +8,13 @@
 '''
 
 from plugins.helpers.macinfo import *
+from plugins.helpers.worker_processes import GetNumParseWorkers, WorkerPool
 from plugins.helpers.writer import *
+import collections
+import io
 import logging
+import os
+import pickle
 import zlib
 import struct
 
@@ -103,29 +108,43 @@ FlagValues = {
 data_writer = ChunkedDataWriter()
 out_params = None
 total_logs_processed = 0
+# Max rows held in memory before they are written. With worker processes, this is 
+# shared by the workers and the writer.
+max_rows_in_memory = 500000
+
+fsevent_info = [ ('LogID',DataType.TEXT),
+                 ('EventFlagsHex',DataType.TEXT),('EventType',DataType.TEXT),('EventFlags',DataType.TEXT),
+                 ('Filepath',DataType.TEXT),
+                 ('File_ID',DataType.INTEGER),('Log_Unknown',DataType.INTEGER),
+                 ('SourceModDate',DataType.DATE),('Source',DataType.TEXT)
+               ]
+
+# Precompiled structs for the page header and the fixed size part after each record's path
+page_header_struct = struct.Struct("<4sII")
+record_v1_struct = struct.Struct("<QI")   # log_id, log_event_flag
+record_v2_struct = struct.Struct("<QIq")  # log_id, log_event_flag, log_file_id
+record_v3_struct = struct.Struct("<QIqi") # log_id, log_event_flag, log_file_id, log_unknown
 
 # [log_id, log_event_flag, log_filepath, log_file_id, log_unknown, source_date, source]
 def PrintAll(logs):
-    global FlagValues
-    global TypeValues
-    global data_writer
-    global out_params
-    fsevent_info = [ ('LogID',DataType.TEXT),
-                     ('EventFlagsHex',DataType.TEXT),('EventType',DataType.TEXT),('EventFlags',DataType.TEXT),
-                     ('Filepath',DataType.TEXT),
-                     ('File_ID',DataType.INTEGER),('Log_Unknown',DataType.INTEGER),
-                     ('SourceModDate',DataType.DATE),('Source',DataType.TEXT)
-                   ]
-
     log.info ("Writing " + str(len(logs)) + " fsevent(s)")
+    WriteFormattedLogs(FormatLogs(logs))
+
+def FormatLogs(logs):
+    '''Returns list of rows for writing'''
     fsevent_list = []
     for x in logs:
         e_item =  [ "{:016X}".format(x[0]), 
-                    "{:08X}".format(x[1]), GetEventFlagsString(x[1], TypeValues), GetEventFlagsString(x[1], FlagValues), 
+                    "{:08X}".format(x[1]), event_type_strings[x[1]], event_flag_strings[x[1]], 
                     x[2],
                     x[3], x[4], x[5], x[6]
                   ]
         fsevent_list.append(e_item)
+    return fsevent_list
+
+def WriteFormattedLogs(fsevent_list):
+    global data_writer
+    global out_params
     data_writer.WriteListPartial("fsevents information", "FsEvents", fsevent_list, fsevent_info, out_params, '')
 
 def GetEventFlagsString(flags, flag_values):
@@ -136,24 +155,43 @@ def GetEventFlagsString(flags, flag_values):
             list_flags.append(v)
     return '|'.join(list_flags)
 
+class EventFlagsStrings(dict):
+    '''Lookup table of flags --> GetEventFlagsString(flags, flag_values). Only a 
+       few distinct flag combinations are seen, each is computed once when first seen.'''
+    max_entries = 65536
+
+    def __init__(self, flag_values):
+        super().__init__()
+        self.flag_values = flag_values
+
+    def __missing__(self, flags):
+        if len(self) >= self.max_entries:
+            self.clear()
+        string = GetEventFlagsString(flags, self.flag_values)
+        self[flags] = string
+        return string
+
+event_type_strings = EventFlagsStrings(TypeValues)
+event_flag_strings = EventFlagsStrings(FlagValues)
+
 def ReadCString(buffer, buffer_size, start_pos):
     '''
     Reads null-terminated string starting at start_pos in buffer.
     Returns tuple (string, end_pos)
     '''
-    string = ""
-    end_pos = buffer[start_pos:].find(b'\0')
+    end_pos = buffer.find(b'\0', start_pos) # Searched in place, buffer is not copied
     if end_pos == -1: # Null not found
-        end_pos = len(buffer)
         string = buffer[start_pos:].decode("utf-8", "backslashreplace")
+        end_pos = len(buffer) + start_pos
     else:
-        string = buffer[start_pos:start_pos + end_pos].decode("utf-8", "backslashreplace")
-    end_pos += start_pos
+        string = buffer[start_pos:end_pos].decode("utf-8", "backslashreplace")
 
     return string, end_pos + 1
 
-def ParseData(buffer, logs, source_date, source):
-    '''Process buffer to extract log data and return number of logs processed'''
+def ParseData(buffer, logs, source_date, source, write_logs_func=None, max_logs=None):
+    '''Process buffer to extract log data and return number of logs processed.
+       If logs has more than max_logs (default max_rows_in_memory), they are passed to 
+       write_logs_func (default PrintAll) and cleared.'''
     global total_logs_processed
     num_logs_processed = 0
     buffer_size = len(buffer)
@@ -161,7 +199,7 @@ def ParseData(buffer, logs, source_date, source):
         log.error("Error, too small buffer (size={})".format(len(buffer)))
         return 0
     
-    header_sig, unknown, file_size = struct.unpack("<4sII", buffer[0:12])
+    header_sig, unknown, file_size = page_header_struct.unpack_from(buffer, 0)
     #Changed header_sig encoding so that it would actually match true against a string
     is_version3 = (str(header_sig, 'utf-8') == '3SLD')
     is_version2 = (str(header_sig, 'utf-8') == '2SLD')
@@ -172,56 +210,60 @@ def ParseData(buffer, logs, source_date, source):
         return 0
     
     pos = 12
+    end = min(buffer_size, file_size) # buffer size is always larger, this skips the junk data at its end
 
     try:
         if is_version3:
-            while pos < min(buffer_size, file_size): # buffer size is always larger, this skips the junk data at its end
+            unpack_from = record_v3_struct.unpack_from
+            while pos < end:
                 log_filepath, pos = ReadCString(buffer, buffer_size, pos)
-                log_id, log_event_flag, log_file_id, log_unknown = struct.unpack("<QIqi", buffer[pos:pos+24])
+                log_id, log_event_flag, log_file_id, log_unknown = unpack_from(buffer, pos)
                 pos += 24
                 num_logs_processed += 1
                 logs.append([log_id, log_event_flag, log_filepath, log_file_id, log_unknown, source_date, source])
         if is_version2:
-            while pos < min(buffer_size, file_size): # buffer size is always larger, this skips the junk data at its end
+            unpack_from = record_v2_struct.unpack_from
+            while pos < end:
                 log_filepath, pos = ReadCString(buffer, buffer_size, pos)
-                log_id, log_event_flag, log_file_id = struct.unpack("<QIq", buffer[pos:pos+20])
+                log_id, log_event_flag, log_file_id = unpack_from(buffer, pos)
                 pos += 20
                 num_logs_processed += 1
                 logs.append([log_id, log_event_flag, log_filepath, log_file_id, None, source_date, source])
         else:
-            while pos < min(buffer_size, file_size):
+            unpack_from = record_v1_struct.unpack_from
+            while pos < end:
                 log_filepath, pos = ReadCString(buffer, buffer_size, pos)
-                log_id, log_event_flag = struct.unpack("<QI", buffer[pos:pos+12])
+                log_id, log_event_flag = unpack_from(buffer, pos)
                 pos += 12
                 num_logs_processed += 1
                 logs.append([log_id, log_event_flag, log_filepath, None, None, source_date, source])
     except (ValueError, IndexError, struct.error):
         log.exception('Error processing stream from file {}, stream pos was {}'.format(source, pos))
-    if len(logs) > 500000:
-        PrintAll(logs)
+    if len(logs) > (max_logs or max_rows_in_memory):
+        (write_logs_func or PrintAll)(logs)
         logs.clear()
     total_logs_processed += num_logs_processed
     return num_logs_processed
 
-def ProcessFile(file_name, f, logs, source_date, source):
+def ProcessFile(file_name, f, logs, source_date, source, write_logs_func=None, max_logs=None):
     num_logs_processed_this_file = 0
     z = zlib.decompressobj(31)
     uncompressed_count = 0
-    uncompressed_data = b''
+    uncompressed_data = bytearray() # Grows in place, reused for every gzip member (page) in file
     gzip_start = 0
 
     try:
         while True:
             if z.unused_data == b"":
-                buf = f.read(65536)
+                buf = f.read(0x100000)
                 if buf == b"":
                     break
             else:
                 buf = z.unused_data
                 log.debug("decompressed={} bytes from gzip ({}) at pos={}".format(uncompressed_count, file_name, gzip_start))
-                num_logs_processed_this_file += ParseData(uncompressed_data, logs, source_date, source)
+                num_logs_processed_this_file += ParseData(uncompressed_data, logs, source_date, source, write_logs_func, max_logs)
 
-                uncompressed_data = b''
+                del uncompressed_data[:]
                 uncompressed_count = 0
                 gzip_start = f.tell() - len(buf)
                 z = zlib.decompressobj(31)
@@ -232,7 +274,7 @@ def ProcessFile(file_name, f, logs, source_date, source):
     except zlib.error:
         log.exception("Error trying to decompress file {}".format(source))
     if uncompressed_data:
-        num_logs_processed_this_file += ParseData(uncompressed_data, logs, source_date, source)
+        num_logs_processed_this_file += ParseData(uncompressed_data, logs, source_date, source, write_logs_func, max_logs)
 
     log.debug( "num_logs_processed from {} = {}".format(file_name, num_logs_processed_this_file))
 
@@ -244,12 +286,146 @@ def ReadUuid(f):
         log.exception('Error trying to read UUID')
     return uuid
 
-def ProcessFsevents(logs, folder_path, file_list, mac_info):
+# Used by ParallelFileParser, inherited by forked workers
+_parallel_parse_args = None # (temp_folder, rows_per_batch)
+
+def _ParseFileToTempFile(job):
+    '''Worker process function, parses one fsevents file and saves its rows (pickled
+       lists of formatted rows, at most rows_per_batch in each) in a temp file.
+       Returns tuple (index, temp_path, num_logs_processed)
+    '''
+    global total_logs_processed
+    index, file_name, data, source_date, source = job
+    temp_folder, rows_per_batch = _parallel_parse_args
+    temp_path = os.path.join(temp_folder, '{}.pickle'.format(index))
+    try:
+        total_logs_processed = 0
+        logs = []
+        with open(temp_path, 'wb') as temp_file:
+            def SaveLogs(logs_to_save):
+                pickle.dump(FormatLogs(logs_to_save), temp_file, pickle.HIGHEST_PROTOCOL)
+            ProcessFile(file_name, io.BytesIO(data), logs, source_date, source, SaveLogs, rows_per_batch)
+            if logs:
+                SaveLogs(logs)
+        return index, temp_path, total_logs_processed
+    except Exception:
+        log.exception('Error parsing {} in worker process'.format(source))
+    return index, None, 0
+
+class ParallelFileParser:
+    '''Parses fsevents files in worker processes. Rows are written here as workers 
+       finish, in the same order as a serial run. Workers save rows to temp files in
+       batches, so rows held in memory (by workers and writer) stay near max_rows_in_memory.
+       Worker processes and temp folder are only created when the first file is added.
+    '''
+    def __init__(self, logs, num_workers, output_path):
+        self.logs = logs
+        self.num_workers = num_workers
+        self.output_path = output_path
+        self.worker_pool = None
+        self.pool = None
+        self.workers_start_tried = False
+        self.rows_per_batch = max(1000, max_rows_in_memory // (num_workers + 1))
+        self.fsevent_list = [] # Formatted rows from workers, written when rows_per_batch is reached
+        self.pending = collections.deque() # (job, async_result) in file order
+        self.next_index = 0
+
+    def _StartWorkers(self):
+        '''Returns True if worker processes are running, starts them on first call'''
+        global _parallel_parse_args
+        if not self.workers_start_tried:
+            self.workers_start_tried = True
+            try:
+                self.worker_pool = WorkerPool(self.output_path, 'Fsevents_Temp_')
+                _parallel_parse_args = (self.worker_pool.temp_folder, self.rows_per_batch)
+                self.pool = self.worker_pool.Start(self.num_workers)
+                log.info('Parsing fsevents files using {} worker processes'.format(self.num_workers))
+            except (OSError, ValueError):
+                log.exception('Could not start worker processes, files will be parsed serially')
+        return self.pool is not None
+
+    def AddFile(self, file_name, f, source_date, source):
+        '''Reads file and queues it for parsing, writes rows of earlier files if done'''
+        if not self._StartWorkers():
+            ProcessFile(file_name, f, self.logs, source_date, source)
+            return
+        try:
+            data = f.read()
+        except (OSError, ValueError):
+            log.exception('Error reading file {}'.format(source))
+            return
+        self._WriteSeriallyParsedLogs() # These come first
+        job = (self.next_index, file_name, data, source_date, source)
+        self.next_index += 1
+        self.pending.append((job, self.pool.apply_async(_ParseFileToTempFile, [job])))
+        while len(self.pending) >= self.num_workers * 2:
+            self._WriteNextResult()
+
+    def _WriteNextResult(self):
+        global total_logs_processed
+        job, async_result = self.pending.popleft()
+        index, file_name, data, source_date, source = job
+        try:
+            index, temp_path, num_logs_processed = async_result.get()
+        except Exception: # Result could not be returned from worker
+            log.exception('Error getting result from worker process for {}'.format(source))
+            temp_path = None
+        if temp_path is None:
+            log.info('Parsing {} again, as it failed in worker process'.format(source))
+            self._WriteFormattedRows()
+            ProcessFile(file_name, io.BytesIO(data), self.logs, source_date, source)
+            self._WriteSeriallyParsedLogs()
+            return
+        log.debug("num_logs_processed from {} = {}".format(file_name, num_logs_processed))
+        total_logs_processed += num_logs_processed
+        with open(temp_path, 'rb') as temp_file:
+            while True:
+                try:
+                    self.fsevent_list.extend(pickle.load(temp_file))
+                except EOFError:
+                    break
+                if len(self.fsevent_list) >= self.rows_per_batch:
+                    self._WriteFormattedRows()
+        os.remove(temp_path)
+
+    def _WriteFormattedRows(self):
+        if self.fsevent_list:
+            log.info ("Writing " + str(len(self.fsevent_list)) + " fsevent(s)")
+            WriteFormattedLogs(self.fsevent_list)
+            self.fsevent_list = []
+
+    def _WriteSeriallyParsedLogs(self):
+        if self.logs:
+            self._WriteFormattedRows()
+            PrintAll(self.logs)
+            self.logs.clear()
+
+    def Finish(self):
+        '''Waits for all queued files and writes their rows'''
+        while self.pending:
+            self._WriteNextResult()
+        self._WriteFormattedRows()
+
+    def Close(self):
+        global _parallel_parse_args
+        if self.worker_pool:
+            self.worker_pool.Close()
+        _parallel_parse_args = None
+
+def CreateParallelFileParser(logs, output_path):
+    '''Returns ParallelFileParser or None if files cannot be parsed in parallel'''
+    num_workers = GetNumParseWorkers()
+    if num_workers < 2:
+        return None
+    return ParallelFileParser(logs, num_workers, output_path)
+
+def ProcessFsevents(logs, folder_path, file_list, mac_info, file_parser=None):
     ''' Process Fsevents from files
         Args:
             logs - list to be populated
             file_list - list returned from mac_info.ListItemsInFolder
             mac_info - MacInfo object
+            file_parser - ParallelFileParser object, if files are parsed in worker processes
     '''
     for item in file_list:
         file_name = item['name']
@@ -262,6 +438,8 @@ def ProcessFsevents(logs, folder_path, file_list, mac_info):
                 log.info("fseventsd-uuid={}".format(uuid))
             elif file_name == 'no_log':
                 log.info("'no_log' file found, so no logs will be here!")
+            elif file_parser:
+                file_parser.AddFile(file_name, f, item['dates']['m_time'], path)
             else:
                 ProcessFile(file_name, f, logs, item['dates']['m_time'], path)
         else:
@@ -275,15 +453,22 @@ def Plugin_Start(mac_info):
     out_params = mac_info.output_params
     logs = []
 
-    file_list = mac_info.ListItemsInFolder('/.fseventsd', EntryType.FILES, True)
-    ProcessFsevents(logs, '/.fseventsd', file_list, mac_info)
-
-    #if hasattr(mac_info, 'BuildFullPath') or isinstance(mac_info, ZipMacInfo): # its a MOUNTED or live image
-    os_ver = mac_info.GetVersionDictionary()
-    if (os_ver['major'] == 10 and os_ver['minor'] >= 15) or os_ver['major'] >= 11:
-        # Then also get DATA volume's FSEVENTS from /System/Volumes/Data
-        file_list = mac_info.ListItemsInFolder('/System/Volumes/Data/.fseventsd', EntryType.FILES, True)
-        ProcessFsevents(logs, '/System/Volumes/Data/.fseventsd', file_list, mac_info)
+    file_parser = CreateParallelFileParser(logs, out_params.output_path)
+    try:
+        file_list = mac_info.ListItemsInFolder('/.fseventsd', EntryType.FILES, True)
+        ProcessFsevents(logs, '/.fseventsd', file_list, mac_info, file_parser)
+
+        #if hasattr(mac_info, 'BuildFullPath') or isinstance(mac_info, ZipMacInfo): # its a MOUNTED or live image
+        os_ver = mac_info.GetVersionDictionary()
+        if (os_ver['major'] == 10 and os_ver['minor'] >= 15) or os_ver['major'] >= 11:
+            # Then also get DATA volume's FSEVENTS from /System/Volumes/Data
+            file_list = mac_info.ListItemsInFolder('/System/Volumes/Data/.fseventsd', EntryType.FILES, True)
+            ProcessFsevents(logs, '/System/Volumes/Data/.fseventsd', file_list, mac_info, file_parser)
+        if file_parser:
+            file_parser.Finish()
+    finally:
+        if file_parser:
+            file_parser.Close()
     
     if len(logs) > 0:
         PrintAll(logs)
@@ -306,16 +491,26 @@ def Plugin_Start_Standalone(input_files_list, output_params):
         data_writer = ChunkedDataWriter()
         total_logs_processed = 0
         files_list = os.listdir(input_path)
-        for file_name in files_list:
-            if file_name == 'fseventsd-uuid':
-                pass
-            else:
-                path = os.path.join(input_path, file_name)
-                try:
-                    with open(path, 'rb') as f:
-                        ProcessFile(file_name, f, logs, CommonFunctions.ReadUnixTime(os.path.getmtime(path)), path)
-                except (OSError):
-                    log.exception('Failed to open file for reading: ' + path)
+        file_parser = CreateParallelFileParser(logs, output_params.output_path)
+        try:
+            for file_name in files_list:
+                if file_name == 'fseventsd-uuid':
+                    pass
+                else:
+                    path = os.path.join(input_path, file_name)
+                    try:
+                        with open(path, 'rb') as f:
+                            if file_parser:
+                                file_parser.AddFile(file_name, f, CommonFunctions.ReadUnixTime(os.path.getmtime(path)), path)
+                            else:
+                                ProcessFile(file_name, f, logs, CommonFunctions.ReadUnixTime(os.path.getmtime(path)), path)
+                    except (OSError):
+                        log.exception('Failed to open file for reading: ' + path)
+            if file_parser:
+                file_parser.Finish()
+        finally:
+            if file_parser:
+                file_parser.Close()
         if len(logs) > 0:
             PrintAll(logs)
             log.info("The source_date field on the fsevents are from the individual file modified date "\
@@ -335,11 +530,18 @@ def Plugin_Start_Ios(ios_info):
     out_params = ios_info.output_params
     logs = []
  
-    file_list = ios_info.ListItemsInFolder('/.fseventsd', EntryType.FILES, True)
-    ProcessFsevents(logs, '/.fseventsd', file_list, ios_info)
-
-    file_list = ios_info.ListItemsInFolder('/private/var/.fseventsd', EntryType.FILES, True)
-    ProcessFsevents(logs, '/private/var/.fseventsd', file_list, ios_info)
+    file_parser = CreateParallelFileParser(logs, out_params.output_path)
+    try:
+        file_list = ios_info.ListItemsInFolder('/.fseventsd', EntryType.FILES, True)
+        ProcessFsevents(logs, '/.fseventsd', file_list, ios_info, file_parser)
+
+        file_list = ios_info.ListItemsInFolder('/private/var/.fseventsd', EntryType.FILES, True)
+        ProcessFsevents(logs, '/private/var/.fseventsd', file_list, ios_info, file_parser)
+        if file_parser:
+            file_parser.Finish()
+    finally:
+        if file_parser:
+            file_parser.Close()
 
     if len(logs) > 0:
         PrintAll(logs)
@@ -176,7 +176,21 @@ class CachedFiles(object):
         except Exception:
             logger.exception('')
 
-def ReadTimesyncFile(buffer, ts_list):
+    def Close(self):
+        '''Closes all cached files, releasing their mmaps and file handles'''
+        for dsc in self.cached_dsc.values():
+            dsc.Close()
+        for ut in self.cached_uuidtext.values():
+            ut.Close()
+        self.cached_dsc = {}
+        self.cached_uuidtext = {}
+
+def ReadTimesyncFile(buffer, ts_list, ts_index=None):
+    '''Reads timesync entries from buffer into ts_list.
+       ts_index = dict of boot_uuid : Timesync for items in ts_list, built if not provided
+    '''
+    if ts_index is None:
+        ts_index = { ts.header.boot_uuid : ts for ts in ts_list }
     try:
         pos = 0
         size = len(buffer)
@@ -193,16 +207,13 @@ def ReadTimesyncFile(buffer, ts_list):
                 logger.info("Timesync header was 0x{:X} bytes instead of 0x30(48) bytes!".format(size))
             logger.debug("TIMEHEAD {}  0x{:016X}  {} {}".format(uuid, t_stamp, ReadAPFSTime(t_stamp), 'boot'))
             #TODO - TEST search ts_list for existing, not seen so far
-            existing_ts = None
-            for ts in ts_list:
-                if ts.header.boot_uuid == uuid:
-                    existing_ts = ts
-                    break
+            existing_ts = ts_index.get(uuid, None)
             if existing_ts:
                 ts_obj = existing_ts
             else:
                 ts_obj = resources.Timesync(ts_header)
                 ts_list.append(ts_obj)
+                ts_index[uuid] = ts_obj
                 # Adding header timestamp as Ts type too with cont_time = 0
                 timesync_item = resources.TimesyncItem(0, 0, t_stamp, tz, is_dst)
                 ts_obj.items.append(timesync_item)
@@ -222,7 +233,9 @@ def ReadTimesyncFolder(path, ts_list, vfs):
     '''Reads files in the timesync folder specified by 'path' and populates ts_list 
        with timesync entries.
        vfs = VirtualFileSystem object
+       Returns dict of boot_uuid : Timesync
     '''
+    ts_index = { ts.header.boot_uuid : ts for ts in ts_list }
     try:
         entries = vfs.listdir(path)
         for entry in sorted(entries): # sort the files by name, so continuous time will be sequential automatically
@@ -232,9 +245,12 @@ def ReadTimesyncFolder(path, ts_list, vfs):
                 f = vfs.get_virtual_file(file_path, 'TimeSync').open()
                 if f:
                     buffer = f.read() # should be a fairly small file!
-                    ReadTimesyncFile(buffer, ts_list)
+                    ReadTimesyncFile(buffer, ts_list, ts_index)
                     f.close()
             else:
                 logger.error("In Timesync folder, found non-ts file {}".format(entry))
     except Exception:
         logger.exception('')
+    for ts in ts_list:
+        ts.SortItems()
+    return ts_index
@@ -4,6 +4,8 @@
 from __future__ import unicode_literals
 
 import datetime
+import io
+import mmap
 import struct
 
 import plugins.helpers.UnifiedLog.logger as logger
@@ -40,6 +42,38 @@ class BinaryDataFormat(object):
 
         return string
 
+    def _EntriesOverlap(self, sorted_starts, sizes):
+        '''Returns True if any of the ranges (start, size), sorted by start, overlap'''
+        for index in range(1, len(sorted_starts)):
+            if sorted_starts[index] < sorted_starts[index - 1] + sizes[index - 1]:
+                return True
+        return False
+
+    def _MapFileObject(self, file_object):
+        '''Returns a read-only mmap of the file, or None if the file-like object
+           is not a local file (eg: a file read from an image)
+        '''
+        if not isinstance(file_object, (io.BufferedReader, io.FileIO)):
+            return None
+        try:
+            return mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError): # io.UnsupportedOperation is an OSError
+            return None
+
+    def _ReadCStringFromMap(self, mapped_data, offset, max_len):
+        '''Returns a C utf8 string (excluding terminating null) at offset in the
+           mmap, same as _ReadCString() but only the string bytes are copied.
+        '''
+        end = min(len(mapped_data), offset + max_len)
+        null_pos = mapped_data.find(b'\x00', offset, end)
+        if null_pos == -1:
+            return self._ReadCString(mapped_data[offset:end], max_len)
+        try:
+            return mapped_data[offset:null_pos].decode('utf8', 'backslashreplace')
+        except (ValueError, UnicodeDecodeError):
+            logger.exception('Error reading C-String')
+        return ''
+
     def _ReadCStringAndEndPos(self, data, max_len=1024):
         '''Returns a tuple containing a C utf8 string (excluding terminating null)
            and the end position in the data
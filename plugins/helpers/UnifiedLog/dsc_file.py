@@ -3,6 +3,8 @@
 
 from __future__ import unicode_literals
 
+import bisect
+import collections
 import os
 import posixpath
 import struct
@@ -19,6 +21,7 @@ class Dsc(data_format.BinaryDataFormat):
       range_entries (list[tuple[int, int, int, int]]): range entries.
       uuid_entries (list[tuple[int, int, UUID, str, str]]): UUID entries.
     '''
+    fmt_string_memo_max_entries = 4096 # Recently read format strings kept per file
 
     def __init__(self, v_file):
         '''Initializes a shared-Cache strings (dsc) file parser.
@@ -31,6 +34,16 @@ class Dsc(data_format.BinaryDataFormat):
         self._format_version = None
         self.range_entries = []  # [ [uuid_index, v_off, data_offset, data_len], [..], ..] # data_offset is absolute in file
         self.uuid_entries  = []  # [ [v_off,  size,  uuid,  lib_path, lib_name], [..], ..] # v_off is virt offset
+        # Entries sorted by v_off and their start offsets, for bisect lookups
+        self._sorted_range_entries = []
+        self._range_starts = []
+        self._sorted_uuid_entries = []
+        self._uuid_starts = []
+        # If entries overlap, bisect may not find the first matching entry
+        self._ranges_overlap = False
+        self._uuids_overlap = False
+        self._mapped_data = None # mmap of file if it is a local file
+        self._fmt_string_memo = collections.OrderedDict() # v_offset : (fmt_string, range_entry, uuid_entry)
 
     def _ParseFileObject(self, file_object):
         '''Parses a dsc file-like object.
@@ -84,17 +97,33 @@ class Dsc(data_format.BinaryDataFormat):
             lib_name = posixpath.basename(lib_path)
             self.uuid_entries.append([v_off, size, uuid_object, lib_path, lib_name])
 
+        self._BuildIndexes()
+        self._mapped_data = self._MapFileObject(file_object)
         return True
 
+    def _BuildIndexes(self):
+        '''Sorts range and uuid entries by virtual offset for bisect lookups'''
+        self._sorted_range_entries = sorted(self.range_entries, key=lambda a: a[1])
+        self._range_starts = [a[1] for a in self._sorted_range_entries]
+        self._sorted_uuid_entries = sorted(self.uuid_entries, key=lambda b: b[0])
+        self._uuid_starts = [b[0] for b in self._sorted_uuid_entries]
+        self._ranges_overlap = self._EntriesOverlap(self._range_starts, [a[3] for a in self._sorted_range_entries])
+        self._uuids_overlap = self._EntriesOverlap(self._uuid_starts, [b[1] for b in self._sorted_uuid_entries])
+        if self._ranges_overlap or self._uuids_overlap:
+            logger.debug('Overlapping entries in dsc {}, using linear lookups'.format(self._file.filename))
+
     def FindVirtualOffsetEntries(self, v_offset):
         '''Return tuple (range_entry, uuid_entry) where range_entry[xx].size <= v_offset'''
-        ret_range_entry = None
-        ret_uuid_entry = None
-        for a in self.range_entries:
-            if (a[1] <= v_offset) and ((a[1] + a[3]) > v_offset):
-                ret_range_entry = a
-                ret_uuid_entry = self.uuid_entries[a[0]]
-                return (ret_range_entry, ret_uuid_entry)
+        if self._ranges_overlap:
+            for a in self.range_entries:
+                if (a[1] <= v_offset) and ((a[1] + a[3]) > v_offset):
+                    return (a, self.uuid_entries[a[0]])
+        else:
+            index = bisect.bisect_right(self._range_starts, v_offset) - 1
+            if index >= 0:
+                a = self._sorted_range_entries[index]
+                if (a[1] + a[3]) > v_offset:
+                    return (a, self.uuid_entries[a[0]])
         #Not found
         logger.error('Failed to find v_offset in Dsc!')
         return (None, None)
@@ -115,24 +144,43 @@ class Dsc(data_format.BinaryDataFormat):
           KeyError: if no range entry could be found corresponding the offset.
           OSError: if the format string cannot be read.
         '''
+        memo = self._fmt_string_memo
+        result = memo.get(v_offset, None)
+        if result:
+            memo.move_to_end(v_offset)
+            return result
+
         range_entry, uuid_entry = self.FindVirtualOffsetEntries(v_offset)
         if not range_entry:
             raise KeyError('Missing range entry for offset: 0x{0:08x}'.format(
                 v_offset))
 
         rel_offset = v_offset - range_entry[1]
-        file_object = self._file.file_pointer
-        file_object.seek(range_entry[2] + rel_offset)
-        cstring_data = file_object.read(range_entry[3] - rel_offset)
-        cstring = self._ReadCString(cstring_data, range_entry[3] - rel_offset)
-        return cstring, range_entry, uuid_entry
+        if self._mapped_data is not None:
+            cstring = self._ReadCStringFromMap(self._mapped_data, range_entry[2] + rel_offset, range_entry[3] - rel_offset)
+        else:
+            file_object = self._file.file_pointer
+            file_object.seek(range_entry[2] + rel_offset)
+            cstring_data = file_object.read(range_entry[3] - rel_offset)
+            cstring = self._ReadCString(cstring_data, range_entry[3] - rel_offset)
+        result = (cstring, range_entry, uuid_entry)
+        memo[v_offset] = result
+        if len(memo) > self.fmt_string_memo_max_entries:
+            memo.popitem(last=False)
+        return result
 
     def GetUuidEntryFromVirtualOffset(self, v_offset):
         '''Returns uuid_entry where uuid_entry[xx].v_off <= v_offset and falls within allowed size'''
-        for b in self.uuid_entries:
-            if (b[0] <= v_offset) and ((b[0] + b[1]) > v_offset):
-                rel_offset = v_offset - b[0]
-                return b
+        if self._uuids_overlap:
+            for b in self.uuid_entries:
+                if (b[0] <= v_offset) and ((b[0] + b[1]) > v_offset):
+                    return b
+        else:
+            index = bisect.bisect_right(self._uuid_starts, v_offset) - 1
+            if index >= 0:
+                b = self._sorted_uuid_entries[index]
+                if (b[0] + b[1]) > v_offset:
+                    return b
         #Not found
         logger.error('Failed to find uuid_entry for v_offset 0x{:X} in Dsc!'.format(v_offset))
         return None
@@ -174,5 +222,14 @@ class Dsc(data_format.BinaryDataFormat):
 
         if not result:
             self._file.is_valid = False
+        elif self._mapped_data is not None: # Map has its own handle, file not needed
+            self._file.close()
 
         return result
+
+    def Close(self):
+        '''Releases the mmap and closes the file'''
+        if self._mapped_data is not None:
+            self._mapped_data.close()
+            self._mapped_data = None
+        self._file.close()
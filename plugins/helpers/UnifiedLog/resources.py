@@ -3,6 +3,8 @@
 
 from __future__ import unicode_literals
 
+import bisect
+
 import plugins.helpers.UnifiedLog.logger as logger
 
 
@@ -37,6 +39,55 @@ class ChunkMeta(object):
         self.Strings = {} # key = string offset
 
 
+class LogFilter(object):
+    '''Criteria for selecting logs to extract. Times are nanoseconds since 1970
+       (same as log time), None or empty for any field means no filtering on it.
+       Level filtering applies to Debug/Info/Default/Error/Fault logs, other 
+       types (Activity, State, Loss) are not levels and are not filtered by it.
+    '''
+    log_levels = { 'Debug':0, 'Info':1, 'Default':2, 'Error':3, 'Fault':4 }
+
+    def __init__(self, start_time=None, end_time=None, subsystems=None, categories=None, process_names=None, min_log_level=None):
+        super(LogFilter, self).__init__()
+        self.start_time = start_time
+        self.end_time = end_time
+        self.subsystems = set(subsystems) if subsystems else None
+        self.categories = set(categories) if categories else None
+        self.process_names = set(process_names) if process_names else None
+        self.min_level = 0
+        if min_log_level:
+            if min_log_level not in self.log_levels:
+                raise ValueError('Unknown log level {}, must be one of {}'.format(min_log_level, ', '.join(self.log_levels)))
+            self.min_level = self.log_levels[min_log_level]
+
+    def IsTimeRangeIncluded(self, first_time, last_time):
+        '''Returns True if the time range overlaps with the filter's time range'''
+        if self.start_time is not None and last_time < self.start_time:
+            return False
+        if self.end_time is not None and first_time > self.end_time:
+            return False
+        return True
+
+    def IsIncluded(self, time, log_type, p_name):
+        '''Check on fields known early in parsing a log'''
+        if self.start_time is not None and time < self.start_time:
+            return False
+        if self.end_time is not None and time > self.end_time:
+            return False
+        if self.min_level and self.log_levels.get(log_type, self.min_level) < self.min_level:
+            return False
+        if self.process_names is not None and p_name not in self.process_names:
+            return False
+        return True
+
+    def IsSubsystemIncluded(self, sub_sys, cat):
+        if self.subsystems is not None and sub_sys not in self.subsystems:
+            return False
+        if self.categories is not None and cat not in self.categories:
+            return False
+        return True
+
+
 class ExtraFileReference(object):
     '''Extra file reference object. Some ProcInfos have messages in more than one uuidtext file'''
     def __init__(self, data_size, uuid_file_index, u2, v_offset, id):
@@ -82,7 +133,23 @@ class Timesync(object):
         super(Timesync, self).__init__()
         self.header = header
         self.items = []
-        #self.items_dict = {} # unused , use later for optimization
+        self.continuous_times = [] # continuousTime of each item, sorted, for bisect lookups
+
+    def SortItems(self):
+        '''Sorts items by continuousTime and rebuilds the continuous_times list'''
+        self.items.sort(key=lambda item: item.continuousTime)
+        self.continuous_times = [item.continuousTime for item in self.items]
+
+    def FindClosestItem(self, continuousTime):
+        '''Returns the last item with continuousTime <= the one provided (or the
+           first item if there is none), None if there are no items
+        '''
+        if len(self.continuous_times) != len(self.items): # items were added
+            self.SortItems()
+        if not self.items:
+            return None
+        index = bisect.bisect_right(self.continuous_times, continuousTime) - 1
+        return self.items[index if index > 0 else 0]
 
 
 class TimesyncHeader(object):
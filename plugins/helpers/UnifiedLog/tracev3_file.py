@@ -22,8 +22,11 @@ import plugins.helpers.UnifiedLog.uuidtext_file as uuidtext_file
 
 class TraceV3(data_format.BinaryDataFormat):
     '''Tracev3 file parser.'''
+    # Parsed format strings, shared by all TraceV3 objects, key = format string, value = template (see _GetFmtStringTemplate)
+    fmt_string_templates = {}
+    fmt_string_templates_max_entries = 50000 # Cache is cleared when this is exceeded
 
-    def __init__(self, v_fs, v_file, ts_list, uuidtext_folder_path, large_data_cache, cached_files=None):
+    def __init__(self, v_fs, v_file, ts_list, uuidtext_folder_path, large_data_cache, cached_files=None, log_filter=None):
         '''
             Input params:
             v_fs    = VirtualFileSystem object for FS operations (listing dirs, opening files ,..)
@@ -33,6 +36,7 @@ class TraceV3(data_format.BinaryDataFormat):
             large_data_cache = Dictionary to store oversize data, 
                                 key = ( data_ref_id << 64 | contTime ) , value = data 
             cached_files = CachedFiles object for dsc & uuidtext files (can be None)
+            log_filter = LogFilter object, only logs matching it are extracted (can be None)
         '''
         super(TraceV3, self).__init__()
         self._debug_log_count = 0
@@ -52,7 +56,9 @@ class TraceV3(data_format.BinaryDataFormat):
         self.header_unknown8 = 0
         self.header_unknown9 = 0
         self.ts_list = ts_list
+        self.ts_index = { ts.header.boot_uuid : ts for ts in ts_list } # Key = boot_uuid, Val = Timesync
         self.cached_files = cached_files
+        self.log_filter = log_filter
         self.uuidtext_folder_path = uuidtext_folder_path
         self.dsc_folder_path = v_fs.path_join(uuidtext_folder_path, "dsc")
         self.other_uuidtext = {} # cacheing uuidtext files referenced individually
@@ -65,8 +71,10 @@ class TraceV3(data_format.BinaryDataFormat):
         # from header items
         self.system_boot_uuid = None
         self.large_data = large_data_cache # key = ( data_ref_id << 64 | contTime ) , value = data 
-        self.boot_uuid_ts_list = None
+        self.missing_data_refs = [] # keys not found in large_data when referenced
+        self.boot_uuid_ts = None # Timesync for system_boot_uuid
         self.chunk_read_count = 0
+        self.chunks_skipped = 0 # Data chunks outside log_filter's time range
 
     def _DecompressChunkData(self, chunk_data, data_len):
         '''Decompress an individual compressed chunk (tag=0x600D)'''
@@ -93,49 +101,68 @@ class TraceV3(data_format.BinaryDataFormat):
             logger.error('Unknown compression type {}'.format(chunk_data[16:20].hex()))
         return uncompressed
 
-    # TODO: move this into a TimesyncList class.
-    def _GetBootUuidTimeSyncList(self, ts_list, uuid):
+    def _GetUncompressedChunkSize(self, chunk_data, data_len):
+        '''Returns the size of a compressed chunk (tag=0x600D) after decompression,
+           read from its block headers without decompressing
+        '''
+        size = 0
+        comp_start = 0
+        comp_header = chunk_data[0:4]
+        while (data_len > comp_start) and (comp_header != b'bv4$'):
+            if comp_header == b'bv41':
+                uncompressed_size, compressed_size = struct.unpack('<II', chunk_data[comp_start + 4:comp_start + 12])
+                comp_start += 12 + compressed_size
+            elif comp_header == b'bv4-':
+                uncompressed_size = struct.unpack('<I', chunk_data[comp_start + 4:comp_start + 8])[0]
+                comp_start += 8 + uncompressed_size
+            else:
+                logger.error('Unknown compression value {} @ 0x{:X}'.format(comp_header.hex(), comp_start))
+                break
+            size += uncompressed_size
+            comp_header = chunk_data[comp_start:comp_start + 4]
+        return size
+
+    def _IsChunkInTimeRange(self, chunk_meta):
+        '''Returns False if all logs of the data chunk are outside the filter's time range'''
+        first_ts = self.boot_uuid_ts.FindClosestItem(chunk_meta.continuous_time_first)
+        last_ts = self.boot_uuid_ts.FindClosestItem(chunk_meta.continuous_time_last)
+        if first_ts is None or last_ts is None:
+            return True
+        first_time = first_ts.time_stamp + chunk_meta.continuous_time_first - first_ts.continuousTime
+        last_time = last_ts.time_stamp + chunk_meta.continuous_time_last - last_ts.continuousTime
+        return self.log_filter.IsTimeRangeIncluded(first_time, last_time)
+
+    def _GetBootUuidTimeSync(self, uuid):
         '''Retrieves the timesync for a specific boot identifier.
 
         Args:
-            ts_list (list[Timesync]): timesync list.
             uuid (uuid): boot identifier.
 
         Returns:
           Timesync: timesync or None if not available.
         '''
-        for ts in ts_list:
-            if ts.header.boot_uuid == uuid:
-                return ts.items
-        logger.error("Could not find boot uuid {} in Timesync!".format(uuid))
-        return None
+        ts = self.ts_index.get(uuid, None)
+        if ts is None:
+            logger.error("Could not find boot uuid {} in Timesync!".format(uuid))
+        return ts
 
-    # TODO: move this into a TimesyncList class.
-    def _FindClosestTimesyncItem(self, ts_list, uuid, continuousTime):
-        '''Searches ts_list for the boot_id specified by uuid and time'''
-        found_boot_id = False
-        for ts in ts_list:
-            if ts.header.boot_uuid == uuid:
-                found_boot_id = True
-                return self._FindClosestTimesyncItemInList(ts.items, continuousTime)
+    def _GetBootUuidTimeSyncList(self, ts_list, uuid):
+        '''Retrieves the timesync items for a specific boot identifier.
 
-        if not found_boot_id:
-            logger.error("Could not find boot uuid {} in Timesync!".format(uuid))
-        return None
+        Args:
+            ts_list (list[Timesync]): timesync list.
+            uuid (uuid): boot identifier.
 
-    # TODO: move this into a TimesyncList class.
-    def _FindClosestTimesyncItemInList(self, ts_items, continuousTime):
-        '''Returns the closest timesync item from the provided ts_items list'''
-        if not ts_items:
-            return None
+        Returns:
+          list[TimesyncItem]: timesync items or None if not available.
+        '''
+        ts = self._GetBootUuidTimeSync(uuid)
+        return ts.items if ts else None
 
-        closest_tsi = ts_items[0]
-        for item in ts_items:
-            if item.continuousTime > continuousTime:
-                break
-            else: # must be <
-                closest_tsi = item
-        return closest_tsi
+    def _FindClosestTimesyncItem(self, ts_list, uuid, continuousTime):
+        '''Searches ts_list for the boot_id specified by uuid and time'''
+        ts = self._GetBootUuidTimeSync(uuid)
+        return ts.FindClosestItem(continuousTime) if ts else None
 
     def _Read_CLClientManagerStateTrackerState(self, data):
         ''' size=0x8 int, bool '''
@@ -198,8 +225,8 @@ class TraceV3(data_format.BinaryDataFormat):
             elif item_id == 0x6101: pass # machine hostname & model
             elif item_id == 0x6102: # uuid
                 self.system_boot_uuid = UUID(bytes=buffer[pos:pos+16])
-                self.boot_uuid_ts_list = self._GetBootUuidTimeSyncList(self.ts_list, self.system_boot_uuid)
-                if self.boot_uuid_ts_list is None:
+                self.boot_uuid_ts = self._GetBootUuidTimeSync(self.system_boot_uuid)
+                if self.boot_uuid_ts is None:
                     raise ValueError('Could not get Timesync for boot uuid! Cannot parse file..')
             elif item_id == 0x6103: # timezone string
                 pass
@@ -539,20 +566,39 @@ class TraceV3(data_format.BinaryDataFormat):
         #    pass #logger.debug("Extra Data bytes ({}) @ {} ".format(buf_size-pos_debug, pos_debug) + " ## " + binascii.hexlify(buffer[pos_debug:]).decode('ascii').upper())
         return data
 
+    def _GetFmtStringTemplate(self, format_str):
+        '''Returns the parsed form of a format string as a tuple (format_str, hits),
+           format_str has %% replaced with %, hits is a list of tuples
+           (literal_before_hit, hit_end, hit_text, custom_specifier, flags_width_precision, length_modifier, specifier)
+           The regex is only run once per distinct format string, results are cached.
+        '''
+        template = TraceV3.fmt_string_templates.get(format_str, None)
+        if template is None:
+            format_str_for_regex = format_str.replace('%%', '~') # %% is to be considered literal % but will interfere with our regex, so replace it
+            fmt_str = format_str.replace('%%', '%')              # %% replaced with % in original. Since we aren't tokenizing, we use this hack
+            hits = []
+            last_hit_end = 0
+            for hit in self.regex.finditer(format_str_for_regex):
+                hits.append((fmt_str[last_hit_end : hit.start()], hit.end(), hit.group(0), 
+                             hit.group(1), hit.group(2).replace('\'', ''), hit.group(3), hit.group(4)))
+                last_hit_end = hit.end()
+            template = (fmt_str, hits)
+            if len(TraceV3.fmt_string_templates) >= TraceV3.fmt_string_templates_max_entries:
+                TraceV3.fmt_string_templates.clear()
+            TraceV3.fmt_string_templates[format_str] = template
+        return template
+
     def RecreateMsgFromFmtStringAndData(self, format_str, data, log_file_pos):
         msg = ''
-        format_str_for_regex = format_str.replace('%%', '~') # %% is to be considered literal % but will interfere with our regex, so replace it
-        format_str = format_str.replace('%%', '%')           # %% replaced with % in original. Since we aren't tokenizing, we use this hack
+        format_str, hits = self._GetFmtStringTemplate(format_str)
         len_format_str = len(format_str)
         data_count = len(data)
         format_str_consumed = 0 # No. of bytes read
         last_hit_end = 0
         index = 0
-        for hit in self.regex.finditer(format_str_for_regex):
-            #logger.debug('{} {} all={}  {}  {} {} {}'.format(hit.start(), hit.end(), hit.group(0), hit.group(1), hit.group(2), hit.group(3), hit.group(4)))
-            hit_len = hit.end() - hit.start()
-            last_hit_end = hit.end()
-            msg += format_str[format_str_consumed : hit.start()] # slice from end of last hit to begin of new hit
+        for literal, hit_end, hit_text, custom_specifier, flags_width_precision, length_modifier, specifier in hits:
+            last_hit_end = hit_end
+            msg += literal # slice from end of last hit to begin of new hit
             format_str_consumed = last_hit_end
             # Now add data from this hit
             if index >= data_count: # len(data):
@@ -563,10 +609,6 @@ class TraceV3(data_format.BinaryDataFormat):
             # msg += data from this hit
             # data_item = [type, size, raw_data]
             try:
-                custom_specifier = hit.group(1)
-                flags_width_precision = hit.group(2).replace('\'', '')
-                length_modifier = hit.group(3)
-                specifier = hit.group(4)
                 data_type = data_item[0]
                 data_size = data_item[1]
                 raw_data  = data_item[2]
@@ -642,7 +684,7 @@ class TraceV3(data_format.BinaryDataFormat):
                     msg += chars
                 elif specifier == 'P':  # Pointer to data of different types!
                     if not custom_specifier:
-                        msg += hit.group(0)
+                        msg += hit_text
                         logger.info("Unknown data object with no custom specifier in log @ 0x{:X}".format(log_file_pos))
                         index += 1
                         continue
@@ -707,7 +749,7 @@ class TraceV3(data_format.BinaryDataFormat):
                     elif custom_specifier.find('_CLClientManagerStateTrackerState') > 0:
                         msg += self._Read_CLClientManagerStateTrackerState(raw_data)
                     else:
-                        msg += hit.group(0)
+                        msg += hit_text
                         logger.info("Unknown custom data object type '{}' data size=0x{:X} in log @ 0x{:X}".format(custom_specifier, len(raw_data), log_file_pos))
                         pass #TODO
                 elif specifier == 'p':  # Should be 8bytes to be displayed as uint 32/64 in hex lowercase no leading zeroes
@@ -749,7 +791,7 @@ class TraceV3(data_format.BinaryDataFormat):
 
     def DebugPrintTimestampFromContTime(self, ct, msg=''):
         '''Given a continuous time value, print its human readable form'''
-        ts = self._FindClosestTimesyncItemInList(self.boot_uuid_ts_list, ct)
+        ts = self.boot_uuid_ts.FindClosestItem(ct) if self.boot_uuid_ts else None
         time_string = 'N/A'
         if ts is not None:
             time = ts.time_stamp + ct - ts.continuousTime
@@ -762,6 +804,16 @@ class TraceV3(data_format.BinaryDataFormat):
             logger.error('Log data length (0x{:X}) < {} for log @ 0x{:X}!'.format(log_length, bytes_needed, log_abs_offset))
             raise ValueError('Not enough data in log data buffer!')
 
+    def _IsStateLogIncluded(self, ct, log_type, proc_info, catalog):
+        '''Returns True if a State log (which has no subsystem or category) passes log_filter'''
+        try:
+            ts = self.boot_uuid_ts.FindClosestItem(ct)
+            time = ts.time_stamp + ct - ts.continuousTime
+            p_name = catalog.FileObjects[proc_info.uuid_file_index].library_name
+        except (AttributeError, IndexError):
+            return True # Let the log be parsed, errors are logged there
+        return self.log_filter.IsIncluded(time, log_type, p_name) and self.log_filter.IsSubsystemIncluded('', '')
+
     def ProcessDataChunk(self, buffer, catalog, meta_chunk_index, debug_file_pos, logs):
         '''Read chunks with flag 0x600D'''
         global debug_log_count
@@ -800,7 +852,7 @@ class TraceV3(data_format.BinaryDataFormat):
 
                 num_logs_debug = 0
 
-                ts = self._FindClosestTimesyncItemInList(self.boot_uuid_ts_list, continuousTime)
+                ts = self.boot_uuid_ts.FindClosestItem(continuousTime)
                 self.DebugPrintTimestampFromContTime(continuousTime, "Type 6001")
                 
                 logs_end_offset = offset_strings + 16
@@ -810,13 +862,17 @@ class TraceV3(data_format.BinaryDataFormat):
                     start_skew = pos2 % 8
                     u1, u2, fmt_str_v_offset, thread, ct_rel, ct_rel_upper, log_data_len = struct.unpack('<HHIQIHH', buffer[pos + pos2 : pos + pos2 + 24])
                     pos2 += 24
+                    next_log_pos2 = pos2 + log_data_len
+                    #padding
+                    if ((next_log_pos2 - start_skew) % 8) != 0: 
+                        next_log_pos2 += 8 - ((next_log_pos2 - start_skew) % 8)
                     
                     ct = continuousTime + (ct_rel | (ct_rel_upper << 32))
                     # processing
                     log_file_pos = debug_file_pos + pos + pos2 - 24
                     #logger.debug('log_file_pos=0x{:X}'.format(log_file_pos))
 
-                    ts = self._FindClosestTimesyncItemInList(self.boot_uuid_ts_list, ct)
+                    ts = self.boot_uuid_ts.FindClosestItem(ct)
                     time = ts.time_stamp + ct - ts.continuousTime
                     #logger.debug("Type 6001 LOG timestamp={}".format(self._ReadAPFSTime(time)))
                     try: # Big Exception block for any log uncaught exception
@@ -875,6 +931,10 @@ class TraceV3(data_format.BinaryDataFormat):
                         elif u1_upper_byte == 0x11: log_type = 'Fault'
                         elif u1 == 7: log_type = 'Loss' # New
 
+                        if self.log_filter and not self.log_filter.IsIncluded(time, log_type, p_name):
+                            pos2 = next_log_pos2
+                            continue
+
                         if u2 & 0x7000:
                             logger.info('Unknown flag for u2 encountered u2=0x{:4X} @ 0x{:X} ct={}'.format(u2, log_file_pos, ct))
                             #raise ValueError('Unk u2 flag')
@@ -1027,6 +1087,10 @@ class TraceV3(data_format.BinaryDataFormat):
                                 pos3 += 4
                                 log_data_len2 -= 4
 
+                        if self.log_filter and not self.log_filter.IsSubsystemIncluded(sub_sys, cat):
+                            pos2 = next_log_pos2
+                            continue
+
                         # Get format_str and lib now
                         if has_msg_in_uuidtext: # u2 & 0x0002: # msg string in uuidtext file
                             imageOffset = u5
@@ -1097,6 +1161,7 @@ class TraceV3(data_format.BinaryDataFormat):
                                 del self.large_data[unique_ref]
                                 log_data = log_data = self.ReadLogDataBuffer(log_data, len(log_data), '')
                             else:
+                                self.missing_data_refs.append(unique_ref)
                                 logger.error('Data Reference not found for unique_ref=0x{:X} ct={}!'.format(unique_ref, ct))
                                 format_str = "<decode: missing data>"
                                 # TODO - Sometimes this data is in another file, create a mechanism to deal with that
@@ -1120,10 +1185,7 @@ class TraceV3(data_format.BinaryDataFormat):
                     ##
                     debug_log_count += 1
                     
-                    pos2 += log_data_len
-                    #padding
-                    if ((pos2 - start_skew) % 8) != 0: 
-                        pos2 += 8 - ((pos2 - start_skew) % 8)
+                    pos2 = next_log_pos2
                     num_logs_debug += 1
 
                 logger.debug("Parsed {} type 6001 logs".format(num_logs_debug))
@@ -1144,7 +1206,7 @@ class TraceV3(data_format.BinaryDataFormat):
                 
                 pos2 += data_len
                 ## Debug print
-                ts = self._FindClosestTimesyncItemInList(self.boot_uuid_ts_list, ct)
+                ts = self.boot_uuid_ts.FindClosestItem(ct)
                 time = ts.time_stamp + ct - ts.continuousTime
                 logger.debug("Type 6002 timestamp={} ({}), data_ref_id=0x{:X} @ 0x{:X}".format(self._ReadAPFSTime(time), ct, data_ref_id, log_file_pos))
                 pos += data_size
@@ -1155,6 +1217,12 @@ class TraceV3(data_format.BinaryDataFormat):
                 log_type = 'State'
                 ct, activity_id, un7 = struct.unpack("<QII", buffer[pos + pos2 : pos + pos2 + 16])
                 pos2 += 16
+                if self.log_filter and not self._IsStateLogIncluded(ct, log_type, proc_info, catalog):
+                    pos += data_size
+                    if (pos - start_skew) % 8:
+                        pad_len = 8 - ((pos - start_skew) % 8)
+                        pos += pad_len
+                    continue
                 uuid = UUID(bytes = buffer[pos + pos2 : pos + pos2 + 16])
                 pos2 += 16
                 data_type, data_len = struct.unpack('<II', buffer[pos + pos2 : pos + pos2 + 8])
@@ -1203,7 +1271,7 @@ class TraceV3(data_format.BinaryDataFormat):
                     imageUUID = uuid
                     processImageUUID = ut_cache.Uuid
 
-                    ts = self._FindClosestTimesyncItemInList(self.boot_uuid_ts_list, ct)
+                    ts = self.boot_uuid_ts.FindClosestItem(ct)
                     time = ts.time_stamp + ct - ts.continuousTime
                     #logger.debug("Type 6003 timestamp={}".format(self._ReadAPFSTime(time)))
 
@@ -1291,10 +1359,17 @@ class TraceV3(data_format.BinaryDataFormat):
                     catalog = self.ProcessMetaChunk(buffer)
                     uncompressed_file_pos += 16 + data_length
                 elif tag == 0x600D:
-                    uncompressed_buffer = self._DecompressChunkData(buffer, len(buffer))
-                    self.ProcessDataChunk(uncompressed_buffer, catalog, meta_chunk_index, uncompressed_file_pos + 16, logs)
-                    meta_chunk_index += 1
-                    uncompressed_file_pos += 16 + len(uncompressed_buffer)
+                    if self.log_filter and catalog and meta_chunk_index < len(catalog.ChunkMetaInfo) and \
+                        not self._IsChunkInTimeRange(catalog.ChunkMetaInfo[meta_chunk_index]):
+                        logger.debug('Skipping chunk @ 0x{:X} as it is outside the time range'.format(pos))
+                        meta_chunk_index += 1
+                        uncompressed_file_pos += 16 + self._GetUncompressedChunkSize(buffer, len(buffer))
+                        self.chunks_skipped += 1
+                    else:
+                        uncompressed_buffer = self._DecompressChunkData(buffer, len(buffer))
+                        self.ProcessDataChunk(uncompressed_buffer, catalog, meta_chunk_index, uncompressed_file_pos + 16, logs)
+                        meta_chunk_index += 1
+                        uncompressed_file_pos += 16 + len(uncompressed_buffer)
                 else:
                     logger.info("Unknown header for chunk - 0x{:X} , skipping chunk @ 0x{:X}!".format(tag, pos))
                     uncompressed_file_pos += 16 + data_length
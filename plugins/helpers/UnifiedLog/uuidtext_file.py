@@ -3,6 +3,8 @@
 
 from __future__ import unicode_literals
 
+import bisect
+import collections
 import struct
 import os
 import posixpath
@@ -13,6 +15,7 @@ import plugins.helpers.UnifiedLog.logger as logger
 
 class Uuidtext(data_format.BinaryDataFormat):
     '''Uuidtext file parser.'''
+    fmt_string_memo_max_entries = 1024 # Recently read format strings kept per file
 
     def __init__(self, v_file, uuid):
         '''Initializes an uuidtext file parser.
@@ -23,6 +26,11 @@ class Uuidtext(data_format.BinaryDataFormat):
         '''
         super(Uuidtext, self).__init__()
         self._entries = []   # [ [range_start_offset, data_offset, data_len], [..] , ..]
+        self._sorted_entries = [] # _entries sorted by range_start_offset
+        self._entry_starts = []   # range_start_offset of _sorted_entries, for bisect lookups
+        self._entries_overlap = False # If True, bisect may not find the first matching entry
+        self._mapped_data = None  # mmap of file if it is a local file
+        self._fmt_string_memo = collections.OrderedDict() # v_offset : fmt_string
         self._file = v_file
         self.library_path = ''
         self.library_name = ''
@@ -75,8 +83,28 @@ class Uuidtext(data_format.BinaryDataFormat):
         self.library_path = self._ReadCString(library_path_data)
         self.library_name = posixpath.basename(self.library_path)
 
+        self._sorted_entries = sorted(self._entries)
+        self._entry_starts = [entry[0] for entry in self._sorted_entries]
+        self._entries_overlap = self._EntriesOverlap(self._entry_starts, [entry[2] for entry in self._sorted_entries])
+        self._mapped_data = self._MapFileObject(file_object)
         return True
 
+    def _FindEntry(self, v_offset):
+        '''Returns the first entry (range_start_offset, data_offset, data_len)
+           whose range contains v_offset, or None
+        '''
+        if self._entries_overlap:
+            for entry in self._entries:
+                if entry[0] <= v_offset < entry[0] + entry[2]:
+                    return entry
+            return None
+        index = bisect.bisect_right(self._entry_starts, v_offset) - 1
+        if index >= 0:
+            entry = self._sorted_entries[index]
+            if v_offset < entry[0] + entry[2]:
+                return entry
+        return None
+
     def ReadFmtStringFromVirtualOffset(self, v_offset):
         '''Reads a format string for a specific virtual offset.
 
@@ -96,15 +124,28 @@ class Uuidtext(data_format.BinaryDataFormat):
         if v_offset & 0x80000000:
             return '%s'
 
-        for range_start_offset, data_offset, data_len in self._entries:
-            range_end_offset = range_start_offset + data_len
-            if range_start_offset <= v_offset < range_end_offset:
-                rel_offset = v_offset - range_start_offset
+        memo = self._fmt_string_memo
+        format_string = memo.get(v_offset, None)
+        if format_string is not None:
+            memo.move_to_end(v_offset)
+            return format_string
 
+        entry = self._FindEntry(v_offset)
+        if entry:
+            range_start_offset, data_offset, data_len = entry
+            rel_offset = v_offset - range_start_offset
+
+            if self._mapped_data is not None:
+                format_string = self._ReadCStringFromMap(self._mapped_data, data_offset + rel_offset, data_len - rel_offset)
+            else:
                 file_object = self._file.file_pointer
                 file_object.seek(data_offset + rel_offset)
                 format_string_data = file_object.read(data_len - rel_offset)
-                return self._ReadCString(format_string_data, data_len - rel_offset)
+                format_string = self._ReadCString(format_string_data, data_len - rel_offset)
+            memo[v_offset] = format_string
+            if len(memo) > self.fmt_string_memo_max_entries:
+                memo.popitem(last=False)
+            return format_string
 
         # This is the value returned by the MacOS 'log' program if the uuidtext
         # entry is not found.
@@ -133,5 +174,14 @@ class Uuidtext(data_format.BinaryDataFormat):
 
         if not result:
             self._file.is_valid = False
+        elif self._mapped_data is not None: # Map has its own handle, file not needed
+            self._file.close()
 
         return result
+
+    def Close(self):
+        '''Releases the mmap and closes the file'''
+        if self._mapped_data is not None:
+            self._mapped_data.close()
+            self._mapped_data = None
+        self._file.close()
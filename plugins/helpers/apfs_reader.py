@@ -7,9 +7,14 @@
 
 '''
 
+import array
 import collections
+import hashlib
 import logging
+import multiprocessing
+import operator
 import struct
+import time
 import zlib
 from uuid import UUID
 
@@ -17,6 +22,7 @@ import anytree
 import liblzfse
 import plugins.helpers.apfs as apfs
 from anytree import Node, RenderTree
+from Crypto.Util.strxor import strxor
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from kaitaistruct import BytesIO, KaitaiStream
@@ -63,9 +69,10 @@ class ApfsDbInfo:
     image's volumes.
     '''
 
+    version = 8 # This will change if db structure changes in future
+
     def __init__(self, db_writer):
         self.db_writer = db_writer # SqliteWriter object
-        self.version = 7 # This will change if db structure changes in future
         self.ver_table_name = 'Version_Info'
         self.vol_table_name = 'Volumes_Info'
         self.version_info = collections.OrderedDict([('Version',DataType.INTEGER)])
@@ -75,6 +82,17 @@ class ApfsDbInfo:
                                                     ('Created',DataType.INTEGER),('Updated',DataType.INTEGER),
                                                     ('Role',DataType.INTEGER),('VEK',DataType.BLOB)])
 
+    @staticmethod
+    def GetCacheFileName(container_uuid, volumes):
+        '''Returns file name for the db in a cache folder. The name is unique to
+           the container UUID and the current state (xid, counts) of its volumes.
+        '''
+        state = [str(ApfsDbInfo.version)]
+        for vol in volumes:
+            state.append('{}|{}|{}|{}|{}|{}'.format(vol.uuid, vol.xid, vol.num_files, vol.num_folders, vol.num_snapshots, vol.role))
+        digest = hashlib.sha1(';'.join(state).encode('utf8')).hexdigest()[:16]
+        return 'APFS_Volumes_{}_{}.db'.format(str(container_uuid).upper(), digest)
+
     def WriteVersionInfo(self):
         self.db_writer.CreateTable(self.version_info, self.ver_table_name)
         data = [self.version]
@@ -138,12 +156,23 @@ class ApfsFileSystemParser:
     '''
     Reads and parses the file system, writes output to a database.
     '''
-    def __init__(self, apfs_volume, db_writer):
+    table_types = ('Hardlinks', 'Extents', 'Attributes', 'Inodes', 'DirEntries', 'DirStats', 'Compressed_Files', 'Paths')
+    leaf_blocks_per_task = 256 # For parallel reading of leaf blocks
+    paths_build_methods = ('memory', 'cte', 'compare')
+
+    def __init__(self, apfs_volume, db_writer, num_workers=1, image_opener=None, paths_build_method='memory'):
         self.name = apfs_volume.name
         self.volume = apfs_volume
         self.container = apfs_volume.container
         self.dbo = db_writer
         self.encryption_key = apfs_volume.encryption_key
+        # For decoding leaf blocks in parallel, image_opener is a function that returns a new image object
+        self.num_workers = num_workers
+        self.image_opener = image_opener
+        # How the Paths table is built, 'memory' = resolve paths in python (faster), 
+        #  'cte' = recursive sql query, 'compare' = run both and log timings
+        self.paths_build_method = paths_build_method
+        self.indexes_needed = True # False when writing to a staging db, whose tables are copied to the main db
 
         self.num_records_read_total = 0
         self.num_records_read_batch = 0
@@ -301,6 +330,11 @@ class ApfsFileSystemParser:
         self.dbo.CreateTable(self.compressed_info, self.name + '_Compressed_Files')
         self.dbo.CreateTable(self.paths_info, self.name + '_Paths')
 
+    def drop_tables(self):
+        for table_type in self.table_types:
+            table_name = '{}_{}'.format(self.name, table_type)
+            self.run_query('DROP TABLE IF EXISTS "{}"'.format(table_name), True)
+
     def clear_records(self):
         self.hardlink_records = []
         self.extent_records = []
@@ -314,15 +348,23 @@ class ApfsFileSystemParser:
         index_queries = ["CREATE INDEX \"{0}_attribute_cnid\" ON \"{0}_Attributes\" (CNID)".format(self.name),
                          "CREATE INDEX \"{0}_extent_cnid\" ON \"{0}_Extents\" (CNID)".format(self.name),
                          "CREATE INDEX \"{0}_index_cnid\" ON \"{0}_DirEntries\" (CNID)".format(self.name),
+                         "CREATE INDEX \"{0}_index_parent_cnid\" ON \"{0}_DirEntries\" (Parent_CNID, CNID)".format(self.name), # For ListItemsInFolder()
                          "CREATE INDEX \"{0}_paths_path_cnid\" ON \"{0}_Paths\" (Path, CNID)".format(self.name),
+                         "CREATE INDEX \"{0}_paths_cnid\" ON \"{0}_Paths\" (CNID)".format(self.name),
                          "CREATE INDEX \"{0}_inodes_cnid_parent_cnid\" ON \"{0}_Inodes\" (CNID, Parent_CNID)".format(self.name),
                          "CREATE INDEX \"{0}_compressed_files_cnid\" ON \"{0}_Compressed_Files\" (CNID)".format(self.name),
                          "CREATE INDEX \"{0}_dir_stats_cnid\" ON \"{0}_DirStats\" (CNID)".format(self.name)]
+        if not self.indexes_needed:
+            return
+        if self.dbo.bulk_insert_mode: # Commit this volume's rows, indexes are needed by later steps (linked volume)
+            self.dbo.Commit()
         for query in index_queries:
             success, cursor, error = self.dbo.RunQuery(query, writing=True)
             if not success:
                 log.error('Error creating index: ' + error)
                 break
+        if self.dbo.bulk_insert_mode:
+            self.dbo.Commit()
     
     def run_query(self, query, writing=True, table_name='', print_rowcount=False):
         '''Returns True/False on query execution'''
@@ -444,9 +486,35 @@ class ApfsFileSystemParser:
             self.clear_records() # Clear the data once written
 
         self.create_other_tables_and_indexes()
+        self.dbo.Commit() # In bulk insert mode, this ends the transaction for this volume
         self.PrintStats()
 
+    def merge_volume_records(self, staging_db_path):
+        ''' Copy all tables of this volume from a staging db (populated by
+            read_volume_records() in a worker process) into this db,
+            then create indexes. Returns True/False.
+        '''
+        self.create_tables()
+        if self.encryption_key: # Worker did this on its own copy of the volume
+            self.volume.SetupDecryption(self.encryption_key)
+        self.dbo.Commit() # Cannot attach within a transaction
+        attach_query = "ATTACH DATABASE '{}' AS staging".format(staging_db_path.replace("'", "''"))
+        if not self.run_query(attach_query, False): return False
+        success = True
+        for table_type in self.table_types:
+            table_name = '{}_{}'.format(self.name, table_type)
+            query = 'INSERT INTO main."{0}" SELECT * FROM staging."{0}"'.format(table_name)
+            if not self.run_query(query, True, table_name):
+                success = False
+                break
+        self.dbo.Commit()
+        self.run_query('DETACH DATABASE staging', False)
+        if success:
+            self.create_indexes()
+        return success
+
     def read_inode_volume_blocks(self, inode_tree, noheader):
+        leaf_blocks = [] # [ (block_number, oid, xid), .. ]
         processed_blocks = set()
         for node in anytree.PreOrderIter(inode_tree, filter_=lambda n: n.is_leaf==True):  
             block_number = node.block_number
@@ -456,11 +524,54 @@ class ApfsFileSystemParser:
                     continue
                 else:
                     processed_blocks.add(block_number)
-                block = self.volume.read_vol_block(block_number, self.encryption_key, noheader=noheader)
-                self.read_entries_for_block(block_number, block, noheader, node.name, node.xid)
+                leaf_blocks.append((block_number, node.name, node.xid))
             else:
                 log.error('Block number was 0 (invalid), cannot read!')
 
+        if self.num_workers > 1 and self.image_opener and len(leaf_blocks) > self.leaf_blocks_per_task:
+            if self.read_leaf_blocks_in_parallel(leaf_blocks, noheader):
+                return
+        for block_number, oid, xid in leaf_blocks:
+            block = self.volume.read_vol_block(block_number, self.encryption_key, noheader=noheader)
+            self.read_entries_for_block(block_number, block, noheader, oid, xid)
+            self.write_records_if_batch_full()
+
+    def read_leaf_blocks_in_parallel(self, leaf_blocks, noheader):
+        '''Decrypt and decode leaf blocks in worker processes, records are
+           returned in block order and written here, so the db is identical 
+           to that from a serial read. Returns False if workers could not be
+           started (nothing is read then).
+        '''
+        global _leaf_parser, _leaf_noheader
+        try:
+            # Workers inherit this parser & volume objects, so fork is needed
+            mp_context = multiprocessing.get_context('fork')
+        except ValueError:
+            log.info('Parallel decoding of leaf blocks is not supported on this platform')
+            return False
+        tasks = [leaf_blocks[i:i + self.leaf_blocks_per_task] for i in range(0, len(leaf_blocks), self.leaf_blocks_per_task)]
+        log.debug(f'Decoding {len(leaf_blocks)} leaf blocks of {self.name} using {self.num_workers} worker processes')
+        _leaf_parser = self
+        _leaf_noheader = noheader
+        try:
+            with mp_context.Pool(self.num_workers) as pool:
+                for records, debug_stats in pool.imap(_ReadLeafBlocksWorker, tasks):
+                    self.hardlink_records.extend(records[0])
+                    self.extent_records.extend(records[1])
+                    self.inode_records.extend(records[2])
+                    self.dir_records.extend(records[3])
+                    self.attr_records.extend(records[4])
+                    self.dir_stats_records.extend(records[5])
+                    num_records = sum(len(x) for x in records)
+                    self.num_records_read_batch += num_records
+                    self.num_records_read_total += num_records
+                    for entry_type, item_count in debug_stats.items():
+                        self.debug_stats[entry_type] = self.debug_stats.get(entry_type, 0) + item_count
+                    self.write_records_if_batch_full()
+        finally:
+            _leaf_parser = None
+        return True
+
     def create_obj_id_tree(self, my_root):
         p_root = Node('x')
         self.RecurseAddNodes(my_root, p_root, self.volume.root_tree_oid)
@@ -585,8 +696,90 @@ class ApfsFileSystemParser:
         '''Populate paths table in db, create compressed_files table and create indexes for faster queries'''
 
         self.populate_compressed_files_table()
-        
-        insert_query = "INSERT INTO \"{0}_Paths\" SELECT * FROM " \
+
+        paths_built = False
+        if self.paths_build_method in ('memory', 'compare'):
+            time_started = time.time()
+            try:
+                paths_built = self.populate_paths_table()
+            except (MemoryError, sqlite3.Error):
+                log.exception('Failed to build paths in memory, will use sql query instead')
+                self.run_query("DELETE FROM \"{}_Paths\"".format(self.name), True, self.name + '_Paths')
+            if paths_built:
+                log.info('{} Paths table built in memory in {:.2f} seconds'.format(self.name, time.time() - time_started))
+        if not paths_built:
+            time_started = time.time()
+            self.populate_paths_table_using_cte(self.name + '_Paths')
+            log.info('{} Paths table built using recursive query in {:.2f} seconds'.format(self.name, time.time() - time_started))
+        self.run_query("UPDATE \"{}_Paths\" SET path = '/' where cnid = 2;".format(self.name), True)
+        if paths_built and self.paths_build_method == 'compare':
+            time_started = time.time()
+            self.populate_paths_table_using_cte(self.name + '_Paths_CTE')
+            log.info('{} Paths table built using recursive query in {:.2f} seconds'.format(self.name, time.time() - time_started))
+            self.compare_paths_tables(self.name + '_Paths_CTE')
+
+        self.create_indexes()
+
+    def populate_paths_table(self):
+        '''Resolve full paths of all dir entries in memory and write them to
+           the Paths table, sorted by path (same as the recursive query). Each
+           folder's path is resolved only once. Returns True/False
+        '''
+        query = "SELECT Parent_CNID, CNID, Name FROM \"{}_DirEntries\"".format(self.name)
+        success, cursor, error = self.dbo.RunQuery(query, writing=False)
+        if not success:
+            log.error('Error executing query : Query was {}, Error was {}'.format(query, error))
+            return False
+        rows = cursor.fetchall()
+        parent_cnids = array.array('Q', [row[0] for row in rows])
+        cnids = array.array('Q', [row[1] for row in rows])
+        names = [row[2] for row in rows]
+        del rows
+        entry_index_by_cnid = {} # Only needed for folders, these have a single entry
+        for index, cnid in enumerate(cnids):
+            if cnid not in entry_index_by_cnid:
+                entry_index_by_cnid[cnid] = index
+
+        folder_paths = { 2: '' } # cnid : path , None if not reachable from root
+        def resolve_folder(cnid):
+            chain = [] # folders whose path is not yet known, child first
+            in_chain = set()
+            path = None
+            while True:
+                if cnid in folder_paths:
+                    path = folder_paths[cnid]
+                    break
+                index = entry_index_by_cnid.get(cnid, None)
+                if index is None: # orphan, not under root
+                    folder_paths[cnid] = None
+                    break
+                if cnid in in_chain:
+                    log.error('Loop detected in folder hierarchy at cnid={} in {}'.format(cnid, self.name))
+                    break
+                chain.append(index)
+                in_chain.add(cnid)
+                cnid = parent_cnids[index]
+            for index in reversed(chain):
+                if path is not None:
+                    path = path + '/' + names[index]
+                folder_paths[cnids[index]] = path
+            return path
+
+        paths = [(2, '')]
+        for parent_cnid, cnid, name in zip(parent_cnids, cnids, names):
+            parent_path = folder_paths[parent_cnid] if parent_cnid in folder_paths else resolve_folder(parent_cnid)
+            if parent_path is not None:
+                paths.append((cnid, parent_path + '/' + name))
+        del parent_cnids, cnids, names, entry_index_by_cnid, folder_paths
+        paths.sort(key=operator.itemgetter(1))
+        self.dbo.WriteRows(paths, self.name + '_Paths')
+        return True
+
+    def populate_paths_table_using_cte(self, table_name):
+        '''Populate paths table using a recursive sql query, table is created if it does not exist'''
+        if table_name != self.name + '_Paths':
+            self.run_query("CREATE TABLE IF NOT EXISTS \"{}\" (CNID INTEGER, Path TEXT)".format(table_name), True)
+        insert_query = "INSERT INTO \"{1}\" SELECT * FROM " \
                         "( WITH RECURSIVE " \
                         "  under_root(path,name,cnid) AS " \
                         "  (  VALUES('','root',2) " \
@@ -598,11 +791,21 @@ class ApfsFileSystemParser:
                         "   ORDER BY 1 " \
                         ") SELECT CNID, Path FROM under_root);"
                         
-        query = insert_query.format(self.name)
-        self.run_query(query, True)
-        self.run_query("UPDATE \"{}_Paths\" SET path = '/' where cnid = 2;".format(self.name), True)
-
-        self.create_indexes()
+        query = insert_query.format(self.name, table_name)
+        return self.run_query(query, True)
+
+    def compare_paths_tables(self, cte_table_name):
+        '''Log differences between Paths table and the one built by the recursive query, then drop the latter'''
+        self.run_query("UPDATE \"{}\" SET path = '/' where cnid = 2;".format(cte_table_name), True)
+        query = "SELECT COUNT(*) FROM (SELECT CNID, Path FROM \"{0}_Paths\" EXCEPT SELECT CNID, Path FROM \"{1}\") "\
+                " UNION ALL SELECT COUNT(*) FROM (SELECT CNID, Path FROM \"{1}\" EXCEPT SELECT CNID, Path FROM \"{0}_Paths\")".format(self.name, cte_table_name)
+        success, cursor, error = self.dbo.RunQuery(query, writing=False)
+        if success:
+            only_in_memory, only_in_cte = [row[0] for row in cursor]
+            log.info('{} Paths comparison: {} paths only in memory built table, {} paths only in recursive query table'.format(self.name, only_in_memory, only_in_cte))
+        else:
+            log.error('Error comparing paths tables: ' + error)
+        self.run_query("DROP TABLE \"{}\"".format(cte_table_name), True)
 
     def read_entries_for_block(self, block_num, block, no_blk_hdr_force_subtype_fs_tree=False, sealed_oid=0, sealed_xid=0):
         '''Read file system entries(inodes) from leaf nodes ONLY and add to database. Only pass leaf nodes here'''
@@ -681,6 +884,7 @@ class ApfsFileSystemParser:
         else:
             log.warning("unexpected entry type=0x{:X} subtype={} in block {}".format(block.header.type_block.value, repr(block.header.subtype), block_num))
 
+    def write_records_if_batch_full(self):
         if self.num_records_read_batch > 400000:
             self.num_records_read_batch = 0
             # write to db / file
@@ -823,50 +1027,241 @@ class ApfsFileSystemParser:
         debug_parent_list.pop()
         return
 
+# Used by ApfsFileSystemParser.read_leaf_blocks_in_parallel(), inherited by forked workers
+_leaf_parser = None
+_leaf_noheader = False
+_leaf_worker_image = None
+
+def _ReadLeafBlocksWorker(leaf_blocks):
+    '''Worker process function, reads, decrypts and decodes leaf blocks.
+       Returns tuple (records, debug_stats), where records is a tuple of 
+       record lists in order (hardlinks, extents, inodes, dir, attr, dir_stats)
+    '''
+    global _leaf_worker_image
+    parser = _leaf_parser
+    if _leaf_worker_image is None: # Image must be re-opened, file offsets cannot be shared with parent
+        _leaf_worker_image = parser.image_opener()
+        parser.container.img = _leaf_worker_image
+    parser.clear_records()
+    parser.debug_stats = {}
+    for block_number, oid, xid in leaf_blocks:
+        block = parser.volume.read_vol_block(block_number, parser.encryption_key, noheader=_leaf_noheader)
+        parser.read_entries_for_block(block_number, block, _leaf_noheader, oid, xid)
+    records = (parser.hardlink_records, parser.extent_records, parser.inode_records,
+               parser.dir_records, parser.attr_records, parser.dir_stats_records)
+    return records, parser.debug_stats
+
 class DataCache:
-    '''Cache of ApfsFileMeta objects'''
-    def __init__(self, max_size=2000):
-        self.cache_limit = max_size
-        self.cache = {} # key=path, value=(ApfsFileMeta object, index)
-        self.cache_index = {} # key=index, value=path
-        self.index = 0
-        self.count = 0
-        #self.cnid_cache = {} # key=cnid, value=index
+    '''LRU cache of ApfsFileMeta objects, looked up by path or CNID. It is limited by 
+       number of entries and by an estimate of the bytes they use (mostly xattr data)
+    '''
+    def __init__(self, max_entries=20000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.cache = collections.OrderedDict() # key=path, value=(ApfsFileMeta object, size)
+        self.cnid_index = {} # key=cnid, value=path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def EstimateSize(apfs_file_meta):
+        '''Approximate memory used by object, extent based xattr data read later is not counted'''
+        size = 600 + len(apfs_file_meta.path) + 80 * len(apfs_file_meta.extents)
+        if apfs_file_meta.decmpfs:
+            size += len(apfs_file_meta.decmpfs)
+        for att in apfs_file_meta.attributes.values():
+            size += 200 + (len(att._data) if att._data else 0) + 80 * len(att.extents)
+        return size
+
+    @staticmethod
+    def IsHardLink(apfs_file_meta):
+        '''Returns True if a file has more than one path. For folders, links is the number of children'''
+        return apfs_file_meta.item_type != 4 and (apfs_file_meta.links or 0) > 1
 
     def Insert(self, apfs_file_meta, path):
-        if self.Find(path):
-            log.debug('Obj already cached for path {}'.format(path))
+        if path in self.cache:
+            self.cache.move_to_end(path)
             return
-        self.index += 1
-        self.cache[path] = (apfs_file_meta, self.index)
-        self.cache_index[self.index] = path
-        #self.cnid_cache[apfs_file_meta.cnid] = self.index
-        #self.count += 1
-        if self.count >= self.cache_limit: # should not got to >
-            # remove oldest element
-            oldest_id = self.index - self.cache_limit
-            oldest_path = self.cache_index[oldest_id]
-            #oldest_cnid = self.cache[oldest_path][0].cnid
-            del(self.cache_index[oldest_id])
-            del(self.cache[oldest_path])
-            #del(self.cache_index[oldest_path])
-        else:
-            self.count += 1
-    
+        size = self.EstimateSize(apfs_file_meta)
+        self.cache[path] = (apfs_file_meta, size)
+        if not self.IsHardLink(apfs_file_meta): # Hard links have many paths, which one is cached would depend on cache history
+            self.cnid_index[apfs_file_meta.cnid] = path
+        self.size += size
+        while (len(self.cache) > self.max_entries or self.size > self.max_bytes) and len(self.cache) > 1:
+            evicted_path, (evicted_meta, evicted_size) = self.cache.popitem(last=False)
+            if self.cnid_index.get(evicted_meta.cnid, None) == evicted_path:
+                del self.cnid_index[evicted_meta.cnid]
+            self.size -= evicted_size
+            self.evictions += 1
+
     def Find(self, path):
-        if path.endswith('/'):
-            if path != '/':
-                path = path.rstrip('/')
         cached_obj = self.cache.get(path, None)
-        if cached_obj:
-            return cached_obj[0]
-        return None
+        if cached_obj is None and path.endswith('/') and path != '/':
+            path = path.rstrip('/')
+            cached_obj = self.cache.get(path, None)
+        if cached_obj is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(path)
+        return cached_obj[0]
+
+    def FindByCnid(self, cnid):
+        path = self.cnid_index.get(cnid, None)
+        if path is None:
+            self.misses += 1
+            return None
+        return self.Find(path)
+
+    def Clear(self):
+        self.cache.clear()
+        self.cnid_index.clear()
+        self.size = 0
+
+    def GetStats(self):
+        total = self.hits + self.misses
+        hit_rate = (100.0 * self.hits / total) if total else 0.0
+        return f'hits={self.hits} misses={self.misses} ({hit_rate:.1f}% hits) evictions={self.evictions} cached={len(self.cache)} items (~{self.size} bytes)'
+
+class BlockCache:
+    '''LRU cache of block data, limited by total size (bytes) of data cached'''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.cache = collections.OrderedDict() # key=block_num, value=data
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def Get(self, block_num):
+        data = self.cache.get(block_num, None)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(block_num)
+        return data
 
-    # def FindFileId(self, id):
-    #     cached_path = self.cache_index.get(id, None)
-    #     if cached_path:
-    #         return self.cache[path][0]
-    #     return None  
+    def Insert(self, block_num, data):
+        if len(data) > self.max_bytes:
+            return
+        old_data = self.cache.pop(block_num, None)
+        if old_data is not None:
+            self.size -= len(old_data)
+        self.cache[block_num] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted_data = self.cache.popitem(last=False)
+            self.size -= len(evicted_data)
+            self.evictions += 1
+
+    def Clear(self):
+        self.cache.clear()
+        self.size = 0
+
+    def GetStats(self):
+        total = self.hits + self.misses
+        hit_rate = (100.0 * self.hits / total) if total else 0.0
+        return f'hits={self.hits} misses={self.misses} ({hit_rate:.1f}% hits) evictions={self.evictions} cached={len(self.cache)} blocks ({self.size} bytes)'
+
+class XtsDecryptor:
+    '''AES-XTS decryption with 512 byte data units (sectors), as used by APFS.
+       Instead of creating an XTS cipher per sector, the tweaks of all sectors
+       in a block (or run of blocks) are encrypted with one AES-ECB call, then
+       multiplied by alpha for every 16 byte AES block of the sector, with all
+       sectors processed together as one python int. Data is xor'ed with the
+       tweaks and decrypted with one more AES-ECB call into a reusable buffer.
+    '''
+    sector_size = 0x200
+    blocks_per_sector = sector_size // 16 # AES blocks per sector
+
+    def __init__(self, key):
+        half = len(key) // 2
+        self.data_cipher = Cipher(algorithms.AES(key[:half]), modes.ECB(), backend=default_backend())
+        self.tweak_cipher = Cipher(algorithms.AES(key[half:]), modes.ECB(), backend=default_backend())
+        self.buffer = bytearray() # decrypted data is written here, reused across calls
+        self.layouts = {} # key=num_sectors, value=(tweak_steps, unpacker, reorder)
+
+    def _GetLayout(self, num_sectors):
+        '''Returns masks for expanding num_sectors tweaks to all AES blocks, and 
+           the objects used to reorder the expanded tweaks by sector.
+        '''
+        layout = self.layouts.get(num_sectors, None)
+        if layout is None:
+            # Each step appends tweak*alpha^k for all tweaks computed so far, doubling
+            # their number, so tweaks are ordered by AES block index, then by sector.
+            tweak_steps = []
+            num_tweaks = num_sectors
+            k = 1
+            while k < self.blocks_per_sector:
+                low_bits_mask = int.from_bytes(((1 << (128 - k)) - 1).to_bytes(16, 'little') * num_tweaks, 'little')
+                high_bits_mask = int.from_bytes(((1 << k) - 1).to_bytes(16, 'little') * num_tweaks, 'little')
+                tweak_steps.append((k, low_bits_mask, high_bits_mask, 128 * num_tweaks))
+                num_tweaks *= 2
+                k *= 2
+            if num_sectors <= 32:
+                unpacker = struct.Struct('16s' * (num_sectors * self.blocks_per_sector))
+                reorder = operator.itemgetter(*[j * num_sectors + s for s in range(num_sectors) for j in range(self.blocks_per_sector)])
+            else: # too many objects, _ReorderTweaks() copies with slices instead
+                unpacker = reorder = None
+            layout = (tweak_steps, unpacker, reorder)
+            if len(self.layouts) >= 16:
+                self.layouts.clear()
+            self.layouts[num_sectors] = layout
+        return layout
+
+    def _ReorderTweaks(self, tweaks, num_sectors):
+        '''Reorders tweaks from (AES block index, sector) order to (sector, AES block index)'''
+        reordered = bytearray(len(tweaks))
+        src = memoryview(tweaks).cast('Q')
+        dest = memoryview(reordered).cast('Q')
+        qwords_per_sector = self.sector_size // 8
+        qwords_per_index = 2 * num_sectors
+        for j in range(self.blocks_per_sector):
+            start = j * qwords_per_index
+            dest[2 * j     :: qwords_per_sector] = src[start     : start + qwords_per_index : 2]
+            dest[2 * j + 1 :: qwords_per_sector] = src[start + 1 : start + qwords_per_index : 2]
+        return reordered
+
+    def Decrypt(self, data, sector_num, size=-1):
+        '''Decrypts data, whose first sector is sector_num. If size is
+           specified, only that many bytes are decrypted and returned.
+        '''
+        if size == -1 or size > len(data):
+            size = len(data)
+        requested_size = size
+        size = min(len(data), (size + 15) // 16 * 16) # whole AES blocks only
+        size -= size % 16
+        if size <= 0:
+            return b''
+        num_sectors = (size + self.sector_size - 1) // self.sector_size
+        tweak_steps, unpacker, reorder = self._GetLayout(num_sectors)
+
+        # Tweak for first AES block of a sector is the encrypted sector number
+        sector_nums = struct.pack('<{}Q'.format(num_sectors * 2), *[x for s in range(sector_num, sector_num + num_sectors) for x in (s, 0)])
+        tweaks = int.from_bytes(self.tweak_cipher.encryptor().update(sector_nums), 'little')
+        for k, low_bits_mask, high_bits_mask, shift in tweak_steps:
+            # multiply all tweaks by alpha^k in GF(2^128), bits shifted out are reduced with x^7+x^2+x+1
+            high_bits = (tweaks >> (128 - k)) & high_bits_mask
+            tweaks |= (((tweaks & low_bits_mask) << k) ^ high_bits ^ (high_bits << 1) ^ (high_bits << 2) ^ (high_bits << 7)) << shift
+        tweaks = tweaks.to_bytes(num_sectors * self.sector_size, 'little')
+        if reorder:
+            tweaks = b''.join(reorder(unpacker.unpack(tweaks)))
+        else:
+            tweaks = self._ReorderTweaks(tweaks, num_sectors)
+        tweaks = memoryview(tweaks)[:size]
+
+        if len(self.buffer) < size + 16:
+            self.buffer = bytearray(size + 16) # update_into() needs room for one extra AES block
+        buffer = memoryview(self.buffer)[:size]
+        strxor(memoryview(data)[:size], tweaks, buffer)
+        self.data_cipher.decryptor().update_into(buffer, self.buffer)
+        decrypted = strxor(buffer, tweaks)
+        if requested_size < size:
+            return decrypted[:requested_size]
+        return decrypted
 
 class ApfsExtendedAttribute:
     def __init__(self, volume, xName, xFlags, xData, xSize):
@@ -884,15 +1279,18 @@ class ApfsExtendedAttribute:
         if not self._data_fetched:
             self._real_data = b''
             if self.flags & 1: # extent based
-                # get data from extents
-                for extent in self.extents:
-                    self._real_data += extent.GetData(self._volume)
+                # get data from extents, join() copies each extent's data once
+                self._real_data = b''.join([extent.GetData(self._volume) for extent in self.extents])
             else: # embedded
                 self._real_data = self._data
             self._data_fetched = True
         return self._real_data
 
 class ApfsVolume:
+
+    meta_cache_max_entries = 20000 # Limits for the ApfsFileMeta cache (files_meta_cache)
+    meta_cache_max_bytes = 64 * 1024 * 1024
+
     def __init__(self, apfs_container, name=""):
         self.container = apfs_container
         self.root_tree_oid = 0
@@ -908,62 +1306,70 @@ class ApfsVolume:
         self.num_snapshots = 0
         self.time_created = None
         self.time_updated = None
+        self.xid = 0
         self.uuid = ''
         self.role = 0
-        self.files_meta_cache = DataCache()
+        self.files_meta_cache = DataCache(self.meta_cache_max_entries, self.meta_cache_max_bytes)
         # Encryption related
         self.encryption_key = None
         self.apfs = apfs_container.apfs
         self.block_size = apfs_container.block_size
         self.cs_factor = self.block_size // 0x200
+        self.decrypted_block_cache = BlockCache(apfs_container.block_cache_max_bytes // 2)
         #
         # SqliteWriter object to read from sqlite. 
         # This must be populated manually before calling any file/folder/symlink related method!
         self.dbo = None 
 
     def SetupDecryption(self, key):
-        self.algorithm_aes = algorithms.AES(key)
+        self.xts_decryptor = XtsDecryptor(key)
 
     def get_raw_decrypted_block(self, block_num, key=None, limit_size=-1):
         """Returns raw block data (without parsing). If key is None, no decryption is performed.
            Use limit_size if you need less than one block of data. It's faster to decrypt less
            data. Use it if you don't need the whole block.
         """
-        data = self.container.get_block(block_num)
         if key is not None:
+            decrypted_block = self.decrypted_block_cache.Get(block_num)
+            if decrypted_block is not None:
+                return decrypted_block if limit_size == -1 else decrypted_block[:limit_size]
+            data = self.container.get_block(block_num)
+            if not data:
+                return data
             decrypted_block = self.decrypt_vol_block(data, block_num, key, limit_size)
+            if limit_size == -1: # only cache full blocks
+                self.decrypted_block_cache.Insert(block_num, decrypted_block)
             return decrypted_block
-        return data
+        return self.container.get_block(block_num)
+
+    def get_raw_decrypted_blocks(self, block_num, num_blocks, key=None):
+        """Returns raw data of a run of contiguous blocks, fetched with a single read.
+           If key is None, no decryption is performed.
+        """
+        if num_blocks == 1:
+            return self.get_raw_decrypted_block(block_num, key)
+        data = self.container.get_blocks(block_num, num_blocks)
+        if key is None or not data:
+            return data
+        return self.decrypt_vol_blocks(data, block_num, key)
+
+    def decrypt_vol_blocks(self, encrypted_data, block_id, key):
+        """Decrypts a run of contiguous blocks in one pass"""
+        return self.xts_decryptor.Decrypt(encrypted_data, block_id * self.cs_factor)
 
     def decrypt_vol_block(self, encrypted_block, block_id, key, limit_size=-1):
-        
-        uno = block_id * self.cs_factor
         size = self.block_size
-        k = 0
-        decrypted_block = b""
         if limit_size != -1:
             size = min(size, limit_size)
-        while k < size:
-            tweak = struct.pack("<QQ", uno, 0)
-            decryptor = Cipher(self.algorithm_aes, modes.XTS(tweak), backend=default_backend()).decryptor()
-            decrypted_block += decryptor.update(encrypted_block[k:k + 0x200]) + decryptor.finalize()
-            uno += 1
-            k += 0x200
-        if limit_size != -1:
-            return decrypted_block[:size]
-        return decrypted_block
+        return self.xts_decryptor.Decrypt(encrypted_block, block_id * self.cs_factor, size)
 
     def read_vol_block(self, block_num, key=None, noheader=False):
         """ Parse a single block """
-        data = self.container.get_block(block_num)
+        data = self.get_raw_decrypted_block(block_num, key)
 
         if not data:
             return None
-        if key is None:
-            block = self.apfs.Block(KaitaiStream(BytesIO(data)), self.apfs, self.apfs, noheader)
-        else:
-            decrypted_block = self.decrypt_vol_block(data, block_num, key)
-            block = self.apfs.Block(KaitaiStream(BytesIO(decrypted_block)), self.apfs, self.apfs, noheader)
+        block = self.apfs.Block(KaitaiStream(BytesIO(data)), self.apfs, self.apfs, noheader)
         return block
 
     def read_volume_info(self, volume_super_block_num):
@@ -983,6 +1389,7 @@ class ApfsVolume:
         self.num_snapshots = super_block.body.num_snapshots
         self.time_created = super_block.body.time_created
         self.time_updated = super_block.body.last_mod_time
+        self.xid = super_block.header.xid
         self.uuid = self.ReadUUID(super_block.body.volume_uuid)
         #self.is_case_insensitive = (super_block.body.incompatible_features & apfs.INCOMPAT_CASE_INSENSITIVE != 0)
         self.is_sealed = ((super_block.body.incompatible_features & apfs.INCOMPAT_SEALED_VOLUME) == apfs.INCOMPAT_SEALED_VOLUME)
@@ -1056,6 +1463,22 @@ class ApfsVolume:
                 self.files_meta_cache.Insert(apfs_file_meta, path)
         return apfs_file_meta
 
+    def Prefetch(self, paths):
+        '''Fetches metadata (with extents & xattrs) for many paths, with one query
+           per batch, into the cache. Later calls for these paths (open, 
+           GetExtendedAttribute, ..) then need no queries. Returns number of items found.
+        '''
+        paths = [path for path in paths if self.files_meta_cache.Find(path) == None]
+        count = 0
+        for index in range(0, len(paths), 500):
+            for apfs_file_meta in self.GetManyFileMetadataByPaths(paths[index:index + 500]):
+                count += 1 # GetManyFileMetadata() caches each item
+        return count
+
+    def PrefetchFolder(self, path):
+        '''Fetches metadata for all items in a folder into the cache. Returns number of items'''
+        return len(self.GetFolderItemsMetadata(path))
+
     def GetFile(self, path, apfs_file_meta=None):
         '''Returns an ApfsFile object given path. Returns None if file not found'''
         if not path:
@@ -1121,7 +1544,7 @@ class ApfsVolume:
         return apfs_file
 
     def CopyOutFile(self, path, destination_path):
-        '''Copy out file to disk'''
+        '''Copy out file to disk, file content is streamed in pieces'''
         retval = False
         if not path:
             return False
@@ -1130,7 +1553,8 @@ class ApfsVolume:
         if apfs_file:
             try:
                 with open(destination_path, 'wb') as out_file:
-                    out_file.write(apfs_file.readAll())
+                    for data in apfs_file.readChunks():
+                        out_file.write(data)
                     final_file_size = out_file.tell()
                     out_file.flush()
                     out_file.close()
@@ -1184,8 +1608,13 @@ class ApfsVolume:
         cnid = int(cnid)
         if cnid <= 0:
             return None
-        where_clause = " where p.CNID={} ".format(cnid)
-        return self.GetFileMetadata(where_clause)
+        apfs_file_meta = self.files_meta_cache.FindByCnid(cnid)
+        if apfs_file_meta == None:
+            where_clause = " where p.CNID={} ".format(cnid)
+            apfs_file_meta = self.GetFileMetadata(where_clause)
+            if apfs_file_meta:
+                self.files_meta_cache.Insert(apfs_file_meta, apfs_file_meta.path)
+        return apfs_file_meta
 
     def GetFileMetadataByPath(self, path):
         '''Returns ApfsFileMeta object from database given path and db handle'''
@@ -1197,6 +1626,16 @@ class ApfsVolume:
         where_clause = " where p.Path = '{}' ".format(path)
         return self.GetFileMetadata(where_clause)
 
+    def GetCnidsForPath(self, path):
+        '''Returns list of CNIDs having this exact path (more than one in a Combined volume for firmlinked folders)'''
+        path = path.replace("'", "''") # if path contains single quote, replace with double to escape it!
+        query = "SELECT CNID FROM \"{}_Paths\" WHERE Path = '{}'".format(self.name, path)
+        success, cursor, error_message = self.dbo.RunQuery(query)
+        if success:
+            return [row[0] for row in cursor]
+        log.debug('Failed to execute GetCnidsForPath query, error was : ' + error_message)
+        return []
+
     def GetFilePathFromCnid(self, cnid):
         apfs_file_meta = self.GetFileMetadataByCnid(cnid)
         return apfs_file_meta.path
@@ -1318,19 +1757,20 @@ class ApfsVolume:
         cnids_str = ",".join(cnids)
         where_clause = " where p.CNID IN ({}) ".format(cnids_str)
         try:
-            for item in self.GetManyFileMetadata(where_clause):
+            for item in self.GetManyFileMetadata(where_clause, order_by_cnid=True):
                 yield item
         except GeneratorExit:
             pass
 
     def GetManyFileMetadataByPaths(self, paths):
         '''Returns ApfsFileMeta object from database given a list of paths'''   
+        quoted_paths = []
         for path in paths:
             if not path.startswith('/'): 
                 path = '/' + path
             path = path.replace("'", "''") # if path contains single quote, replace with double to escape it!
-            path = "'{}'".format(path)
-        paths_str = ",".join(paths)
+            quoted_paths.append("'{}'".format(path))
+        paths_str = ",".join(quoted_paths)
         where_clause = " where p.Path IN ({}) ".format(paths_str)
         try:
             for item in self.GetManyFileMetadata(where_clause):
@@ -1357,8 +1797,10 @@ class ApfsVolume:
         else:
             log.debug('Failed to execute GetManyFileMetadataCountOnly query, error was : ' + error_message)
 
-    def GetManyFileMetadata(self, where_clause):
-        '''Returns ApfsFileMeta object from database. A where_clause specifies either cnid or path to find'''
+    def GetManyFileMetadata(self, where_clause, order_by_cnid=False):
+        '''Returns ApfsFileMeta object from database. A where_clause specifies either cnid or path to find.
+           Use order_by_cnid if where_clause selects by CNID, else sqlite scans all paths to sort them.
+        '''
         #apfs_file_meta_list = []
         query = "SELECT a.name as xName, a.flags as xFlags, a.data as xData, a.Logical_uncompressed_size as xSize, "\
                 " a.Extent_CNID as xCNID, a.XID as xXID, ex.Offset as xExOff, ex.Size as xExSize, ex.Block_Num as xBlock_Num, "\
@@ -1376,11 +1818,12 @@ class ApfsVolume:
                 " left join \"{0}_Attributes\" as a on a.CNID = p.CNID "\
                 " left join \"{0}_Extents\" as ex on ex.CNID = a.Extent_CNID "\
                 " {1} and i.Name is not null "\
-                " order by p.Path, p.CNID, Extent_Offset, compressed_Extent_Offset, xName, xExOff"
+                " order by {2}, Extent_Offset, compressed_Extent_Offset, xName, xExOff"
         # This query gets file metadata as well as extents for file. If compressed, it gets compressed extents.
         # It gets XAttributes, except decmpfs and ResourceFork (we already got those in _Compressed_Files table)
         # Sometimes, there are old items in dirEntries but not present in inodes or elsewhere, "i.Name is not null" removes these.
-        success, cursor, error_message = self.dbo.RunQuery(query.format(self.name, where_clause), return_named_objects=True)
+        order_by = 'p.CNID, p.Path' if order_by_cnid else 'p.Path, p.CNID'
+        success, cursor, error_message = self.dbo.RunQuery(query.format(self.name, where_clause, order_by), return_named_objects=True)
         if success:
             apfs_file_meta = None
             #extent_cnid = 0
@@ -1396,7 +1839,7 @@ class ApfsVolume:
             path = ''
             try:
                 for row in cursor:
-                    if last_cnid == row['CNID']: # same file
+                    if last_cnid == row['CNID'] and path == row['Path']: # same file (hard links have more than one path)
                         pass
                     else:                  # new file
                         if last_cnid:      # save old info
@@ -1482,22 +1925,39 @@ class ApfsVolume:
         else:
             log.debug('Failed to execute GetManyFileMetadata query, error was : ' + error_message)
 
+    def GetFolderItemsMetadata(self, path):
+        '''Returns list of ApfsFileMeta objects for items in folder, sorted by path.
+           All of these are also put in the cache.
+        '''
+        if path.endswith('/') and path != '/':
+            path = path[:-1]
+        folder_cnids = self.GetCnidsForPath(path)
+        if not folder_cnids: # Not found with exact match, LIKE is case-insensitive
+            if path == '/':
+                where_clause = "where path like '/%' and path NOT like '/%/%' and path NOT like '/' "
+            else:
+                where_clause = "where path like '{}/%' and path NOT like '{}/%/%'".format(path, path)
+            return list(self.GetManyFileMetadata(where_clause))
+
+        # Children are looked up by Parent_CNID (indexed), instead of scanning all paths with LIKE.
+        # Hard links have one DirEntry per parent, items whose path is in another folder are skipped.
+        where_clause = "where p.CNID IN (SELECT CNID FROM \"{}_DirEntries\" WHERE Parent_CNID IN ({}))".format(
+                        self.name, ",".join([str(x) for x in folder_cnids]))
+        prefix = '/' if path == '/' else path + '/'
+        prefix_len = len(prefix)
+        meta_items = [meta_item for meta_item in self.GetManyFileMetadata(where_clause, order_by_cnid=True) \
+                        if meta_item.path.startswith(prefix) and meta_item.path.find('/', prefix_len) == -1]
+        return sorted(meta_items, key=lambda x: x.path)
+
     def ListItemsInFolder(self, path):
         ''' 
         Returns a list of files and/or folders in a list
         Format of list = [ { 'name':'got.txt', 'type':'File', 'size':10, 'dates': {} }, .. ]
         'path' should be linux style using forward-slash like '/var/db/xxyy/file.tdc'
+        Metadata for these items is cached, so later calls for them need no queries.
         '''
-        if path.endswith('/') and path != '/':
-            path = path[:-1]
         items = [] # List of dictionaries
-
-        if path == '/':
-            where_clause = "where path like '/%' and path NOT like '/%/%' and path NOT like '/' "
-        else:
-            where_clause = "where path like '{}/%' and path NOT like '{}/%/%'".format(path, path)
-
-        for meta_item in self.GetManyFileMetadata(where_clause):
+        for meta_item in self.GetFolderItemsMetadata(path):
             item = { 'name':meta_item.name, 'size':meta_item.logical_size, 
                     'type':ApfsFileMeta.ItemTypeString(meta_item.item_type) }
             item['dates'] = { 'c_time':meta_item.changed,
@@ -1561,6 +2021,10 @@ class ApfsSysDataLinkedVolume(ApfsVolume):
 
 class ApfsContainer:
 
+    block_cache_max_bytes = 64 * 1024 * 1024 # For raw blocks, volumes get half this for decrypted blocks
+    read_ahead_blocks = 32 # Number of blocks read at once, when sequential block reads are seen
+    max_blocks_per_read = 1024 # Largest run of blocks fetched in a single read by get_blocks()
+
     def __init__(self, image_file, apfs_container_size, offset=0):
         self.img = image_file
         self.apfs_container_offset = offset
@@ -1568,6 +2032,8 @@ class ApfsContainer:
         self.volumes = []
         self.preboot_volume = None
         self.position = 0 # For self.seek()
+        self.block_cache = BlockCache(self.block_cache_max_bytes)
+        self.last_block_num = -1 # For detecting sequential reads
 
         try:
             self.block_size = 4096 # Default, before real size is read in
@@ -1635,7 +2101,12 @@ class ApfsContainer:
             index += 1
 
     def close(self):
-        pass
+        log.debug('Block cache stats: ' + self.block_cache.GetStats())
+        for volume in self.volumes:
+            if volume.files_meta_cache.hits or volume.files_meta_cache.misses:
+                log.debug(f'{volume.name} file metadata cache stats: ' + volume.files_meta_cache.GetStats())
+            if volume.encryption_key:
+                log.debug(f'{volume.name} decrypted block cache stats: ' + volume.decrypted_block_cache.GetStats())
 
     def seek(self, offset, whence=0):
         if whence == 0: # Beginning of file
@@ -1659,9 +2130,39 @@ class ApfsContainer:
         return data
 
     def get_block(self, idx):
-        """ Get data of a single block """
+        """ Get data of a single block. Blocks are cached, and if blocks are 
+            being read sequentially, the next few blocks are read ahead.
+        """
+        is_sequential = (idx == self.last_block_num + 1)
+        self.last_block_num = idx
+        data = self.block_cache.Get(idx)
+        if data is not None:
+            return data
+        self.seek(idx * self.block_size)
+        if is_sequential and self.read_ahead_blocks > 1:
+            num_blocks = min(self.read_ahead_blocks, (self.apfs_container_size // self.block_size) - idx)
+            if num_blocks > 1:
+                data = self.read(num_blocks * self.block_size)
+                for i in range(1, len(data) // self.block_size):
+                    self.block_cache.Insert(idx + i, data[i * self.block_size : (i + 1) * self.block_size])
+                data = data[:self.block_size]
+                if len(data) == self.block_size: # Short reads are not cached, so they are retried
+                    self.block_cache.Insert(idx, data)
+                return data
+        data = self.read(self.block_size)
+        if len(data) == self.block_size:
+            self.block_cache.Insert(idx, data)
+        return data
+
+    def get_blocks(self, idx, num_blocks):
+        """ Get data of a run of contiguous blocks with a single read. These are
+            large data reads (file content), so they bypass the block cache.
+        """
+        if num_blocks == 1:
+            return self.get_block(idx)
+        self.last_block_num = idx + num_blocks - 1
         self.seek(idx * self.block_size)
-        return self.read(self.block_size)
+        return self.read(num_blocks * self.block_size)
 
     def read_block(self, block_num):
         """ Parse a single block """
@@ -1717,46 +2218,50 @@ class ApfsExtent:
         self.block_num = block_num
 
     def GetData(self, volume):
-        ## TODO: Create buffered read, in case of really large files!!
-        encryption_key = volume.encryption_key
-        num_full_blocks_needed = self.size // volume.block_size
-        partial_block_size = self.size % volume.block_size
-
-        data = b''
-        for b in range(num_full_blocks_needed):
-            data += volume.get_raw_decrypted_block(self.block_num + b, encryption_key)
-        if partial_block_size > 0:
-            data += volume.get_raw_decrypted_block(self.block_num + num_full_blocks_needed, encryption_key, partial_block_size)
+        '''Returns all data in the extent as a bytearray, convert it if bytes are needed'''
+        data = bytearray(self.size)
+        with memoryview(data) as buffer:
+            bytes_read = self.ReadInto(volume, buffer)
+        if bytes_read < self.size:
+            del data[bytes_read:] # Trimmed in place, no copy
         return data
-    
-    def GetSomeData(self, volume, max_size=41943040): # max 40MB
-        encryption_key = volume.encryption_key
-        try:
-            #container.seek(self.block_num * container.block_size)
-            # return data in chunks of max_size
-            if self.size <= max_size:
-                yield self.GetData(volume)
-                #yield container.read(self.size)
-            else:
-                block_num = self.block_num
-                num_full_blocks_needed = self.size // volume.block_size
-                partial_block_size = self.size % volume.block_size
-
-                data = b''
-                for b in range(num_full_blocks_needed):
-                    data += volume.get_raw_decrypted_block(block_num, encryption_key)
-                    block_num += 1
-                    if data >= max_size:
-                        yield data
-                        data = b''
-                if partial_block_size > 0:
-                    data += volume.get_raw_decrypted_block(block_num, encryption_key, partial_block_size)
-                    yield data
 
-        except GeneratorExit:
-            pass
+    def ReadInto(self, volume, buffer, offset=0, size=-1):
+        '''Reads extent data starting at 'offset' (relative to start of extent) into
+           'buffer' (a writable bytearray or memoryview). Reads 'size' bytes or till
+           the end of the extent if size is -1. Contiguous blocks are fetched and
+           decrypted in large runs, instead of one block at a time.
+           Returns number of bytes read.
+        '''
+        if size < 0 or offset + size > self.size:
+            size = self.size - offset
+        if size <= 0:
+            return 0
+        block_size = volume.block_size
+        max_blocks = volume.container.max_blocks_per_read
+        block_index = offset // block_size
+        skip = offset % block_size # bytes to skip in first block
+        bytes_read = 0
+        while bytes_read < size:
+            num_blocks = min(max_blocks, (skip + size - bytes_read + block_size - 1) // block_size)
+            data = volume.get_raw_decrypted_blocks(self.block_num + block_index, num_blocks, volume.encryption_key)
+            if not data:
+                break
+            chunk = memoryview(data)[skip : skip + size - bytes_read]
+            if not chunk:
+                break
+            buffer[bytes_read : bytes_read + len(chunk)] = chunk
+            bytes_read += len(chunk)
+            if len(data) < num_blocks * block_size: # short read, reached end of image?
+                break
+            block_index += num_blocks
+            skip = 0
+        return bytes_read
 
 class ApfsFile():
+
+    read_ahead_size = 1048576 # Minimum bytes fetched by read(), rest is kept in buffer for next read
+
     def __init__(self, apfs_file_meta, logical_size, extents, volume):
         self.meta = apfs_file_meta
         self.file_size = logical_size
@@ -1769,84 +2274,66 @@ class ApfsFile():
         self._buffer = b''
         self._buffer_start = 0
 
-    def _GetDataFromExtents(self, extents, total_size):
-        '''Retrieves data from extents'''
-        content = b''
-        if total_size == 0: 
-            return content
-        bytes_left = total_size
+    def _ReadFromExtents(self, extents, total_size, offset, size):
+        '''Reads data from extents, corresponding to a file offset and specific size,
+           into a single preallocated buffer. Returns a bytearray, this is shorter
+           than requested only if the extents did not have all the data.
+        '''
+        size = min(size, total_size - offset)
+        if size <= 0:
+            return bytearray()
+        content = bytearray(size)
+        with memoryview(content) as view:
+            bytes_read = self._ReadExtentsInto(extents, offset, view)
+        if bytes_read < size:
+            del content[bytes_read:]
+        return content
+
+    def _ReadExtentsInto(self, extents, offset, view):
+        '''Fills the writable memoryview 'view' with data from extents, starting at
+           file offset. Caller must ensure that view does not extend past the
+           logical size of the file. Returns number of bytes read.
+        '''
+        size = len(view)
+        bytes_read = 0
+        extent_start = 0 # file offset of current extent
         for extent in extents:
-            if bytes_left <= 0:
+            if bytes_read >= size:
                 # Not so uncommon in reality! For files that grow and shrink, APFS does not reclaim clusters immediately.
-                log.debug ("mismatch between logical size and extents!")
                 break
-            data = extent.GetData(self.volume)
-            data_len = extent.size
-            if data_len >= bytes_left:
-                content += data[:bytes_left]
-                bytes_left = 0
-            else:
-                content += data
-                bytes_left -= data_len
-        if bytes_left > 0:
+            extent_end = extent_start + extent.size
+            file_pos = offset + bytes_read
+            if file_pos < extent_end:
+                to_read = min(size - bytes_read, extent_end - file_pos)
+                got = extent.ReadInto(self.volume, view[bytes_read : bytes_read + to_read], file_pos - extent_start, to_read)
+                bytes_read += got
+                if got < to_read:
+                    break
+            extent_start = extent_end
+        return bytes_read
+
+    def _GetDataFromExtents(self, extents, total_size):
+        '''Retrieves data from extents'''
+        if total_size == 0:
+            return b''
+        content = self._ReadFromExtents(extents, total_size, 0, total_size)
+        if len(content) < total_size:
             log.error ("Error, could not get all pieces of file for file - " + self.meta.name + " cnid=" + str(self.meta.cnid))
-        return content
+        return bytes(content)
 
     def _GetSomeDataFromExtents(self, extents, total_size, offset, size):
         '''Retrieves data from extents, corresponding to a file offset and specific size
            It is assumed that size and offset values are sanitized and fall within
-           the range of logical file content. Returned size of data may be larger than 
-           requested. It reads full extent even if only partial is requested.
+           the range of logical file content. Only the blocks covering the requested
+           range are read.
         '''
-        content = b''
-        ext_content = b''
-        if total_size == 0: 
-            return content
-        bytes_left_in_file = total_size
-        bytes_consumed = 0
-        desired_size = size
-
-        break_main_loop = False
-        for extent in extents:
-            if bytes_left_in_file <= 0:
-                # Not so uncommon in reality! For files that grow and shrink, APFS does not reclaim clusters immediately.
-                log.debug ("mismatch between logical size and extents!")
-                break
-            data_len = extent.size
-            if (bytes_consumed <= offset):
-                if offset >= (bytes_consumed + data_len):
-                    # not in range yet
-                    bytes_consumed += data_len
-                    bytes_left_in_file -= data_len
-                else:
-                    # reached desired start offset
-                    extent_slice_consumed = 0
-                    for data in extent.GetSomeData(self.volume):
-                        start_pos = offset - bytes_consumed - extent_slice_consumed
-                        if start_pos >= len(data): # Case when extent slicing results in this, we only want let's say 3rd yield onwards!
-                            extent_slice_consumed += len(data)
-                            continue
-                        ext_content = data[start_pos : ] #start_pos + size] # Perhaps return full buffer, let caller truncate buffer!
-                        content += ext_content
-                        ext_content_len = len(ext_content)
-                        
-                        if ext_content_len >= size: # will be <= size
-                            break_main_loop = True
-                            break
-                        else:
-                            offset += ext_content_len
-                            size -= ext_content_len
-                            extent_slice_consumed += len(data) #ext_content_len 
-
-                    bytes_consumed += data_len
-                    bytes_left_in_file -= data_len
-                    if break_main_loop: break
-            else:
-                log.debug('Should it ever be here?? bytes_consumed={} offset={}, file={} cnid={}'.format(bytes_consumed, offset, self.meta.name, self.meta.cnid))
-                break
+        if total_size == 0:
+            return b''
+        content = self._ReadFromExtents(extents, total_size, offset, size)
+        desired_size = min(size, total_size - offset)
         if len(content) < desired_size:
             log.error ("Error, could not get some pieces of file={} cnid={} len(content)={} desired_size={}".format(self.meta.name, self.meta.cnid, len(content), desired_size))
-        return content
+        return bytes(content)
 
     def readAll(self):
         '''return entire file in one buffer'''
@@ -1861,6 +2348,30 @@ class ApfsFile():
         self.closed = True
         return file_content
 
+    def readChunks(self, chunk_size=4194304):
+        '''Generator, returns entire file in pieces of chunk_size (default 4MB), 
+           so large files can be exported without holding them in memory.
+           For uncompressed files, the same buffer is reused for every piece,
+           so a piece is only valid till the next one is requested.
+        '''
+        self.closed = False
+        if self.meta.is_symlink: # if symlink, return symlink  path as data
+            yield self.meta.attributes['com.apple.fs.symlink'].data
+        else:
+            total_size = self.meta.logical_size
+            buffer = memoryview(bytearray(min(chunk_size, total_size)))
+            offset = 0
+            while offset < total_size:
+                size_to_read = min(chunk_size, total_size - offset)
+                bytes_read = self._ReadExtentsInto(self.extents, offset, buffer[:size_to_read])
+                if bytes_read:
+                    yield buffer[:bytes_read]
+                offset += bytes_read
+                if bytes_read < size_to_read:
+                    log.error ("Error, could not get all pieces of file for file - " + self.meta.name + " cnid=" + str(self.meta.cnid))
+                    break
+        self.closed = True
+
     def _check_closed(self):
         if self.closed:
             raise ValueError("File is closed!")
@@ -1955,12 +2466,16 @@ class ApfsFile():
         if self.meta.is_symlink: # if symlink, return symlink  path as data
             data += self.meta.attributes['com.apple.fs.symlink'].data[self._pointer : self._pointer + size_to_read]
         else:
-            new_data_fetched = self._GetSomeDataFromExtents(self.extents, self.meta.logical_size, self._pointer, size_to_read)
+            # Fetch at least read_ahead_size bytes, so small sequential reads are served from buffer
+            new_data_fetched = self._GetSomeDataFromExtents(self.extents, self.file_size, self._pointer, max(size_to_read, self.read_ahead_size))
             new_data_len = len(new_data_fetched)
-            data += new_data_fetched
 
             if new_data_len < size_to_read:
-                log.error("Did not get enough data! Debug this new_data_len={} size_to_read={}".format(new_data_len, size_to_read))            
+                log.error("Did not get enough data! Debug this new_data_len={} size_to_read={}".format(new_data_len, size_to_read))
+            self._buffer_start = self._pointer
+            self._buffer = new_data_fetched
+            self._pointer += size_to_read
+            return data + new_data_fetched[:size_to_read]
 
         self._buffer_start = original_file_pointer
         self._pointer += size_to_read
@@ -2173,10 +2688,7 @@ class ApfsFileCompressed(ApfsFile):
                         uncomp_offset_start = 0
                         for i in range(num_blocks):
                             chunk_offset, chunk_size = struct.unpack('<II', compressed_header[base_offset + i*8 : base_offset + i*8 + 8])
-                            if i == num_blocks - 1: # last block
-                                uncomp_offset_end = uncomp_offset_start + (self.uncompressed_size % 65536)
-                            else:
-                                uncomp_offset_end = uncomp_offset_start + 65536
+                            uncomp_offset_end = min(uncomp_offset_start + 65536, self.uncompressed_size)
                             self.zlib_info.chunk_info.append([header_size + 4 + chunk_offset, chunk_size, uncomp_offset_start, uncomp_offset_end])
                             uncomp_offset_start += 65536
                     elif self.compression_type == 8: # lzvn in ResourceFork
@@ -2190,30 +2702,31 @@ class ApfsFileCompressed(ApfsFile):
                             compressed_header += super().read(min(extent_data_size, farthest_pos))
                         chunkOffsets = struct.unpack('<{}I'.format(num_chunkOffsets), compressed_header[4 : 4 + (num_chunkOffsets * 4)])
                         self.lzvn_info = LzvnCompressionParams(headerSize, chunkOffsets, self.uncompressed_size)
+                    self.compressed_header = compressed_header # parsed once, chunk info is reused for later reads
                 
                 # Read compressed_data chunks and decrypt them
-                decompressed = b''
+                decompressed = []
                 req_start = self.uncomp_pointer
                 if self.compression_type == 4:   # zlib
                    # Determine chunks to decryt
-                    z_decomp_obj = zlib.decompressobj()
                     chunks_to_decompress = self.getChunkList(self.zlib_info.chunk_info, req_start, size)
                     for chunk_offset, chunk_size, uncomp_offset_start, uncomp_offset_end in chunks_to_decompress:
-                        super().seek(self.zlib_info.header_size + 4 + chunk_offset)
+                        super().seek(chunk_offset) # already includes header_size + 4
                         compressed_data = super().read(chunk_size)
                         if compressed_data[0] == 0xFF:
-                            decompressed += compressed_data[1 : chunk_size]
+                            decompressed.append(compressed_data[1 : chunk_size])
                         else:
-                            decompressed += z_decomp_obj.decompress(compressed_data)
+                            decompressed.append(zlib.decompress(compressed_data)) # each chunk is a separate zlib stream
                 elif self.compression_type == 8: # lzvn
                     chunks_to_decompress = self.getChunkList(self.lzvn_info.chunk_info, req_start, size)
                     for chunk_offset, chunk_size, uncomp_offset_start, uncomp_offset_end in chunks_to_decompress:
                         super().seek(chunk_offset)
                         compressed_data = super().read(chunk_size)
                         if compressed_data[0] == 0x06:
-                            decompressed += compressed_data[1:]
+                            decompressed.append(compressed_data[1:])
                         else:
-                            decompressed += self._lzvn_decompress(compressed_data, chunk_size, uncomp_offset_end - uncomp_offset_start)
+                            decompressed.append(self._lzvn_decompress(compressed_data, chunk_size, uncomp_offset_end - uncomp_offset_start))
+                decompressed = b''.join(decompressed)
 
                 # got all decompressed data, now slice to required part
                 buffer_start = chunks_to_decompress[0][2]
@@ -2323,6 +2836,21 @@ class ApfsFileCompressed(ApfsFile):
         self.closed = True
         return file_content
 
+    def readChunks(self, chunk_size=4194304):
+        '''Generator, returns entire uncompressed file in pieces of chunk_size (default 4MB).
+           Only the compressed chunks needed for each piece are read and decompressed.
+        '''
+        if self.meta.is_symlink or self.uncompressed_size < 10485760: # read() would decompress whole file anyway
+            yield self.readAll()
+            return
+        self.closed = False
+        self.seek(0)
+        data = self.read(chunk_size)
+        while data:
+            yield data
+            data = self.read(chunk_size)
+        self.closed = True
+
     def close(self):
         self.uncomp_pointer = None
         self.uncomp_buffer_start = 0
@@ -8,6 +8,7 @@
 '''
 
 import logging
+import multiprocessing
 import os
 import posixpath
 import random
@@ -31,6 +32,7 @@ from plugins.helpers.common import *
 from plugins.helpers.darwin_path_generator import GetDarwinPath, GetDarwinPath2
 from plugins.helpers.hfs_alt import HFSVolume
 from plugins.helpers.structs import *
+from plugins.helpers.writer import SqliteWriter
 
 if sys.platform == 'linux':
     from plugins.helpers.statx import statx
@@ -321,6 +323,7 @@ class MacInfo:
     def __init__(self, output_params, password='', dont_decrypt=False):
         #self.Partitions = {}   # Dictionary of all partition objects returned from pytsk LATER!
         self.pytsk_image = None
+        self.image_opener = None  # Function that returns a new image object, for forked worker processes
         self.macos_FS = None      # Just the FileSystem object (fs) from OSX partition
         self.macos_partition_start_offset = 0 # Container offset if APFS
         self.vol_info = None # disk_volumes
@@ -407,6 +410,17 @@ class MacInfo:
         if self.use_native_hfs_parser:
             return self.hfs_native.GetExtendedAttribute(path, att_name)
 
+    def Prefetch(self, paths):
+        '''Read metadata for many files in one go, where the filesystem supports it (APFS),
+           so later calls for them (Open, GetFileMACTimes, ..) are faster. 
+           Returns number of items fetched.
+        '''
+        return 0
+
+    def PrefetchFolder(self, path):
+        '''Read metadata for all items in a folder in one go, see Prefetch()'''
+        return 0
+
     def GetExtendedAttributes(self, path):
         if self.use_native_hfs_parser:
             return self.hfs_native.GetExtendedAttributes(path)
@@ -777,6 +791,18 @@ class MacInfo:
 
     # Private (Internal) functions, plugins should not use these
 
+    def _ReopenImageHandles(self, image_opener):
+        '''Called in a forked plugin worker process (mac_apt --jobs), to get handles
+           to the image that are not shared with the parent. 'image_opener' is a 
+           function that returns a new image object.
+        '''
+        if self.pytsk_image:
+            self.pytsk_image = image_opener()
+            if not self.is_apfs and self.macos_FS:
+                self.macos_FS = pytsk3.FS_Info(self.pytsk_image, offset=self.macos_partition_start_offset)
+            if self.hfs_native.initialized:
+                self.hfs_native.Initialize(self.pytsk_image, self.macos_partition_start_offset)
+
     def _GetSafeFilename(self, name):
         '''
            Removes illegal characters from filenames
@@ -1026,6 +1052,39 @@ class MacInfo:
             log.exception("Unknown error from _GetSystemInfo()")
         return False
 
+# Used by ApfsMacInfo._ReadApfsVolumesInParallel(), inherited by forked workers
+_apfs_parallel_volumes = []
+_apfs_parallel_image_opener = None
+_apfs_parallel_paths_build_method = 'memory'
+_apfs_worker_image = None
+
+def _ParseApfsVolumeToStagingDb(job):
+    '''Worker process function, parses a single volume to its own staging db.
+       Returns tuple (index, success)
+    '''
+    global _apfs_worker_image
+    index, staging_db_path = job
+    vol = _apfs_parallel_volumes[index]
+    staging_db = None
+    try:
+        if _apfs_worker_image is None: # Image must be re-opened, file offsets cannot be shared with parent
+            _apfs_worker_image = _apfs_parallel_image_opener()
+        vol.container.img = _apfs_worker_image
+        staging_db = SqliteWriter()
+        staging_db.OpenSqliteDb(staging_db_path)
+        staging_db.BeginBulkInsert()
+        apfs_parser = ApfsFileSystemParser(vol, staging_db, paths_build_method=_apfs_parallel_paths_build_method) # Daemon process, cannot start more workers
+        apfs_parser.indexes_needed = False # Indexes are only needed in main db
+        apfs_parser.read_volume_records()
+        staging_db.EndBulkInsert()
+        return index, True
+    except Exception:
+        log.exception(f'Error parsing volume {vol.volume_name} in worker process')
+    finally:
+        if staging_db:
+            staging_db.CloseDb()
+    return index, False
+
 class ApfsMacInfo(MacInfo):
     def __init__(self, output_params, password, dont_decrypt):
         super().__init__(output_params, password, dont_decrypt)
@@ -1099,13 +1158,29 @@ class ApfsMacInfo(MacInfo):
                 log.error("Could not open plist to get system version info!")
         return info
 
-    def ReadApfsVolumes(self):
-        '''Read volume information into an sqlite db'''
+    def _ReopenImageHandles(self, image_opener):
+        MacInfo._ReopenImageHandles(self, image_opener)
+        if self.apfs_container:
+            self.apfs_container.img = self.pytsk_image
+        if self.apfs_db: # All volumes use this same object as dbo
+            self.apfs_db.OpenSqliteDb(self.apfs_db.filepath, read_only=True)
+
+    def ReadApfsVolumes(self, num_workers=1, image_opener=None, num_block_workers=1, paths_build_method='memory'):
+        '''Read volume information into an sqlite db.
+           If num_workers > 1, volumes (except Preboot) are parsed in parallel
+           worker processes, each writing to its own staging db, which is then
+           merged into the main db. If num_block_workers > 1, the leaf blocks of
+           volumes parsed in this process are decoded by that many worker processes.
+           Both need 'image_opener', a function that returns a new image object, 
+           as workers cannot share the image handle. 'paths_build_method' is one
+           of ApfsFileSystemParser.paths_build_methods.
+        '''
         decryption_key = None
+        volumes_to_parse = []
         # Process Preboot volume first
         preboot_vol = self.apfs_container.preboot_volume
         if preboot_vol:
-            apfs_parser = ApfsFileSystemParser(preboot_vol, self.apfs_db)
+            apfs_parser = ApfsFileSystemParser(preboot_vol, self.apfs_db, num_block_workers, image_opener, paths_build_method)
             apfs_parser.read_volume_records()
             preboot_vol.dbo = self.apfs_db
         # Process other volumes now
@@ -1149,15 +1224,66 @@ class ApfsMacInfo(MacInfo):
                                 else:
                                     log.debug(f"Starting decryption of filesystem, VEK={decryption_key.hex().upper()}")
                                     vol.encryption_key = decryption_key
-                                    apfs_parser = ApfsFileSystemParser(vol, self.apfs_db)
-                                    apfs_parser.read_volume_records()
+                                    volumes_to_parse.append(vol)
                                     break
                             else:
                                 log.error(f"Failed to read {plist_path}. Error was : {error}")
                         index += 1
             else:
+                volumes_to_parse.append(vol)
+
+        if num_workers > 1 and image_opener and len(volumes_to_parse) > 1:
+            volumes_to_parse = self._ReadApfsVolumesInParallel(volumes_to_parse, num_workers, image_opener, paths_build_method)
+        for vol in volumes_to_parse:
+            apfs_parser = ApfsFileSystemParser(vol, self.apfs_db, num_block_workers, image_opener, paths_build_method)
+            apfs_parser.read_volume_records()
+
+    def _ReadApfsVolumesInParallel(self, volumes, num_workers, image_opener, paths_build_method):
+        '''Parse volumes in worker processes and merge their staging dbs into
+           apfs_db. Returns list of volumes that still need to be parsed (serially).
+        '''
+        global _apfs_parallel_volumes, _apfs_parallel_image_opener, _apfs_parallel_paths_build_method
+        try:
+            # Workers inherit the parsed container & volume objects, so fork is needed
+            mp_context = multiprocessing.get_context('fork')
+        except ValueError:
+            log.info('Parallel parsing of APFS volumes is not supported on this platform, parsing serially')
+            return volumes
+
+        num_workers = min(num_workers, len(volumes))
+        log.info(f'Parsing {len(volumes)} APFS volumes using {num_workers} worker processes')
+        time_started = time.time()
+        staging_folder = tempfile.mkdtemp(prefix='APFS_Staging_', dir=self.output_params.output_path)
+        _apfs_parallel_volumes = volumes
+        _apfs_parallel_image_opener = image_opener
+        _apfs_parallel_paths_build_method = paths_build_method
+        jobs = [(index, os.path.join(staging_folder, f'Vol_{index}.db')) for index in range(len(volumes))]
+        # Largest volumes first, so the Data volume is not left running alone at the end
+        jobs.sort(key=lambda job: volumes[job[0]].num_files + volumes[job[0]].num_folders, reverse=True)
+        results = {}
+        try:
+            with mp_context.Pool(num_workers) as pool:
+                results = dict(pool.imap_unordered(_ParseApfsVolumeToStagingDb, jobs))
+        except Exception:
+            log.exception('Error in parallel APFS parsing, will parse remaining volumes serially')
+        finally:
+            _apfs_parallel_volumes = []
+            _apfs_parallel_image_opener = None
+            _apfs_parallel_paths_build_method = 'memory'
+
+        remaining_volumes = []
+        for index, staging_db_path in sorted(jobs):
+            vol = volumes[index]
+            if results.get(index, False):
                 apfs_parser = ApfsFileSystemParser(vol, self.apfs_db)
-                apfs_parser.read_volume_records()
+                if apfs_parser.merge_volume_records(staging_db_path):
+                    continue
+                log.error(f'Failed to merge staging db for volume {vol.volume_name}, will parse it again')
+                apfs_parser.drop_tables()
+            remaining_volumes.append(vol)
+        shutil.rmtree(staging_folder, ignore_errors=True)
+        log.info('Parallel APFS parsing took {}'.format(time.strftime('%H:%M:%S', time.gmtime(time.time() - time_started))))
+        return remaining_volumes
 
     def GetFileMACTimes(self, file_path):
         '''Gets MACB and the 5th Index timestamp too'''
@@ -1195,7 +1321,7 @@ class ApfsMacInfo(MacInfo):
 
     def GetFileSize(self, full_path, error=None):
         try:
-            apfs_file_meta = self.macos_FS.GetFileMetadataByPath(full_path)
+            apfs_file_meta = self.macos_FS.GetApfsFileMeta(full_path)
             if apfs_file_meta:
                 return apfs_file_meta.logical_size
         except Exception as ex:
@@ -1232,7 +1358,7 @@ class ApfsMacInfo(MacInfo):
             UID & GID are returned as strings
         '''
         success, uid, gid = False, 0, 0
-        apfs_file_meta = self.macos_FS.GetFileMetadataByPath(path)
+        apfs_file_meta = self.macos_FS.GetApfsFileMeta(path)
         if apfs_file_meta:
             uid = str(apfs_file_meta.uid)
             gid = str(apfs_file_meta.gid)
@@ -1268,6 +1394,12 @@ class ApfsMacInfo(MacInfo):
                         items.append(dict(x))
         return items
 
+    def Prefetch(self, paths):
+        return self.macos_FS.Prefetch(paths)
+
+    def PrefetchFolder(self, path):
+        return self.macos_FS.PrefetchFolder(path)
+
 class MountedFile():
     # This class is a file-like object, its existence is due to
     # Xways Forensics bug with reading mounted files, which can't
@@ -1772,6 +1904,9 @@ class ZipMacInfo(MacInfo):
         self.name_list = self.zip_file.namelist()
         log.debug(f'Total files = {len(self.name_list)}')
 
+    def _ReopenImageHandles(self, image_opener):
+        self.zip_file = zipfile.ZipFile(self.zip_path)
+
     #def BuildFullPath(self, path_in_image):
     #    return path_in_image
 
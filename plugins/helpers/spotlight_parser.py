@@ -37,7 +37,7 @@
 #                of store.db. Ideally, just extract the whole folder instead of just the single
 #                store.db file. 
 #
-# Usage        : spotlight_parser.py [-p OUTPUT_PREFIX] <path_to_database>  <output_folder>
+# Usage        : spotlight_parser.py [-p OUTPUT_PREFIX] [-w WORKERS] <path_to_database>  <output_folder>
 #                Example:  python.exe spotlight_parser.py c:\store.db  c:\store_output
 #
 # Ack          : M Bartle for most of the python3 porting
@@ -48,6 +48,8 @@
 import zlib
 import lz4.block
 import time
+import collections
+import multiprocessing
 import struct
 import binascii
 import datetime
@@ -69,12 +71,31 @@ __VERSION__ = '1.0.2'
 
 log = logging.getLogger('SPOTLIGHT_PARSER')
 
+def _BuildVarSizeNumTable():
+    '''Returns list indexed by first byte of a var sized number, with
+       entries (extra_bytes_to_read, value_from_first_byte)'''
+    table = []
+    for first_byte in range(256):
+        if first_byte < 0x80:   table.append((0, first_byte))
+        elif first_byte < 0xC0: table.append((1, first_byte - 0x80))
+        elif first_byte < 0xE0: table.append((2, first_byte - 0xC0))
+        elif first_byte < 0xF0: table.append((3, first_byte - 0xE0))
+        elif first_byte < 0xF8: table.append((4, first_byte - 0xF0))
+        elif first_byte < 0xFC: table.append((5, 0))
+        elif first_byte < 0xFE: table.append((6, 0))
+        elif first_byte < 0xFF: table.append((7, 0))
+        else:                   table.append((8, 0))
+    return table
+
+var_size_num_table = _BuildVarSizeNumTable()
+
 class FileMetaDataListing:
     def __init__(self, file_pos, data, size):
         self.file_pos = file_pos
         self.pos = 0
-        self.data = data
+        self.data = memoryview(data) # cursor over data, reads below do not copy it
         self.size = size
+        self.var_size_num_limit = min(size, len(self.data))
         self.meta_data_dict = {} # { kMDItemxxx: value1, kMCItemyyy: value2, ..}
         #
         self.id = 0 # inode number
@@ -85,27 +106,27 @@ class FileMetaDataListing:
         self.full_path = ''
        
     def ReadFloat(self):
-        num = struct.unpack("<f", self.data[self.pos : self.pos + 4])[0]
+        num = struct.unpack_from("<f", self.data, self.pos)[0]
         self.pos += 4
         return num
 
     def ReadDouble(self):
-        num = struct.unpack("<d", self.data[self.pos : self.pos + 8])[0]
+        num = struct.unpack_from("<d", self.data, self.pos)[0]
         self.pos += 8
         return num
 
     def ReadShort(self):
-        num = struct.unpack("<H", self.data[self.pos : self.pos + 2])[0]
+        num = struct.unpack_from("<H", self.data, self.pos)[0]
         self.pos += 2
         return num
        
     def ReadUint32(self):
-        num = struct.unpack("<I", self.data[self.pos : self.pos + 4])[0]
+        num = struct.unpack_from("<I", self.data, self.pos)[0]
         self.pos += 4
         return num
      
     def ReadUint64(self):
-        num = struct.unpack("<Q", self.data[self.pos : self.pos + 8])[0]
+        num = struct.unpack_from("<Q", self.data, self.pos)[0]
         self.pos += 8
         return num
 
@@ -134,14 +155,22 @@ class FileMetaDataListing:
     
     def ReadVarSizeNum(self):
         '''Returns num and bytes_read'''
-        num, bytes_read = SpotlightStore.ReadVarSizeNum(self.data[self.pos : min(self.size, 9 + self.size)])
-        self.pos += bytes_read
-        return num, bytes_read
+        pos = self.pos
+        if pos >= self.var_size_num_limit:
+            raise struct.error('Not enough data to read var sized number @ {}'.format(pos))
+        extra, num = var_size_num_table[self.data[pos]]
+        if extra:
+            end = pos + 1 + extra
+            if end > self.var_size_num_limit:
+                raise struct.error('Not enough data to read var sized number @ {}'.format(pos))
+            num = (num << (extra * 8)) + int.from_bytes(self.data[pos + 1 : end], 'big')
+        self.pos = pos + 1 + extra
+        return num, extra + 1
 
     def ReadStr(self, dont_decode=False):
         '''Returns single string of data and bytes_read'''
         size, pos = self.ReadVarSizeNum()
-        string = self.data[self.pos:self.pos + size]
+        string = self.data[self.pos:self.pos + size].tobytes()
         if string[-1] == 0:
             string = string[:-1] # null character
         if string.endswith(b'\x16\x02'):
@@ -154,7 +183,7 @@ class FileMetaDataListing:
     def ReadStrings(self, dont_decode=False):
         '''Returns array of strings found in data and bytes_read'''
         size, pos = self.ReadVarSizeNum()
-        all_strings_in_one = self.data[self.pos:self.pos+size]
+        all_strings_in_one = self.data[self.pos:self.pos+size].tobytes()
         strings = [x for x in all_strings_in_one.split(b'\x00') if x != b'']
         if dont_decode:
             strings = [x[:-2] if x.endswith(b'\x16\x02') else x for x in strings]
@@ -164,13 +193,13 @@ class FileMetaDataListing:
         return strings, size + pos
 
     def ReadSingleByte(self):
-        single = struct.unpack("<B", self.data[self.pos : self.pos + 1])[0]
+        single = struct.unpack_from("<B", self.data, self.pos)[0]
         self.pos += 1
         return single
 
     def ReadManyBytes(self, count, debug_dont_advance = False):
         '''Returns tuple'''
-        many = struct.unpack("<" + str(count) + "B", self.data[self.pos : self.pos + count])
+        many = struct.unpack_from("<" + str(count) + "B", self.data, self.pos)
         if debug_dont_advance:
             return many
         self.pos += count
@@ -326,7 +355,7 @@ class FileMetaDataListing:
                         strings.append(s)
                     value = ', '.join(strings)
                 else: # string
-                    value = FileMetaDataListing.FilterStrings(self.data[self.pos:self.pos + data_len])
+                    value = FileMetaDataListing.FilterStrings(self.data[self.pos:self.pos + data_len].tobytes())
                     self.pos += data_len
             elif data_type & 0xF == 0x0c:
                 if data_len > 8:
@@ -340,7 +369,7 @@ class FileMetaDataListing:
                     value = self.ReadDate()
             elif data_type & 0xF == 0x0e: # binary data
                 if prop_name == 'kMDStoreProperties':
-                    value = self.data[self.pos:self.pos+data_len].decode('utf8', 'ignore')
+                    value = self.data[self.pos:self.pos+data_len].tobytes().decode('utf8', 'ignore')
                     self.pos += data_len
                 else:
                     value = self.ReadManyBytesReturnHexString(data_len)
@@ -603,7 +632,29 @@ class DbStrMapHeader:
             log.warning("Header signature is different for DbStrMapHeader. Sig=0x{:X}".format(self.sig))
 
 
+# Used by SpotlightStore.ParseMetadataBlocksInParallel(), inherited by forked workers
+_parallel_store = None
+
+def _ParseMetadataBlocksInWorker(job):
+    '''Worker process function, decompresses and parses a list of metadata blocks.
+       Returns list of tuples [ (index, parsed_items), .. ], parsed_items is None 
+       if the block could not be processed.
+    '''
+    results = []
+    for index, block_data in job:
+        try:
+            parsed_items = _parallel_store.ParseMetadataBlock(index, block_data)
+            for pos, md_item in parsed_items:
+                md_item.data = None # memoryview cannot be pickled, not needed after parsing
+            results.append((index, parsed_items))
+        except Exception:
+            log.exception('Error parsing block @ 0x{:X} in worker process'.format(index[1] * 0x1000 + 20))
+            results.append((index, None))
+    return results
+
 class SpotlightStore:
+    blocks_per_job = 8 # Metadata blocks sent to a worker process at a time
+
     def __init__(self, file_pointer):
         self.file = file_pointer
         #self.pos = 0
@@ -902,10 +953,10 @@ class SpotlightStore:
         if hit and (hit[4] == md_item.date_updated): return True
         return False
 
-    def ParseMetadataBlocks(self, output_file, items, items_to_compare=None, process_items_func=None):
-        '''Parses block, return number of items written (after deduplication if items_to_compare!=None)'''
+    def ReadMetadataBlocks(self):
+        '''Generator, reads the metadata blocks listed in block0 indexes,
+           yields tuple (index, block_data)'''
         # Index = [last_id_in_block, offset_index, dest_block_size]
-        total_items_written = 0
         for index in self.block0.indexes:
             #go to offset and parse
             seek_offset = index[1] * 0x1000
@@ -913,141 +964,209 @@ class SpotlightStore:
                 log.error(f'File may be truncated, index seeks ({seek_offset}) outside file size ({self.file_size})!')
                 continue
             self.Seek(seek_offset)
-            block_data = self.ReadFromFile(self.block_size)
-            try:
-                compressed_block = StoreBlock(block_data)
-                if compressed_block.block_type & 0xFF != BlockType.METADATA:
-                    log.error('Expected METADATA block, Unknown block type encountered: 0x{:X}'.format(compressed_block.block_type))
-                    continue
-            except ValueError as ex:
-                log.error('Block read error : ' + str(ex))
-                continue
-            log.debug ("Trying to decompress compressed block @ 0x{:X}".format(index[1] * 0x1000 + 20))
-            
-            try:
-                if compressed_block.block_type & 0x1000 == 0x1000: # LZ4 compression
-                    if block_data[20:24] in [b'bv41', b'bv4-']:
-                        # check for bv41, version 97 in High Sierra has this header (bv41) and footer (bv4$)
-                        # There are often multiple chunks  bv41.....bv41.....bv41.....bv4$
-                        # Sometimes bv4- (uncompressed data) followed by 4 bytes length, then data
-                        chunk_start = 20 # bv41 offset
-                        uncompressed = b''
-                        last_uncompressed = b''
-                        header = block_data[chunk_start:chunk_start + 4]
-                        while (self.block_size > chunk_start) and (header != b'bv4$'):  # b'bv41':
-                            #log.debug("0x{:X} - {}".format(chunk_start, header))
-                            if header == b'bv41':
-                                uncompressed_size, compressed_size = struct.unpack('<II', block_data[chunk_start + 4:chunk_start + 12])
-                                last_uncompressed = lz4.block.decompress(block_data[chunk_start + 12: chunk_start + 12 + compressed_size], uncompressed_size, dict=last_uncompressed)
-                                chunk_start += 12 + compressed_size
-                                uncompressed += last_uncompressed
-                            elif header == b'bv4-':
-                                uncompressed_size = struct.unpack('<I', block_data[chunk_start + 4:chunk_start + 8])[0]
-                                uncompressed += block_data[chunk_start + 8:chunk_start + 8 + uncompressed_size]
-                                chunk_start += 8 + uncompressed_size
-                            else:
-                                log.warning('Unknown compression value @ 0x{:X} - {}'.format(chunk_start, header))
-                            header = block_data[chunk_start:chunk_start + 4]
-                    else:
-                        uncompressed = lz4.block.decompress(block_data[20:compressed_block.logical_size], compressed_block.unknown - 20)
-                elif compressed_block.block_type & 0x2000 == 0x2000: # LZFSE compression seen, also perhaps LZVN
-                    if not lzfse_capable:
-                        log.error('LIBLZFSE library not available for LZFSE decompression, skipping block..')
-                        continue
-                    if block_data[20:23] == b'bvx':
-                        # check for header (bvx1 or bvx2 or bvxn) and footer (bvx$)
-                        chunk_start = 20 # bvx offset
-                        uncompressed = b''
-                        header = block_data[chunk_start:chunk_start + 4]    
+            yield index, self.ReadFromFile(self.block_size)
+
+    def DecompressMetadataBlock(self, index, block_data):
+        '''Returns uncompressed data of metadata block or None if it could not be decompressed'''
+        try:
+            compressed_block = StoreBlock(block_data)
+            if compressed_block.block_type & 0xFF != BlockType.METADATA:
+                log.error('Expected METADATA block, Unknown block type encountered: 0x{:X}'.format(compressed_block.block_type))
+                return None
+        except ValueError as ex:
+            log.error('Block read error : ' + str(ex))
+            return None
+        log.debug ("Trying to decompress compressed block @ 0x{:X}".format(index[1] * 0x1000 + 20))
+
+        uncompressed = b''
+        try:
+            if compressed_block.block_type & 0x1000 == 0x1000: # LZ4 compression
+                if block_data[20:24] in [b'bv41', b'bv4-']:
+                    # check for bv41, version 97 in High Sierra has this header (bv41) and footer (bv4$)
+                    # There are often multiple chunks  bv41.....bv41.....bv41.....bv4$
+                    # Sometimes bv4- (uncompressed data) followed by 4 bytes length, then data
+                    chunk_start = 20 # bv41 offset
+                    uncompressed = b''
+                    last_uncompressed = b''
+                    header = block_data[chunk_start:chunk_start + 4]
+                    while (self.block_size > chunk_start) and (header != b'bv4$'):  # b'bv41':
                         #log.debug("0x{:X} - {}".format(chunk_start, header))
-                        if header in [b'bvx1', b'bvx2', b'bvxn']:
-                            uncompressed_size = struct.unpack('<I', block_data[chunk_start + 4:chunk_start + 8])[0]
-                            uncompressed = liblzfse.decompress(block_data[chunk_start : compressed_block.logical_size])
-                            if len(uncompressed) != uncompressed_size:
-                                log.error('Decompressed size does not match stored value, DecompSize={}, Should_be={}'.format(len(uncompressed), uncompressed_size))
-                        elif header == b'bvx-':
+                        if header == b'bv41':
+                            uncompressed_size, compressed_size = struct.unpack('<II', block_data[chunk_start + 4:chunk_start + 12])
+                            last_uncompressed = lz4.block.decompress(block_data[chunk_start + 12: chunk_start + 12 + compressed_size], uncompressed_size, dict=last_uncompressed)
+                            chunk_start += 12 + compressed_size
+                            uncompressed += last_uncompressed
+                        elif header == b'bv4-':
                             uncompressed_size = struct.unpack('<I', block_data[chunk_start + 4:chunk_start + 8])[0]
-                            uncompressed = block_data[chunk_start + 8:chunk_start + 8 + uncompressed_size]
+                            uncompressed += block_data[chunk_start + 8:chunk_start + 8 + uncompressed_size]
+                            chunk_start += 8 + uncompressed_size
                         else:
                             log.warning('Unknown compression value @ 0x{:X} - {}'.format(chunk_start, header))
+                        header = block_data[chunk_start:chunk_start + 4]
+                else:
+                    uncompressed = lz4.block.decompress(block_data[20:compressed_block.logical_size], compressed_block.unknown - 20)
+            elif compressed_block.block_type & 0x2000 == 0x2000: # LZFSE compression seen, also perhaps LZVN
+                if not lzfse_capable:
+                    log.error('LIBLZFSE library not available for LZFSE decompression, skipping block..')
+                    return None
+                if block_data[20:23] == b'bvx':
+                    # check for header (bvx1 or bvx2 or bvxn) and footer (bvx$)
+                    chunk_start = 20 # bvx offset
+                    uncompressed = b''
+                    header = block_data[chunk_start:chunk_start + 4]    
+                    #log.debug("0x{:X} - {}".format(chunk_start, header))
+                    if header in [b'bvx1', b'bvx2', b'bvxn']:
+                        uncompressed_size = struct.unpack('<I', block_data[chunk_start + 4:chunk_start + 8])[0]
+                        uncompressed = liblzfse.decompress(block_data[chunk_start : compressed_block.logical_size])
+                        if len(uncompressed) != uncompressed_size:
+                            log.error('Decompressed size does not match stored value, DecompSize={}, Should_be={}'.format(len(uncompressed), uncompressed_size))
+                    elif header == b'bvx-':
+                        uncompressed_size = struct.unpack('<I', block_data[chunk_start + 4:chunk_start + 8])[0]
+                        uncompressed = block_data[chunk_start + 8:chunk_start + 8 + uncompressed_size]
                     else:
-                        uncompressed = lz4.block.decompress(block_data[20:compressed_block.logical_size], compressed_block.unknown - 20)
-                else: # zlib compression
-                    #compressed_size = compressed_block.logical_size - 20
-                    uncompressed = zlib.decompress(block_data[20:compressed_block.logical_size])
-            except (ValueError,  lz4.block.LZ4BlockError, liblzfse.error) as ex:
-                log.error("Decompression error for block @ 0x{:X}\r\n{}".format(index[1] * 0x1000 + 20, str(ex)))
-                if len(uncompressed) == 0: continue
-            
-            ## Now process it!!
+                        log.warning('Unknown compression value @ 0x{:X} - {}'.format(chunk_start, header))
+                else:
+                    uncompressed = lz4.block.decompress(block_data[20:compressed_block.logical_size], compressed_block.unknown - 20)
+            else: # zlib compression
+                #compressed_size = compressed_block.logical_size - 20
+                uncompressed = zlib.decompress(block_data[20:compressed_block.logical_size])
+        except (ValueError,  lz4.block.LZ4BlockError, liblzfse.error) as ex:
+            log.error("Decompression error for block @ 0x{:X}\r\n{}".format(index[1] * 0x1000 + 20, str(ex)))
+            if len(uncompressed) == 0: return None
+        return uncompressed
+
+    def ParseMetadataBlock(self, index, block_data):
+        '''Decompresses and parses items of a single metadata block.
+           Returns list of tuples [ (pos, md_item), .. ]
+        '''
+        parsed_items = []
+        uncompressed = self.DecompressMetadataBlock(index, block_data)
+        if uncompressed is None:
+            return parsed_items
+        pos = 0
+        meta_size = len(uncompressed)
+        uncompressed_view = memoryview(uncompressed) # items are slices of this, avoids a copy per item
+        if self.version == 1:
+            while (pos < meta_size):
+                id = struct.unpack("<Q", uncompressed[pos:pos+8])[0]
+                item_size_1 = struct.unpack("<I", uncompressed[pos+8:pos+12])[0]
+                item_size_2 = struct.unpack("<I", uncompressed[pos+12:pos+16])[0]
+                md_item = FileMetaDataListing(pos + 16, uncompressed_view[pos + 16 : pos + 16 + item_size_2], item_size_2 - 16)
+                try:
+                    md_item.ParseItemV1(self.properties, id)
+                    parsed_items.append((pos, md_item))
+                except:
+                    log.exception('Error trying to process item @ block {:X} offset {}'.format(index[1] * 0x1000 + 20, pos))
+                pos += item_size_2
+        else: # ver = 2
+            while (pos < meta_size):
+                item_size = struct.unpack("<I", uncompressed[pos:pos+4])[0]
+                md_item = FileMetaDataListing(pos + 4, uncompressed_view[pos + 4 : pos + 4 + item_size], item_size)
+                try:
+                    md_item.ParseItem(self.properties, self.categories, self.indexes_1, self.indexes_2)
+                    parsed_items.append((pos, md_item))
+                except:
+                    log.exception('Error trying to process item @ block {:X} offset {}'.format(index[1] * 0x1000 + 20, pos))
+                pos += item_size + 4
+        return parsed_items
+
+    def ParseMetadataBlocksInParallel(self, num_workers):
+        '''Generator, decompresses and parses metadata blocks in worker processes,
+           yields tuple (index, parsed_items) in the same order as blocks are read.
+           Blocks are read here, workers get the properties, categories and indexes
+           from this object, which they inherit (fork) and do not read the file.
+        '''
+        global _parallel_store
+        mp_context = multiprocessing.get_context('fork')
+        log.info('Parsing {} metadata blocks using {} worker processes'.format(len(self.block0.indexes), num_workers))
+        _parallel_store = self
+        try:
+            with mp_context.Pool(num_workers) as pool:
+                pending = collections.deque() # Results in block order, a few jobs ahead to limit memory usage
+                job = []
+                for index, block_data in self.ReadMetadataBlocks():
+                    job.append((index, block_data))
+                    if len(job) == SpotlightStore.blocks_per_job:
+                        pending.append((job, pool.apply_async(_ParseMetadataBlocksInWorker, [job])))
+                        job = []
+                    if len(pending) >= num_workers * 2:
+                        yield from self._GetParallelResults(*pending.popleft())
+                if job:
+                    pending.append((job, pool.apply_async(_ParseMetadataBlocksInWorker, [job])))
+                while pending:
+                    yield from self._GetParallelResults(*pending.popleft())
+        finally:
+            _parallel_store = None
+
+    def _GetParallelResults(self, job, async_result):
+        '''Returns list of (index, parsed_items) for a job, blocks that failed 
+           in the worker process are parsed again here'''
+        try:
+            results = async_result.get()
+        except Exception: # Results could not be returned from worker
+            log.exception('Error getting results from worker process, parsing its blocks here')
+            results = [(index, None) for index, block_data in job]
+        for pos, (index, parsed_items) in enumerate(results):
+            if parsed_items is None:
+                log.info('Parsing block @ 0x{:X} again, as it failed in worker process'.format(index[1] * 0x1000 + 20))
+                results[pos] = (index, self.ParseMetadataBlock(index, job[pos][1]))
+        return results
+
+    def CanParseInParallel(self, num_workers):
+        '''Returns True if blocks can be parsed in worker processes'''
+        if num_workers < 2 or len(self.block0.indexes) < 2:
+            return False
+        if multiprocessing.current_process().daemon: # daemon processes cannot have children
+            return False
+        try:
+            # Workers inherit this object (with its property/category/index dictionaries), so fork is needed
+            multiprocessing.get_context('fork')
+        except ValueError:
+            return False
+        return True
+
+    def ParseMetadataBlocks(self, output_file, items, items_to_compare=None, process_items_func=None, num_workers=1):
+        '''Parses block, return number of items written (after deduplication if items_to_compare!=None)
+           If num_workers > 1, blocks are decompressed and parsed in that many worker processes.
+           If output_file is None, items are not printed (only passed to process_items_func).
+        '''
+        total_items_written = 0
+        if self.CanParseInParallel(num_workers):
+            parsed_blocks = self.ParseMetadataBlocksInParallel(num_workers)
+        else:
+            parsed_blocks = ((index, self.ParseMetadataBlock(index, block_data)) for index, block_data in self.ReadMetadataBlocks())
+
+        for index, parsed_items in parsed_blocks:
             items_in_block = []
-            pos = 0
-            count = 0
-            meta_size = len(uncompressed)
-            if self.version == 1:
-                while (pos < meta_size):
-                    id = struct.unpack("<Q", uncompressed[pos:pos+8])[0]
-                    item_size_1 = struct.unpack("<I", uncompressed[pos+8:pos+12])[0]
-                    item_size_2 = struct.unpack("<I", uncompressed[pos+12:pos+16])[0]
-                    md_item = FileMetaDataListing(pos + 16, uncompressed[pos + 16 : pos + 16 + item_size_2], item_size_2 - 16)
-                    try:
-                        md_item.ParseItemV1(self.properties, id)
-                        if items_to_compare and self.ItemExistsInDictionary(items_to_compare, md_item): pass # if md_item exists in compare_dict, skip it, else add
-                        else:
-                            items_in_block.append(md_item)
-                            total_items_written += 1
-                            name = md_item.GetFileName()
-                            existing_item = items.get(md_item.id, None)
-                            if existing_item != None:
-                                log.warning('Item already present id={}, name={}, existing_name={}'.format(md_item.id, name, existing_item[2]))
-                                if existing_item[1] != md_item.parent_id:
-                                    log.warning("Repeat item has different parent_id, existing={}, new={}".format(existing_item[1], md_item.parent_id))
-                                if name != '------NONAME------': # got a real name
-                                    if existing_item[2] == '------NONAME------':
-                                        existing_item[2] = name
-                                    else:  # has a valid name
-                                        if existing_item[2] != name:
-                                            log.warning("Repeat item has different name, existing={}, new={}".format(existing_item[2], name))
-                            else: # Not adding repeat elements
-                                items[md_item.id] = [md_item.id, md_item.parent_id, md_item.GetFileName(), None, md_item.date_updated] # id, parent_id, name, path, date
-                    except:
-                        log.exception('Error trying to process item @ block {:X} offset {}'.format(index[1] * 0x1000 + 20, pos))
-                    pos += item_size_2
-                    count += 1
-            else: # ver = 2
-                while (pos < meta_size):
-                    item_size = struct.unpack("<I", uncompressed[pos:pos+4])[0]
-                    md_item = FileMetaDataListing(pos + 4, uncompressed[pos + 4 : pos + 4 + item_size], item_size)
-                    try:
-                        md_item.ParseItem(self.properties, self.categories, self.indexes_1, self.indexes_2)
-                        if items_to_compare and self.ItemExistsInDictionary(items_to_compare, md_item): pass # if md_item exists in compare_dict, skip it, else add
-                        else:
-                            items_in_block.append(md_item)
-                            total_items_written += 1
-                            name = md_item.GetFileName()
-                            existing_item = items.get(md_item.id, None)
-                            if existing_item != None:
-                                log.warning('Item already present id={}, name={}, existing_name={}'.format(md_item.id, name, existing_item[2]))
-                                if existing_item[1] != md_item.parent_id:
-                                    log.warning("Repeat item has different parent_id, existing={}, new={}".format(existing_item[1], md_item.parent_id))
-                                if name != '------NONAME------': # got a real name
-                                    if existing_item[2] == '------NONAME------':
-                                        existing_item[2] = name
-                                    else:  # has a valid name
-                                        if existing_item[2] != name:
-                                            log.warning("Repeat item has different name, existing={}, new={}".format(existing_item[2], name))
-                            else: # Not adding repeat elements
-                                items[md_item.id] = [md_item.id, md_item.parent_id, md_item.GetFileName(), None, md_item.date_updated] # id, parent_id, name, path, date
-                    except:
-                        log.exception('Error trying to process item @ block {:X} offset {}'.format(index[1] * 0x1000 + 20, pos))
-                    pos += item_size + 4
-                    count += 1
+            for pos, md_item in parsed_items:
+                try:
+                    if items_to_compare and self.ItemExistsInDictionary(items_to_compare, md_item): pass # if md_item exists in compare_dict, skip it, else add
+                    else:
+                        items_in_block.append(md_item)
+                        total_items_written += 1
+                        name = md_item.GetFileName()
+                        existing_item = items.get(md_item.id, None)
+                        if existing_item != None:
+                            log.warning('Item already present id={}, name={}, existing_name={}'.format(md_item.id, name, existing_item[2]))
+                            if existing_item[1] != md_item.parent_id:
+                                log.warning("Repeat item has different parent_id, existing={}, new={}".format(existing_item[1], md_item.parent_id))
+                            if name != '------NONAME------': # got a real name
+                                if existing_item[2] == '------NONAME------':
+                                    existing_item[2] = name
+                                else:  # has a valid name
+                                    if existing_item[2] != name:
+                                        log.warning("Repeat item has different name, existing={}, new={}".format(existing_item[2], name))
+                        else: # Not adding repeat elements
+                            items[md_item.id] = [md_item.id, md_item.parent_id, md_item.GetFileName(), None, md_item.date_updated] # id, parent_id, name, path, date
+                except:
+                    log.exception('Error trying to process item @ block {:X} offset {}'.format(index[1] * 0x1000 + 20, pos))
 
             if process_items_func:
                 process_items_func(items_in_block, self.is_ios_store)
 
-            for md_item in items_in_block:
-                md_item.Print(output_file)
+            if output_file:
+                for md_item in items_in_block:
+                    md_item.Print(output_file)
                 
         return total_items_written
 
@@ -1104,36 +1223,96 @@ class SpotlightStore:
                 raise ValueError("Block size mismatch!")
             self.Seek(self.pos + self.block_size)
         
+class FullPathResolver:
+    '''Builds full paths of items by walking up their parent chain (without recursion).
+       The path of every item resolved on the way is saved, so each item is only
+       resolved once. Here items_list is dictionary, 
+       item = [id, parent_id, name, full_path, date]
+    '''
+    def __init__(self, items_list):
+        self.items_list = items_list
+        self.paths = {} # Key = id, Val = full path
+
+    def _GetKnownPath(self, item):
+        '''Returns path if it needs no lookup of parents, else None'''
+        path = self.paths.get(item[0], None) or item[3]
+        if path:
+            return path
+        if item[0] == 1: #is this plist?
+            return 'plist'
+        if item[0] == 2: # This is root
+            return item[2] if item[2] else '/'
+        return None
+
+    def GetFullPath(self, item):
+        '''Return full path to given item'''
+        path = self._GetKnownPath(item)
+        if path:
+            return path
+        # Usual case, parent's path is already known
+        search_id = item[1] if item[1] != 0 else 2
+        path = self.paths.get(search_id, None)
+        if path:
+            path = (path + '/' + item[2]) if path != '/' else (path + item[2])
+            self.paths[item[0]] = path
+            return path
+        # Walk up till an item with a known path is found
+        chain = [] # items whose path needs to be built, item first
+        chain_ids = set()
+        current = item
+        while True:
+            chain.append(current)
+            chain_ids.add(current[0])
+            search_id = current[1]
+            if search_id == 0:
+                search_id = 2 # root
+            found_item = self.items_list.get(search_id, None)
+            if found_item is None:
+                if search_id == 2: # root
+                    path = ('/' + current[2]) if current[2] else '/'
+                else:
+                    log.debug ('Err, could not find path for id {} '.format(search_id))
+                    path = '..NOT-FOUND../' + current[2]
+                break
+            if found_item[0] in chain_ids:
+                log.debug ('Err, loop found in parents of id {} '.format(found_item[0]))
+                path = '..NOT-FOUND../' + current[2]
+                break
+            path = self._GetKnownPath(found_item)
+            if path:
+                self.paths[found_item[0]] = path
+                path = (path + '/' + current[2]) if path != '/' else (path + current[2])
+                break
+            current = found_item
+        # Build paths back down the chain
+        self.paths[current[0]] = path
+        for child in reversed(chain[:-1]):
+            path = (path + '/' + child[2]) if path != '/' else (path + child[2])
+            self.paths[child[0]] = path
+        return path
+
+    def GetFullPaths(self, items):
+        '''Yields tuple (id, full_path) for all items in dictionary 'items' that have a name'''
+        for k, v in items.items():
+            if v[2]:
+                yield k, self.GetFullPath(v)
+
 def RecursiveGetFullPath(item, items_list):
-    '''Return full path to given item, here items_list is dictionary'''
-    # item = [id, parent_id, name, full_path, date]
-    if item[3]:
-        return item[3]
-    if item[0] == 1: #is this plist?
-        return 'plist'
-    name = item[2]
-    if item[0] == 2: # This is root
-        if name == '':
-            name = '/'
-        item[3] = name
-        return name
-    search_id = item[1]
-
-    if search_id == 0:
-        search_id = 2 # root
-    ret_path = ''
-    found_item = items_list.get(search_id, None)
-
-    if found_item != None:
-        parent_path = RecursiveGetFullPath(found_item, items_list)
-        ret_path = (parent_path + '/' + name) if parent_path != '/' else (parent_path + name)
-        found_item[3] = parent_path
-    elif search_id == 2: # root
-        ret_path = ('/' + name) if name else '/'
-    else:
-        log.debug ('Err, could not find path for id {} '.format(search_id))
-        ret_path = '..NOT-FOUND../' + name
-    return ret_path
+    '''Return full path to given item, here items_list is dictionary.
+       To get paths of many items, use FullPathResolver, which is much faster.
+    '''
+    return FullPathResolver(items_list).GetFullPath(item)
+
+def WriteFullPathsFile(output_paths_file, id_path_list):
+    '''Writes (id, full_path) items to the open tsv file 'output_paths_file', in batches'''
+    lines = []
+    for k, fullpath in id_path_list:
+        lines.append(str(k) + '\t' + fullpath + '\r\n')
+        if len(lines) >= 10000:
+            output_paths_file.write(''.join(lines).encode('utf-8', 'backslashreplace'))
+            lines = []
+    if lines:
+        output_paths_file.write(''.join(lines).encode('utf-8', 'backslashreplace'))
 
 def GetFileData(path):
     data = b''
@@ -1157,7 +1336,7 @@ def GetMapDataOffsetHeader(input_folder, id):
 
     return (map_data, offsets_data, header_data)
 
-def ProcessStoreDb(input_file_path, output_path, file_name_prefix='store'):
+def ProcessStoreDb(input_file_path, output_path, file_name_prefix='store', num_workers=1):
     '''Main processing function'''
 
     items = {}
@@ -1212,19 +1391,14 @@ def ProcessStoreDb(input_file_path, output_path, file_name_prefix='store'):
         log.info("Creating output file {}".format(output_path_data))
 
         with open(output_path_data, 'wb') as output_file:
-            store.ParseMetadataBlocks(output_file, items, None, None)
+            store.ParseMetadataBlocks(output_file, items, None, None, num_workers)
 
         if create_full_paths_output_file:
             log.info("Creating output file {}".format(output_path_full_paths))
 
             with open(output_path_full_paths, 'wb') as output_paths_file:
                 output_paths_file.write("Inode_Number\tFull_Path\r\n".encode('utf-8'))
-                for k, v in items.items():
-                    name = v[2]
-                    if name:
-                        fullpath = RecursiveGetFullPath(v, items)
-                        to_write = str(k) + '\t' + fullpath + '\r\n'
-                        output_paths_file.write(to_write.encode('utf-8', 'backslashreplace'))
+                WriteFullPathsFile(output_paths_file, FullPathResolver(items).GetFullPaths(items))
 
     except Exception as ex:
         log.exception('')
@@ -1257,6 +1431,7 @@ if __name__ == "__main__":
     arg_parser.add_argument('input_path', help="Path to 'store' or '.store' file (the Spotlight db)")
     arg_parser.add_argument('output_folder', help='Path to output folder')
     arg_parser.add_argument('-p', '--output_prefix', help='Prefix for output file names')
+    arg_parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes to parse metadata blocks (default 1)')
 
     args = arg_parser.parse_args()
 
@@ -1280,4 +1455,4 @@ if __name__ == "__main__":
         log.error("Input file'{}' does not exist".format(args.input_path))
         sys.exit()
 
-    ProcessStoreDb(args.input_path, output_folder, output_file_prefix)
+    ProcessStoreDb(args.input_path, output_folder, output_file_prefix, args.workers)
@@ -0,0 +1,67 @@
+'''
+   Copyright (c) 2017 Yogesh Khatri
+
+   This file is part of mac_apt (macOS Artifact Parsing Tool).
+   Usage or distribution of this software/code is subject to the
+   terms of the MIT License.
+
+   Shared by plugins that parse files in worker processes. Workers are
+   forked, so they inherit the module globals a plugin sets up before
+   starting them.
+'''
+
+import logging
+import multiprocessing
+import shutil
+import tempfile
+
+log = logging.getLogger('MAIN.HELPERS.WORKER_PROCESSES')
+
+# Number of worker processes a plugin may use to parse its files in parallel,
+# 1 = no parallel parsing. Set by mac_apt's --parse_workers option.
+num_parse_workers = 1
+
+def GetNumParseWorkers(num_items=None):
+    '''Returns number of worker processes to use for parsing num_items (files,
+       blocks, ..) in parallel, or 1 if a pool of forked workers cannot be
+       started here (not wanted, in a daemon process or fork not supported).
+    '''
+    num_workers = num_parse_workers if num_items is None else min(num_parse_workers, num_items)
+    if num_workers < 2:
+        return 1
+    if multiprocessing.current_process().daemon: # daemon processes cannot have children
+        return 1
+    try:
+        multiprocessing.get_context('fork')
+    except ValueError:
+        return 1
+    return num_workers
+
+class WorkerPool:
+    '''Pool of forked worker processes, with a temp folder (in output_path) for
+       workers to save their results in. Set up the globals workers need (like
+       temp_folder) before calling Start(), as workers are forked then. Close()
+       terminates the workers and deletes the temp folder, use in a 'with'
+       statement or call it.
+    '''
+    def __init__(self, output_path, temp_folder_prefix):
+        self.temp_folder = tempfile.mkdtemp(prefix=temp_folder_prefix, dir=output_path)
+        self.pool = None
+
+    def Start(self, num_workers):
+        '''Starts the worker processes, returns the multiprocessing Pool'''
+        self.pool = multiprocessing.get_context('fork').Pool(num_workers)
+        return self.pool
+
+    def Close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        shutil.rmtree(self.temp_folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
@@ -9,9 +9,12 @@
 
 import binascii
 import collections
+import copy
 import csv
 import logging
 import os
+import pathlib
+import pickle
 import sqlite3
 import sys
 import xlsxwriter
@@ -21,6 +24,21 @@ from plugins.helpers.common import *
 
 log = logging.getLogger('MAIN.HELPERS.WRITER')
 
+# When plugins run in worker processes (mac_apt --jobs), writes to the shared outputs
+# (main db & xlsx) are sent over this queue to the main process. See SetWriterQueue()
+_writer_queue = None
+_shared_db_path = ''
+_writer_count = 0
+
+def SetWriterQueue(queue, shared_db_path):
+    '''Called in a plugin worker process. After this, DataWriters that write to
+       the xlsx or to 'shared_db_path' send their data over 'queue' to be
+       written by a QueuedWritesHandler in the main process.
+    '''
+    global _writer_queue, _shared_db_path
+    _writer_queue = queue
+    _shared_db_path = shared_db_path
+
 class DataType(IntEnum):
     INTEGER = 1 # Whole Numbers
     REAL    = 2 # Floating point numbers
@@ -32,6 +50,9 @@ class DataWriter:
 
     def FinishWrites(self):
         '''This must be called to properly close files'''
+        if self.queue:
+            self.queue.put(('writer_finish', self.writer_id))
+            return
         if self.csv: self.csv_writer.Cleanup()
         if self.tsv: self.tsv_writer.Cleanup()
         if self.sql: self.sql_writer.CloseDb()
@@ -66,6 +87,17 @@ class DataWriter:
         self.sql_db_path = output_params.output_db_path
         self.PYTHON_VER = sys.version_info.major
         self.cols_with_blobs = None
+        self.queue = None
+
+        if _writer_queue is not None and (output_params.write_xlsx or output_params.output_db_path == _shared_db_path):
+            global _writer_count
+            _writer_count += 1
+            self.queue = _writer_queue
+            self.writer_id = (os.getpid(), _writer_count)
+            params = (output_params.output_path, output_params.write_csv, output_params.write_tsv, 
+                      output_params.write_sql, output_params.write_xlsx, output_params.output_db_path)
+            self.queue.put(('writer_open', self.writer_id, params, name, list(collections.OrderedDict(column_info).items()), artifact_source))
+            return
 
         if output_params.write_sql:
             self.sql = True
@@ -95,6 +127,18 @@ class DataWriter:
         self.IdentifyColumnsWithBlobs()
         self.num_columns = len(self.column_info)
   
+    def RunSqlFunction(self, func, *args):
+        '''Calls func(sql_writer, *args) with this writer's SqliteWriter, if it has one.
+           For a writer in a plugin worker process, the call is sent over the queue and
+           made in the main process after the rows written before it, so func must be
+           a module level function or a class method (picklable).
+        '''
+        if self.queue:
+            self.queue.put(('writer_call', self.writer_id, func, args))
+            return
+        if self.sql_writer:
+            func(self.sql_writer, *args)
+
     def IdentifyColumnsWithBlobs(self):
         '''Create a list of names and indexes of columns with type BLOB'''
         i = 0
@@ -127,6 +171,10 @@ class DataWriter:
 
     def WriteRow(self, row):
         '''Write a single row of data, 'row' can be either a list or dictionary'''
+        if self.queue:
+            self.queue.put(('writer_row', self.writer_id, pickle.dumps(row, pickle.HIGHEST_PROTOCOL)))
+            self.row_count += 1
+            return
         if self.row_count == 0: #Write Header row
             self.WriteHeaders()
         row_type = type(row)
@@ -176,6 +224,10 @@ class DataWriter:
         row_len = len(rows)
         if row_len == 0: # Nothing to write!
             return
+        if self.queue: # Pickled now, as plugins may reuse the list once this returns
+            self.queue.put(('writer_rows', self.writer_id, pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)))
+            self.row_count += row_len
+            return
         if self.row_count == 0: #Write Header row
             self.WriteHeaders()
         row_type = type(rows[0])
@@ -241,12 +293,17 @@ class SqliteWriter:
         self.column_info  = None
         self.executemany_querys = []
         self.executemany_query  = ''
+        self.bulk_insert_mode = False # No commits, fast (unsafe) pragmas, see BeginBulkInsert()
+        self.deferred_queries = []
     
-    def OpenSqliteDb(self, filepath):
+    def OpenSqliteDb(self, filepath, read_only=False):
         '''Open an existing db or create it'''
         self.filepath = filepath
         try:
-            self.conn = sqlite3.connect(self.filepath)
+            if read_only:
+                self.conn = sqlite3.connect(pathlib.Path(self.filepath).as_uri() + '?mode=ro', uri=True)
+            else:
+                self.conn = sqlite3.connect(self.filepath)
             #self.conn.execute('PRAGMA SYNCHRONOUS=OFF;') # slightly faster!
         except (OSError, sqlite3.Error) as ex:
             log.error('Failed to open/create sqlite db at path {}'.format(filepath))
@@ -284,7 +341,7 @@ class SqliteWriter:
                 self.conn.row_factory = sqlite3.Row
             cursor = self.conn.cursor()
             cursor = self.conn.execute(query)
-            if writing: 
+            if writing and not self.bulk_insert_mode: 
                 self.conn.commit()
             success = True
         except sqlite3.Error as ex:
@@ -339,7 +396,8 @@ class SqliteWriter:
             cursor = self.conn.cursor()
             query = self._CraftCreateStatement(table_name, column_info_extra_keywords)
             cursor.execute(query)
-            self.conn.commit()
+            if not self.bulk_insert_mode:
+                self.conn.commit()
             self.executemany_query = self._CraftExecuteManyQuery(table_name, column_info, column_info_extra_keywords)
         except sqlite3.Error as ex:
             if  str(ex).find('table "{}" already exists'.format(table_name)) >= 0:
@@ -350,7 +408,8 @@ class SqliteWriter:
                     cursor = self.conn.cursor()
                     query = self._CraftCreateStatement(self.table_name, column_info_extra_keywords)
                     cursor.execute(query)
-                    self.conn.commit()
+                    if not self.bulk_insert_mode:
+                        self.conn.commit()
                     self.executemany_query = self._CraftExecuteManyQuery(self.table_name, column_info, column_info_extra_keywords)
                     return
                 except sqlite3.Error as ex:
@@ -396,12 +455,42 @@ class SqliteWriter:
                     log.exception("Could not find table name {}".format(table_name))
                     raise ex
             cursor.executemany(query, rows)
-            self.conn.commit()
+            if not self.bulk_insert_mode:
+                self.conn.commit()
         except (sqlite3.Error, OverflowError) as ex:
             log.error(str(ex))
             log.exception("error writing to table " + table_name if table_name else self.table_name)
             #raise ex
 
+    def Commit(self):
+        try:
+            self.conn.commit()
+        except sqlite3.Error as ex:
+            log.exception('Commit failed')
+
+    def BeginBulkInsert(self):
+        '''Use for writing large amounts of data to a new db. Sets pragmas for fast
+           writing (not safe if program crashes), and stops committing after every
+           write, call Commit() to end a transaction. Queries added to 
+           deferred_queries (like index creation) are run in EndBulkInsert().
+        '''
+        for pragma in ('journal_mode=MEMORY', 'synchronous=OFF', 'cache_size=-262144', 'temp_store=MEMORY'): # cache is 256MB
+            self.RunQuery('PRAGMA ' + pragma)
+        self.bulk_insert_mode = True
+
+    def EndBulkInsert(self):
+        '''Commit, run deferred queries and restore default (safe) pragmas'''
+        self.Commit()
+        for query in self.deferred_queries:
+            success, cursor, error = self.RunQuery(query)
+            if not success:
+                log.error('Error running deferred query: ' + error)
+        self.Commit()
+        self.deferred_queries = []
+        self.bulk_insert_mode = False
+        for pragma in ('journal_mode=DELETE', 'synchronous=FULL', 'cache_size=-2000', 'temp_store=DEFAULT'):
+            self.RunQuery('PRAGMA ' + pragma)
+
     def CloseDb(self):
         if self.conn != None:
             if self.async_buffer:
@@ -709,6 +798,58 @@ def WriteList(data_description, data_name, data_list, data_type_info, output_par
         log.error ("Failed to initilize data writer")
         log.exception ("Error details")
 
+class ExportLogQueueWriter:
+    '''Stands in for the export log SqliteWriter in plugin worker processes, 
+       rows are sent over the queue to a QueuedWritesHandler
+    '''
+    def __init__(self, queue):
+        self.queue = queue
+
+    def WriteRow(self, row, table_name=None):
+        self.queue.put(('export_log', row))
+
+class QueuedWritesHandler:
+    '''Used in the main process to do the writing for plugin worker processes,
+       which send their data over the queue set with SetWriterQueue()
+    '''
+    def __init__(self, output_params):
+        self.output_params = output_params
+        self.writers = {} # key=writer_id, value=DataWriter
+
+    def HandleMessage(self, message):
+        '''Handles one message from the queue. Returns False if it was not a writer message'''
+        message_type = message[0]
+        try:
+            if message_type == 'writer_rows':
+                self.writers[message[1]].WriteRows(pickle.loads(message[2]))
+            elif message_type == 'writer_row':
+                self.writers[message[1]].WriteRow(pickle.loads(message[2]))
+            elif message_type == 'writer_call':
+                self.writers[message[1]].RunSqlFunction(message[2], *message[3])
+            elif message_type == 'export_log':
+                self.output_params.export_log_sqlite.WriteRow(message[1])
+            elif message_type == 'writer_open':
+                writer_id, params, name, column_info, artifact_source = message[1:]
+                output_params = copy.copy(self.output_params)
+                output_params.output_path, output_params.write_csv, output_params.write_tsv, \
+                    output_params.write_sql, output_params.write_xlsx, output_params.output_db_path = params
+                self.writers[writer_id] = DataWriter(output_params, name, column_info, artifact_source)
+            elif message_type == 'writer_finish':
+                writer = self.writers.pop(message[1], None)
+                if writer:
+                    writer.FinishWrites()
+            else:
+                return False
+        except (KeyError, ValueError, OSError, xlsxwriter.exceptions.XlsxWriterException, sqlite3.Error):
+            log.exception(f"Error writing data sent by plugin worker ({message_type})")
+        return True
+
+    def FinishWrites(self):
+        '''Closes any writers that plugins did not finish'''
+        for writer in self.writers.values():
+            writer.FinishWrites()
+        self.writers = {}
+
 class ChunkedDataWriter:
     '''Plugins should use this class when writing millions of rows to avoid MemoryError situations.
        Ideally write no more than 500K rows at a time. Syntax is the same as WriteList() function.
@@ -7,12 +7,14 @@
    
 '''
 
+import contextlib
 import logging
 import os
 
 from plugins.helpers import spotlight_parser as spotlight_parser
 from plugins.helpers.macinfo import *
 from plugins.helpers.spotlight_filter import create_views_for_ios_db
+from plugins.helpers.worker_processes import GetNumParseWorkers
 from plugins.helpers.writer import *
 
 __Plugin_Name = "SPOTLIGHT"
@@ -34,6 +36,10 @@ log = logging.getLogger('MAIN.' + __Plugin_Name) # Do not rename or remove this
 
 writer = None
 mac_info_obj = None
+# Set to True (or use mac_apt's --spotlight_sqlite_only option) to only write store items and paths
+# to Sqlite, in bulk transactions with indexes created at the end. The <prefix>_data.txt dump and 
+# <prefix>_fullpaths.tsv files are not written.
+sqlite_only_output = False
 spotlight_parser.log = logging.getLogger('MAIN.' + __Plugin_Name + '.SPOTLIGHT_PARSER')
     
 def ProcessStoreItem(item, id_as_hex):
@@ -201,7 +207,7 @@ def ProcessStoreDb(input_file_path, input_file, output_path, output_params, item
             log.info("Creating output folder for spotlight at {}".format(output_path))
             os.makedirs(output_path)
         
-        with open(output_path_data, 'wb') as output_file:
+        with (contextlib.nullcontext() if sqlite_only_output else open(output_path_data, 'wb')) as output_file:
             output_paths_file = None
             store = spotlight_parser.SpotlightStore(input_file)
             if store.is_ios_store: # The properties, categories and indexes must be stored in external files
@@ -226,8 +232,11 @@ def ProcessStoreDb(input_file_path, input_file, output_path, output_params, item
                 store.ReadPageIndexesAndOtherDefinitions()
             ## create db, write table with fields.
             out_params = CopyOutputParams(output_params)
-            if limit_output_types and (store.block0.item_count > 500): # Large db, limit to sqlite output
-                log.warning('Since the spotlight database is large, only Sqlite output will be written!')
+            if sqlite_only_output or (limit_output_types and (store.block0.item_count > 500)): # Large db, limit to sqlite output
+                if sqlite_only_output:
+                    log.info('Only Sqlite output will be written for spotlight (sqlite_only_output is set)')
+                else:
+                    log.warning('Since the spotlight database is large, only Sqlite output will be written!')
                 out_params.write_xlsx = False
                 out_params.write_csv = False
                 out_params.write_tsv = False
@@ -241,35 +250,50 @@ def ProcessStoreDb(input_file_path, input_file, output_path, output_params, item
                 log.exception ("Failed to initilize data writer")
                 return None
 
-            total_items_parsed = store.ParseMetadataBlocks(output_file, items, items_to_compare, ProcessStoreItems)
-            writer.FinishWrites()
+            if sqlite_only_output:
+                BeginBulkWrites(writer)
+            total_items_parsed = store.ParseMetadataBlocks(output_file, items, items_to_compare, ProcessStoreItems, GetNumParseWorkers())
+            if sqlite_only_output:
+                EndBulkWrites(writer, 'ID_hex' if store.is_ios_store else 'ID')
 
             if total_items_parsed == 0:
                 log.debug('Nothing was parsed from this file!')
             # create Views in ios/user style db
             if store.is_ios_store and (total_items_parsed > 0):
-                create_views_for_ios_db(writer.sql_writer.filepath, writer.sql_writer.table_name)
+                writer.RunSqlFunction(CreateViewsForIosDb)
+            writer.FinishWrites()
             
             # Write Paths db as tsv
             if (not store.is_ios_store) and (not store.version==1) and (not no_path_file):
                 path_type_info = [ ('ID',DataType.INTEGER),('FullPath',DataType.TEXT) ]
                 fullpath_writer = DataWriter(out_params, "Spotlight-" + file_name_prefix + '-paths', path_type_info, input_file_path)
-                with open(output_path_full_paths, 'wb') as output_paths_file:
-                    log.info('Inodes and Path information being written to {}'.format(output_path_full_paths))
-                    output_paths_file.write(b"Inode_Number\tFull_Path\r\n")
-                    if items_to_compare: 
-                        items_to_compare.update(items) # This updates items_to_compare ! 
-                        WriteFullPaths(items, items_to_compare, output_paths_file, fullpath_writer)
-                    else:
-                        WriteFullPaths(items, items, output_paths_file, fullpath_writer)
-                    if out_params.write_sql: 
-                        CreateViewAndIndexes(data_type_info, fullpath_writer.sql_writer, file_name_prefix)
+                if items_to_compare: 
+                    items_to_compare.update(items) # This updates items_to_compare ! 
+                    all_items = items_to_compare
+                else:
+                    all_items = items
+                if sqlite_only_output:
+                    log.info('Inodes and Path information being written to Sqlite only')
+                    BeginBulkWrites(fullpath_writer)
+                    WriteFullPaths(items, all_items, None, fullpath_writer)
+                    EndBulkWrites(fullpath_writer, 'ID')
+                    fullpath_writer.RunSqlFunction(CreateViewAndIndexes, data_type_info, file_name_prefix)
+                else:
+                    with open(output_path_full_paths, 'wb') as output_paths_file:
+                        log.info('Inodes and Path information being written to {}'.format(output_path_full_paths))
+                        output_paths_file.write(b"Inode_Number\tFull_Path\r\n")
+                        WriteFullPaths(items, all_items, output_paths_file, fullpath_writer)
+                        if out_params.write_sql: 
+                            fullpath_writer.RunSqlFunction(CreateViewAndIndexes, data_type_info, file_name_prefix)
                 fullpath_writer.FinishWrites()                
             return items
     except Exception as ex:
         log.exception('Exception processing spotlight store db file')
 
-def CreateViewAndIndexes(data_type_info, sql_writer, file_name_prefix):
+def CreateViewsForIosDb(sql_writer):
+    create_views_for_ios_db(sql_writer.filepath, sql_writer.table_name)
+
+def CreateViewAndIndexes(sql_writer, data_type_info, file_name_prefix):
     desired = ['kMDItemContentTypeTree', 'kMDItemContentType', 'kMDItemKind', 'kMDItemMediaTypes', 
                 '_kMDItemOwnerUserID', '_kMDItemOwnerGroupID', 'kMDItemUserCreatedUserHandle', 'kMDItemUserModifiedUserHandle', 
                 'kMDItemUserPrintedUserHandle', '_kMDItemFileName', 'kMDItemDisplayName', 'kMDItemAlternateNames', 
@@ -324,17 +348,36 @@ def WriteFullPaths(items, all_items, output_paths_file, fullpath_writer):
         Writes inode and full paths table to csv
         items = dictionary of items to write
         all_items = dictionary of items to recursively search full paths
+        output_paths_file = tsv file to write paths to, None to skip it
     '''
-    path_list = []
-    for k,v in list(items.items()):
-        name = v[2]
-        if name:
-            fullpath = spotlight_parser.RecursiveGetFullPath(v, all_items)
-            to_write = str(k) + '\t' + fullpath + '\r\n'
-            output_paths_file.write(to_write.encode('utf-8', 'backslashreplace'))
-            path_list.append([k, fullpath])
+    path_list = [ [k, fullpath] for k, fullpath in spotlight_parser.FullPathResolver(all_items).GetFullPaths(items) ]
+    if output_paths_file:
+        spotlight_parser.WriteFullPathsFile(output_paths_file, path_list)
     fullpath_writer.WriteRows(path_list)
 
+def BeginBulkWrites(data_writer):
+    '''Stops commits after every write to the writer's sqlite db (if it has one), 
+       so all rows go in one transaction, see EndBulkWrites()'''
+    if data_writer.queue: # Writes are done by main process, on a db shared with other plugins
+        log.info('Not using a bulk transaction, as the output db is shared with plugins running in parallel')
+        return
+    data_writer.RunSqlFunction(SqliteWriter.BeginBulkInsert)
+
+def EndBulkWrites(data_writer, index_column):
+    '''Commits rows written after BeginBulkWrites() and creates an index on 
+       index_column, which is faster than updating the index with every insert'''
+    data_writer.RunSqlFunction(EndBulkInsertAndCreateIndex, index_column)
+
+def EndBulkInsertAndCreateIndex(sql_writer, index_column):
+    if sql_writer.table_name and sql_writer.column_info and (index_column in sql_writer.column_info):
+        query = 'CREATE INDEX "{0}_{1}_idx" ON "{0}" ("{1}")'.format(sql_writer.table_name, index_column)
+        if sql_writer.bulk_insert_mode:
+            sql_writer.deferred_queries.append(query)
+        else:
+            sql_writer.RunQuery(query, writing=True)
+    if sql_writer.bulk_insert_mode:
+        sql_writer.EndBulkInsert()
+
 def DropReadme(output_folder, message, filename='Readme.txt'):
     try:
         if not os.path.exists(output_folder):
@@ -8,14 +8,19 @@
 '''
 
 import plugins.helpers.UnifiedLog.Lib as UnifiedLogLib
+from plugins.helpers.UnifiedLog.resources import LogFilter
 from plugins.helpers.UnifiedLog.tracev3_file import TraceV3
 from plugins.helpers.UnifiedLog.virtual_file import VirtualFile
 from plugins.helpers.UnifiedLog.virtual_file_system import VirtualFileSystem
 
 from plugins.helpers.macinfo import *
+from plugins.helpers.worker_processes import GetNumParseWorkers, WorkerPool
 from plugins.helpers.writer import *
+import collections
+import datetime
 import logging
 import os
+import pickle
 import posixpath
 import platform
 
@@ -36,6 +41,18 @@ log = logging.getLogger('MAIN.' + __Plugin_Name) # Do not rename or remove this
 writer = None
 files_processed = 0
 total_logs_processed = 0
+# Set to True (or use mac_apt's --unifiedlogs_export option) to export the diagnostics &
+# uuidtext folders and parse the exported copies, by default files are read directly from the image
+export_log_files = False
+# Filters, to only extract some logs. Leave as None or empty to extract everything.
+# These can also be set with mac_apt's --unifiedlogs_* options.
+filter_start_time = None     # UTC datetime, eg: datetime.datetime(2023, 5, 1, 14, 30)
+filter_end_time = None       # UTC datetime
+filter_subsystems = []       # eg: ['com.apple.xpc', 'com.apple.securityd']
+filter_categories = []       # eg: ['connection']
+filter_process_names = []    # eg: ['sshd', 'kernel']
+filter_min_log_level = None  # One of 'Debug', 'Info', 'Default', 'Error', 'Fault'
+log_filter = None # LogFilter object created from above settings
 data_type_info = [ ('File',DataType.TEXT),('DecompFilePos',DataType.INTEGER),('ContinuousTime',DataType.TEXT),('TimeUtc',DataType.DATE),
               ('Thread',DataType.INTEGER),('Type',DataType.TEXT),('ActivityID',DataType.INTEGER),('ParentActivityID',DataType.INTEGER),
               ('ProcessID',DataType.INTEGER),('EffectiveUID',DataType.INTEGER),('TTL',DataType.INTEGER),('ProcessName',DataType.TEXT),
@@ -47,14 +64,49 @@ data_type_info = [ ('File',DataType.TEXT),('DecompFilePos',DataType.INTEGER),('C
                  ]
 
 class MacAptFile(VirtualFile):
+    '''File read directly from the image. Uuidtext & Dsc files stay open for as long
+       as their objects are used, so only the most recently used of these are kept 
+       open, others are closed and opened again when next read.
+    '''
+    max_open_files = 256
+    open_files = collections.OrderedDict() # Key = MacAptFile, Val = None, least recently used first
+
     def __init__(self, mac_info, path, filetype=''):
+        self._file_pointer = None
+        self._reopen = False # Set when closed to limit open files
         super().__init__(path, filetype)
         self.mac_info = mac_info
 
+    @property
+    def file_pointer(self):
+        if self._file_pointer is None:
+            if self._reopen:
+                log.debug('Reopening {}'.format(self.path))
+                self.open()
+        elif self in MacAptFile.open_files:
+            MacAptFile.open_files.move_to_end(self)
+        return self._file_pointer
+
+    @file_pointer.setter
+    def file_pointer(self, value):
+        self._file_pointer = value
+
+    def _AddToOpenFiles(self):
+        open_files = MacAptFile.open_files
+        open_files[self] = None
+        while len(open_files) > MacAptFile.max_open_files:
+            v_file, _ = open_files.popitem(last=False)
+            v_file._file_pointer.close()
+            v_file._file_pointer = None
+            v_file._reopen = True
+
     def open(self, mode='rb'):
         try:
+            self._reopen = False
             self.file_pointer = self.mac_info.Open(self.path)
-            return self.file_pointer
+            if self._file_pointer and self.file_type in ('Uuidtext', 'Dsc'):
+                self._AddToOpenFiles()
+            return self._file_pointer
         except (OSError, ValueError) as ex:
             if not self.mac_info.IsValidFilePath(self.path):
                 log.error('Failed to open as file not found {}'.format(self.path))
@@ -64,6 +116,16 @@ class MacAptFile(VirtualFile):
             self.is_valid = False
         return None
 
+    def close(self):
+        MacAptFile.open_files.pop(self, None)
+        self._reopen = False
+        super().close()
+
+    @staticmethod
+    def CloseOpenFiles():
+        for v_file in list(MacAptFile.open_files):
+            v_file.close()
+
 class MacAptVfs(VirtualFileSystem):
     def __init__(self, mac_info):
         super().__init__(MacAptFile)
@@ -143,47 +205,154 @@ class MacAptVfsLocal(VirtualFileSystem):
         path_local = self.ConstructLocalPath(path)
         return MacAptFileLocal(path, path_local, filetype)
 
-def ProcessLogsList(logs, tracev3):
-    '''
-    logs  = filename, log_file_pos, ct, time, thread, log_type, act_id[-1], parentActivityIdentifier, 
-                pid, euid, ttl, p_name, lib, sub_sys, cat,
-                signpost_name, signpost_string, 
-                imageOffset, imageUUID, processImageUUID, 
-                senderImagePath, processImagePath,
-                log_msg
-    '''
-
-    global writer
-    global total_logs_processed
-
-    # Convert UUIDs to string and dates to human-readable for writing to db
+def ConvertLogsList(logs):
+    '''Convert UUIDs to string and dates to human-readable for writing to db'''
     for log in logs:
         log[3]  = CommonFunctions.ReadAPFSTime(log[3])
         log[18] = str(log[18])
         log[19] = str(log[19])
+
+def WriteLogsList(logs):
+    global total_logs_processed
     try:
         writer.WriteRows(logs)
         total_logs_processed += len(logs)
     except sqlite3.Error as ex:
         log.exception ("Failed to write log row data to db")
 
-def RecurseProcessLogFiles(vfs, input_path, ts_list, uuidtext_folder_path, large_data_cache, caches):
-    '''Recurse the folder located by input_path and process all .traceV3 files'''
-    global files_processed
+def ProcessLogsList(logs, tracev3):
+    '''
+    logs  = filename, log_file_pos, ct, time, thread, log_type, act_id[-1], parentActivityIdentifier, 
+                pid, euid, ttl, p_name, lib, sub_sys, cat,
+                signpost_name, signpost_string, 
+                imageOffset, imageUUID, processImageUUID, 
+                senderImagePath, processImagePath,
+                log_msg
+    '''
+    ConvertLogsList(logs)
+    WriteLogsList(logs)
+
+def FindLogFiles(vfs, input_path, log_files):
+    '''Recurse the folder located by input_path and add paths of all .traceV3 files to log_files'''
     files = vfs.listdir(input_path)
     input_path = input_path.rstrip('/')
     for file_name in files:
         input_file_path = input_path + '/' + file_name
         if file_name.lower().endswith('.tracev3') and not file_name.startswith('._'):
-            log.info("Processing tracev3 file - " + input_file_path)
-            v_file = vfs.get_virtual_file(input_file_path, 'traceV3')
-            TraceV3(vfs, v_file, ts_list, uuidtext_folder_path, large_data_cache, caches).Parse(ProcessLogsList)
-            files_processed += 1
+            log_files.append(input_file_path)
         elif vfs.is_dir(input_file_path):
-            RecurseProcessLogFiles(vfs, input_file_path, ts_list, uuidtext_folder_path, large_data_cache, caches)
+            FindLogFiles(vfs, input_file_path, log_files)
         else:
             log.debug('Not a log file:' + input_file_path)
 
+def ProcessLogFile(vfs, input_file_path, ts_list, uuidtext_folder_path, large_data_cache, caches):
+    global files_processed
+    v_file = vfs.get_virtual_file(input_file_path, 'traceV3')
+    TraceV3(vfs, v_file, ts_list, uuidtext_folder_path, large_data_cache, caches, log_filter).Parse(ProcessLogsList)
+    files_processed += 1
+
+# Used by ProcessLogFilesInParallel(), inherited by forked workers
+_parallel_parse_args = None # (vfs, ts_list, uuidtext_folder_path, temp_folder)
+_worker_caches = None
+
+def _ParseLogFileToTempFile(job):
+    '''Worker process function, parses one tracev3 file and saves its logs (pickled 
+       lists) in a temp file. As there is no large_data_cache from earlier files, it
+       returns what is left in its own cache, and any data references not found.
+       Returns tuple (index, temp_path, leftover_large_data, missing_data_refs)
+    '''
+    global _worker_caches
+    index, input_file_path = job
+    vfs, ts_list, uuidtext_folder_path, temp_folder = _parallel_parse_args
+    temp_path = os.path.join(temp_folder, '{}.pickle'.format(index))
+    try:
+        if _worker_caches is None: # Dsc objects keep files open, so each worker has its own
+            if isinstance(vfs, MacAptVfs): # Image handles are not shared with parent
+                vfs.mac_info._ReopenImageHandles(vfs.mac_info.image_opener)
+            _worker_caches = UnifiedLogLib.CachedFiles(vfs)
+            _worker_caches.ParseFolder(uuidtext_folder_path)
+        large_data_cache = {}
+        with open(temp_path, 'wb') as temp_file:
+            def SaveLogsList(logs, tracev3):
+                ConvertLogsList(logs)
+                pickle.dump(logs, temp_file, pickle.HIGHEST_PROTOCOL)
+            v_file = vfs.get_virtual_file(input_file_path, 'traceV3')
+            tracev3 = TraceV3(vfs, v_file, ts_list, uuidtext_folder_path, large_data_cache, _worker_caches, log_filter)
+            tracev3.Parse(SaveLogsList)
+        return index, temp_path, large_data_cache, tracev3.missing_data_refs
+    except Exception:
+        log.exception('Error parsing {} in worker process'.format(input_file_path))
+    return index, None, None, None
+
+def WriteLogsFromTempFile(temp_path):
+    with open(temp_path, 'rb') as temp_file:
+        while True:
+            try:
+                logs = pickle.load(temp_file)
+            except EOFError:
+                break
+            WriteLogsList(logs)
+
+def ProcessLogFilesInParallel(vfs, log_files, ts_list, uuidtext_folder_path, large_data_cache, caches, output_path, num_workers):
+    '''Parses tracev3 files in worker processes, logs are written here in the same
+       order as a serial run. If a file referenced large data left over from earlier 
+       files (which its worker did not have), that file is parsed again here.
+       Returns False if parallel parsing is not possible.
+    '''
+    global _parallel_parse_args
+    global files_processed
+    if isinstance(vfs, MacAptVfs) and vfs.mac_info.pytsk_image and not vfs.mac_info.image_opener:
+        return False # Workers reading from the image need their own image handles
+
+    log.info('Parsing {} tracev3 files using {} worker processes'.format(len(log_files), num_workers))
+    try:
+        # Workers inherit the vfs & timesync list
+        with WorkerPool(output_path, 'UnifiedLogs_Temp_') as worker_pool:
+            _parallel_parse_args = (vfs, ts_list, uuidtext_folder_path, worker_pool.temp_folder)
+            pool = worker_pool.Start(num_workers)
+            pending = collections.deque() # Results in file order, a few files ahead to limit temp disk usage
+            next_index = 0
+            while pending or next_index < len(log_files):
+                while next_index < len(log_files) and len(pending) < num_workers * 2:
+                    pending.append(pool.apply_async(_ParseLogFileToTempFile, [(next_index, log_files[next_index])]))
+                    next_index += 1
+                index, temp_path, leftover_large_data, missing_data_refs = pending.popleft().get()
+                input_file_path = log_files[index]
+                log.info("Processing tracev3 file - " + input_file_path)
+                if temp_path is None:
+                    log.info('Parsing {} again, as it failed in worker process'.format(input_file_path))
+                    ProcessLogFile(vfs, input_file_path, ts_list, uuidtext_folder_path, large_data_cache, caches)
+                elif any(ref in large_data_cache for ref in missing_data_refs):
+                    log.info('Parsing {} again, it references data from earlier files'.format(input_file_path))
+                    ProcessLogFile(vfs, input_file_path, ts_list, uuidtext_folder_path, large_data_cache, caches)
+                else:
+                    WriteLogsFromTempFile(temp_path)
+                    large_data_cache.update(leftover_large_data)
+                    files_processed += 1
+                if temp_path:
+                    os.remove(temp_path)
+    finally:
+        _parallel_parse_args = None
+    return True
+
+def GetApfsTime(dt):
+    '''Returns nanoseconds since 1970 for a UTC datetime'''
+    return ((dt - datetime.datetime(1970, 1, 1)) // datetime.timedelta(microseconds=1)) * 1000
+
+def CreateLogFilter():
+    '''Returns a LogFilter from the filter_* settings, None if there is no filtering'''
+    if not (filter_start_time or filter_end_time or filter_subsystems or filter_categories or 
+            filter_process_names or filter_min_log_level):
+        return None
+    log.info('Only logs matching these filters will be extracted: ' +
+             ', '.join(['{}={}'.format(name, value) for name, value in (
+                ('start_time', filter_start_time), ('end_time', filter_end_time), ('subsystems', filter_subsystems), 
+                ('categories', filter_categories), ('process_names', filter_process_names), 
+                ('min_log_level', filter_min_log_level)) if value]))
+    return LogFilter(GetApfsTime(filter_start_time) if filter_start_time else None,
+                     GetApfsTime(filter_end_time) if filter_end_time else None,
+                     filter_subsystems, filter_categories, filter_process_names, filter_min_log_level)
+
 def CopyOutputParams(output_params):
     '''Creates and returns a copy of MacInfo.OutputParams object'''
     op_copy = OutputParams()
@@ -241,10 +410,17 @@ def Plugin_Start(mac_info):
     global writer
     global files_processed
     global total_logs_processed
+    global log_filter
 
     if not SetFileDescriptorLimit():
         return
 
+    try:
+        log_filter = CreateLogFilter()
+    except ValueError as ex:
+        log.error('Bad filter setting - ' + str(ex))
+        return
+
     version_info = mac_info.GetVersionDictionary()
     if version_info['major'] == 10:
         if (version_info['minor'] < 12):
@@ -263,14 +439,18 @@ def Plugin_Start(mac_info):
     traceV3_path = '/private/var/db/diagnostics'
     uuidtext_folder_path = '/private/var/db/uuidtext'
 
-    if mac_info.IsValidFolderPath(traceV3_path) and mac_info.IsValidFolderPath(uuidtext_folder_path):
-        mac_info.ExportFolder(traceV3_path, __Plugin_Name, True) 
-        mac_info.ExportFolder(uuidtext_folder_path, __Plugin_Name, True)
-    else:
+    if not (mac_info.IsValidFolderPath(traceV3_path) and mac_info.IsValidFolderPath(uuidtext_folder_path)):
         log.info('Unified Logging folders not found!')
         return
 
-    vfs = MacAptVfsLocal('/private/var/db', os.path.join(mac_info.output_params.export_path, __Plugin_Name)) #MacAptVfs(mac_info)
+    if export_log_files:
+        mac_info.ExportFolder(traceV3_path, __Plugin_Name, True) 
+        mac_info.ExportFolder(uuidtext_folder_path, __Plugin_Name, True)
+        vfs = MacAptVfsLocal('/private/var/db', os.path.join(mac_info.output_params.export_path, __Plugin_Name))
+    else:
+        log.info('Reading log files directly from the image, the diagnostics & uuidtext folders are not exported. '
+                 'To export them, run mac_apt with the --unifiedlogs_export option')
+        vfs = MacAptVfs(mac_info)
 
     #Read uuidtext & dsc files
     caches = UnifiedLogLib.CachedFiles(vfs)
@@ -292,9 +472,20 @@ def Plugin_Start(mac_info):
         if CreateSqliteDb(output_path, out_params):
             writer = DataWriter(out_params, "UnifiedLogs", data_type_info, traceV3_path)
             large_data_cache = {}
-            RecurseProcessLogFiles(vfs, traceV3_path, ts_list, uuidtext_folder_path, large_data_cache, caches)
+            log_files = []
+            FindLogFiles(vfs, traceV3_path, log_files)
+            num_workers = GetNumParseWorkers(len(log_files))
+            if num_workers > 1 and \
+                ProcessLogFilesInParallel(vfs, log_files, ts_list, uuidtext_folder_path, large_data_cache, caches, output_path, num_workers):
+                pass
+            else:
+                for input_file_path in log_files:
+                    log.info("Processing tracev3 file - " + input_file_path)
+                    ProcessLogFile(vfs, input_file_path, ts_list, uuidtext_folder_path, large_data_cache, caches)
     except:
         log.exception('')
+    caches.Close()
+    MacAptFile.CloseOpenFiles()
     if writer:
         writer.FinishWrites()
     if files_processed > 0: